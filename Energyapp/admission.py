@@ -0,0 +1,196 @@
+import fcntl
+import math
+import os
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.http import JsonResponse
+
+from . import metrics
+
+# decoded RGB array plus PIL's copy while converting it (renders are drawn later, from disk)
+BYTES_PER_PIXEL = 6
+
+POLL_S = (0.005, 0.05)  # first and longest sleep between retries while queued
+
+
+class Rejected(Exception):
+    """The request was not admitted; becomes a 429 (queue full) or 503 (waited too long)."""
+
+    def __init__(self, status, message, retry_after):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+
+    def response(self):
+        response = JsonResponse({"error": self.message}, status=self.status)
+        response["Retry-After"] = str(self.retry_after)
+        return response
+
+
+class Ticket:
+    """Slot locks held by one admitted request."""
+
+    def __init__(self, controller, fds, waited):
+        self.controller = controller
+        self.fds = fds
+        self.waited = waited
+        self.started = time.monotonic()
+
+    @property
+    def weight(self):
+        return len(self.fds)
+
+    def release(self):
+        if self.fds:
+            _unlock(self.fds)
+            self.fds = []
+            self.controller._held(time.monotonic() - self.started)
+
+
+# =====================================================
+# Host-wide admission control
+# =====================================================
+class AdmissionController:
+    """
+    Bounds the analyses in flight on this host, across all worker processes.
+    Every slot is a lock file under ENERGY_ADMISSION_DIR held with flock(), so
+    slots of a crashed worker are freed by the kernel. A request takes one
+    slot, or more when its decoded image is larger than the memory budget of
+    one slot. Requests that find no free slot wait in a queue (also lock files,
+    so its length is host-wide too) until their deadline; with the queue full
+    they are turned away at once.
+    """
+
+    def __init__(self):
+        self._avg_hold = 1.0  # seconds a ticket is held, moving average of this process
+        self._lock = threading.Lock()
+        self._ready_dir = None
+
+    # ---------------- SETTINGS ----------------
+    @property
+    def enabled(self):
+        return self.slots > 0
+
+    @property
+    def slots(self):
+        return getattr(settings, "ENERGY_ADMISSION_SLOTS", 0)
+
+    @property
+    def queue_length(self):
+        return settings.ENERGY_ADMISSION_QUEUE
+
+    @property
+    def directory(self):
+        path = settings.ENERGY_ADMISSION_DIR
+        if self._ready_dir != path:
+            os.makedirs(path, exist_ok=True)
+            self._ready_dir = path
+        return path
+
+    def weight(self, image_size=None, images=1):
+        """Slots for `images` images of `image_size` (width, height); unknown sizes count as one slot each."""
+        if not self.enabled:
+            return 1
+        per_image = 1
+        if image_size is not None:
+            slot_bytes = settings.ENERGY_ADMISSION_MEMORY_MB * (1 << 20) / self.slots
+            per_image = math.ceil(image_size[0] * image_size[1] * BYTES_PER_PIXEL / slot_bytes)
+        return min(max(per_image * images, 1), self.slots)
+
+    # ---------------- ACQUIRE / RELEASE ----------------
+    def acquire(self, weight=1, max_wait=None):
+        """Returns a Ticket, or raises Rejected."""
+        started = time.monotonic()
+        fds = self._try_slots(weight)
+        if fds is not None:
+            metrics.admission.inc(result="admitted")
+            return Ticket(self, fds, 0.0)
+
+        queued = self._try_lock("queue", self.queue_length, 1)
+        if queued is None:
+            metrics.admission.inc(result="queue_full")
+            raise Rejected(429, "Server is busy, too many analyses queued", self.retry_after(weight))
+
+        max_wait = settings.ENERGY_ADMISSION_MAX_WAIT_S if max_wait is None else max_wait
+        deadline = started + max_wait
+        pause = POLL_S[0]
+        try:
+            while True:
+                fds = self._try_slots(weight)
+                if fds is not None:
+                    waited = time.monotonic() - started
+                    metrics.admission.inc(result="queued")
+                    metrics.admission_wait_seconds.observe(waited)
+                    return Ticket(self, fds, waited)
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.admission.inc(result="timeout")
+                    metrics.admission_wait_seconds.observe(max_wait)
+                    raise Rejected(503, "Server is busy, no inference slot became free", self.retry_after(weight))
+                # jitter so queued workers do not poll in lockstep
+                time.sleep(min(pause * random.uniform(0.5, 1.5), remaining))
+                pause = min(pause * 2, POLL_S[1])
+        finally:
+            _unlock(queued)
+
+    def retry_after(self, weight=1):
+        """Seconds until a slot is likely free: the queue ahead, drained at the observed hold time."""
+        ahead = (self.queue_length + weight) / self.slots
+        return max(1, min(60, math.ceil(self._avg_hold * ahead)))
+
+    def _held(self, seconds):
+        with self._lock:
+            self._avg_hold = 0.9 * self._avg_hold + 0.1 * seconds
+
+    def _try_slots(self, weight):
+        return self._try_lock("slot", self.slots, weight)
+
+    def _try_lock(self, prefix, count, weight):
+        """`weight` of the `count` lock files, all or nothing (partial holds could deadlock)."""
+        if count <= 0:
+            return None
+        fds = []
+        first = random.randrange(count)  # spread the processes over the files
+        for i in range(count):
+            fd = os.open(
+                os.path.join(self.directory, f"{prefix}-{(first + i) % count}.lock"),
+                os.O_RDWR | os.O_CREAT | os.O_CLOEXEC, 0o600,
+            )
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                os.close(fd)
+                continue
+            fds.append(fd)
+            if len(fds) == weight:
+                return fds
+        _unlock(fds)
+        return None
+
+    # ---------------- PER REQUEST ----------------
+    def admit(self, request, weight=1):
+        """
+        Admits `request` (once; later calls are no-ops) and keeps the ticket on
+        it until AdmissionMiddleware releases it. Raises Rejected.
+        """
+        if not self.enabled or getattr(request, "admission_ticket", None) is not None:
+            return
+        request.admission_ticket = self.acquire(weight)
+
+    def release(self, request):
+        ticket = getattr(request, "admission_ticket", None)
+        if ticket is not None:
+            ticket.release()
+            request.admission_ticket = None
+
+
+def _unlock(fds):
+    for fd in fds:
+        os.close(fd)  # closing the only descriptor drops the flock
+
+
+admission = AdmissionController()
@@ -0,0 +1,213 @@
+import base64
+import json
+from datetime import date
+
+from django.db.models import Avg, Count, F, Max, Min, Prefetch, Q, Sum
+
+from .models import DailyLossRollup, FaultDetail, PanelAnalysis, YOLOOutput
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+# ---------------- KEYSET CURSORS ----------------
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Opaque cursor -> list of values, or None. Raises ValueError for a tampered cursor."""
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    if not isinstance(values, list):
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def page_size(raw):
+    try:
+        size = int(raw) if raw else DEFAULT_PAGE_SIZE
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    return min(max(size, 1), MAX_PAGE_SIZE)
+
+
+def paginate(rows, limit, cursor_of):
+    """`rows` holds up to limit + 1 items; returns (page, next cursor or None)."""
+    rows = list(rows)
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(cursor_of(rows[-1]))
+
+
+# =====================================================
+# Aggregations (all computed in the database)
+# =====================================================
+def latest_outputs(location=None):
+    """The current analysis of every image, optionally for one site."""
+    outputs = YOLOOutput.objects.filter(is_latest=True)
+    if location is not None:
+        outputs = outputs.filter(input_image__location=location)
+    return outputs
+
+
+def totals(location=None):
+    row = latest_outputs(location).aggregate(
+        images=Count("id"),
+        total_daily_loss_kwh=Sum("total_daily_loss_kwh"),
+        mean_loss_percentage=Avg("loss_percentage"),
+        panels=Sum("total_panels"),
+        first_inspection=Min("input_image__created_at"),
+        last_inspection=Max("input_image__created_at"),
+    )
+    return {
+        "images": row["images"],
+        "panels": row["panels"] or 0,
+        "total_daily_loss_kwh": round(row["total_daily_loss_kwh"] or 0, 3),
+        "mean_loss_percentage": round(row["mean_loss_percentage"] or 0, 2),
+        "first_inspection": row["first_inspection"].isoformat() if row["first_inspection"] else None,
+        "last_inspection": row["last_inspection"].isoformat() if row["last_inspection"] else None,
+    }
+
+
+def loss_by_fault(location=None):
+    faults = FaultDetail.objects.filter(panel__yolo_output__is_latest=True)
+    if location is not None:
+        faults = faults.filter(panel__yolo_output__input_image__location=location)
+    rows = (
+        faults.values("fault_name")
+        .annotate(
+            faults=Count("id"),
+            total_daily_loss_kwh=Sum("daily_loss"),
+            mean_confidence=Avg("confidence"),
+        )
+        .order_by("-total_daily_loss_kwh", "fault_name")
+    )
+    return [
+        {
+            "fault": row["fault_name"],
+            "faults": row["faults"],
+            "total_daily_loss_kwh": round(row["total_daily_loss_kwh"] or 0, 3),
+            "mean_confidence": round(row["mean_confidence"] or 0, 3),
+        }
+        for row in rows
+    ]
+
+
+def sites_page(limit, cursor=None):
+    """Per-site totals ordered by location, keyset paginated on the location."""
+    rows = latest_outputs().filter(input_image__location__isnull=False).values(location=F("input_image__location"))
+    after = decode_cursor(cursor)
+    if after:
+        if not isinstance(after[0], str):
+            raise ValueError("Invalid cursor")
+        rows = rows.filter(input_image__location__gt=after[0])
+    rows = (
+        rows.annotate(
+            images=Count("id"),
+            total_daily_loss_kwh=Sum("total_daily_loss_kwh"),
+            mean_loss_percentage=Avg("loss_percentage"),
+            last_inspection=Max("input_image__created_at"),
+        )
+        .order_by("location")[:limit + 1]
+    )
+    page, next_cursor = paginate(rows, limit, lambda row: [row["location"]])
+    return [
+        {
+            "location": row["location"],
+            "images": row["images"],
+            "total_daily_loss_kwh": round(row["total_daily_loss_kwh"] or 0, 3),
+            "mean_loss_percentage": round(row["mean_loss_percentage"] or 0, 2),
+            "last_inspection": row["last_inspection"].isoformat() if row["last_inspection"] else None,
+        }
+        for row in page
+    ], next_cursor
+
+
+def daily_loss_page(limit, cursor=None, location=None, start=None, end=None):
+    """
+    Loss per calendar day (newest first), keyset paginated on the day.
+    Read from the DailyLossRollup table, not from the raw analyses.
+    """
+    rows = DailyLossRollup.objects.filter(fault_name=DailyLossRollup.ALL_FAULTS)
+    if location is not None:
+        rows = rows.filter(location=location)
+    if start is not None:
+        rows = rows.filter(day__gte=start)
+    if end is not None:
+        rows = rows.filter(day__lte=end)
+
+    after = decode_cursor(cursor)
+    if after:
+        try:
+            day = date.fromisoformat(after[0])
+        except (TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+        rows = rows.filter(day__lt=day)
+    rows = (
+        rows.values("day")
+        .annotate(
+            images=Sum("images"),
+            total_daily_loss_kwh=Sum("daily_loss_kwh"),
+            loss_percentage_total=Sum("loss_percentage_total"),
+        )
+        .order_by("-day")[:limit + 1]
+    )
+    page, next_cursor = paginate(rows, limit, lambda row: [row["day"].isoformat()])
+    return [
+        {
+            "date": row["day"].isoformat(),
+            "images": row["images"],
+            "total_daily_loss_kwh": round(row["total_daily_loss_kwh"] or 0, 3),
+            "mean_loss_percentage": round(row["loss_percentage_total"] / row["images"], 2) if row["images"] else 0,
+        }
+        for row in page
+    ], next_cursor
+
+
+def worst_panels_page(limit, cursor=None, location=None):
+    """Panels by daily loss, highest first, keyset paginated on (loss, id)."""
+    panels = PanelAnalysis.objects.filter(yolo_output__is_latest=True)
+    if location is not None:
+        panels = panels.filter(yolo_output__input_image__location=location)
+
+    after = decode_cursor(cursor)
+    if after:
+        try:
+            loss, pk = float(after[0]), int(after[1])
+        except (IndexError, TypeError, ValueError):
+            raise ValueError("Invalid cursor")
+        panels = panels.filter(Q(panel_loss_kwh__lt=loss) | Q(panel_loss_kwh=loss, id__lt=pk))
+
+    panels = (
+        panels.select_related("yolo_output__input_image")
+        .only(
+            "id", "panel_number", "panel_loss_kwh",
+            "yolo_output", "yolo_output__download_token",
+            "yolo_output__input_image", "yolo_output__input_image__location",
+            "yolo_output__input_image__created_at",
+        )
+        .prefetch_related(Prefetch(
+            "faults",
+            queryset=FaultDetail.objects.only("panel_id", "fault_name", "daily_loss").order_by("-daily_loss"),
+        ))
+        .order_by("-panel_loss_kwh", "-id")[:limit + 1]
+    )
+    page, next_cursor = paginate(panels, limit, lambda p: [p.panel_loss_kwh, p.id])
+    return [
+        {
+            "panel_id": p.id,
+            "panel_number": p.panel_number,
+            "panel_loss_kwh": round(p.panel_loss_kwh, 3),
+            "location": p.yolo_output.input_image.location,
+            "inspected_at": p.yolo_output.input_image.created_at.isoformat(),
+            "download_token": str(p.yolo_output.download_token),
+            "faults": [{"fault": f.fault_name, "daily_loss": round(f.daily_loss, 3)} for f in p.faults.all()],
+        }
+        for p in page
+    ], next_cursor
@@ -1,6 +1,33 @@
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class EnergyappConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'Energyapp'
+
+    def ready(self):
+        import os
+
+        from PIL import Image
+
+        if getattr(settings, "FILE_UPLOAD_TEMP_DIR", None):
+            os.makedirs(settings.FILE_UPLOAD_TEMP_DIR, exist_ok=True)
+
+        Image.MAX_IMAGE_PIXELS = getattr(settings, "ENERGY_MAX_IMAGE_PIXELS", Image.MAX_IMAGE_PIXELS)
+
+        # the models are loaded by serving processes only, see boot.serve()
+
+        # a typo in the cascade order would otherwise fail every analysis
+        from .cascade import CascadeRules
+        from .pipeline import DETECTOR_CONFS
+
+        CascadeRules.from_settings().validate(DETECTOR_CONFS)
+
+        from django.db.models.signals import post_delete
+
+        from .models import GrayscaleImage, YOLOOutput
+        from .storage import release_on_delete
+
+        for model in (GrayscaleImage, YOLOOutput):
+            post_delete.connect(release_on_delete, sender=model, dispatch_uid=f"release_{model.__name__}")
@@ -0,0 +1,182 @@
+import logging
+import os
+import shutil
+import zipfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.utils import timezone
+from PIL import Image, UnidentifiedImageError
+
+from .models import GrayscaleImage
+from .pipeline import analyze_batch, analyze_image, mark_failed, wants_tiled
+from .preprocess import PreparedImage
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp"}
+
+COPY_CHUNK_SIZE = 256 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class Skipped:
+    """Stands in for an upload that is not read; `reason` is reported for that image."""
+
+    def __init__(self, reason):
+        self.reason = reason
+
+
+# ---------------- UPLOAD SOURCES ----------------
+def iter_zip_images(archive, max_member_bytes=None, max_total_bytes=None):
+    """
+    Yields (name, file) for every image inside a ZIP upload. Members are
+    extracted one at a time to a temporary file (so saving them is a rename),
+    never into memory. Members larger than `max_member_bytes`, and all members
+    once `max_total_bytes` of uncompressed data are reached, come back as
+    Skipped: the sizes are checked before anything is inflated (ZIP bombs).
+    """
+    max_member_bytes = max_member_bytes or settings.ENERGY_MAX_UPLOAD_BYTES
+    max_total_bytes = max_total_bytes or settings.ENERGY_BATCH_MAX_UPLOAD_BYTES
+    total = 0
+
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            name = info.filename
+            if info.is_dir() or name.startswith("__MACOSX/"):
+                continue
+            if os.path.splitext(name)[1].lower() not in IMAGE_EXTENSIONS:
+                continue
+            name = os.path.basename(name)
+
+            if info.file_size > max_member_bytes:
+                yield name, Skipped("Image is too large")
+                continue
+            total += info.file_size
+            if total > max_total_bytes:
+                yield name, Skipped("Archive is too large")
+                continue
+
+            # reading stops at the declared file_size, whatever the compressed stream holds
+            f = TemporaryUploadedFile(name, "application/octet-stream", info.file_size, None)
+            with zf.open(info) as member:
+                shutil.copyfileobj(member, f, COPY_CHUNK_SIZE)
+            f.seek(0)
+            yield name, f
+
+
+def iter_batch_uploads(files):
+    """All images of a batch request: every "images" file plus the content of an "archive" ZIP."""
+    for f in files.getlist("images"):
+        yield f.name, f
+    if "archive" in files:
+        yield from iter_zip_images(files["archive"])
+
+
+def chunked(iterable, size):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# =====================================================
+# Whole-site inspection
+# =====================================================
+def analyze_site(uploads, location, capacity, sun_hours, batch_size=8, max_images=None):
+    """
+    Runs every upload through the detection pipeline, batch_size images per
+    forward pass; images above ENERGY_TILED_AUTO_SIDE run on their own, tile
+    by tile. Returns (per-image results, site aggregate).
+    """
+    results = []
+    admitted = 0
+
+    for chunk in chunked(uploads, batch_size):
+        names, img_objs, prepared_list = [], [], []
+        chunk_results = []  # None = filled in after inference, keeps upload order
+
+        for name, f in chunk:
+            if max_images is not None and admitted >= max_images:
+                chunk_results.append({"file_name": name, "error": "Too many images in one batch"})
+                continue
+            if isinstance(f, Skipped):
+                chunk_results.append({"file_name": name, "error": f.reason})
+                continue
+            try:
+                tiled = wants_tiled(f)
+                prepared = None if tiled else PreparedImage.from_upload(f)
+            except Image.DecompressionBombError:
+                chunk_results.append({"file_name": name, "error": "Image has too many pixels"})
+                continue
+            except (UnidentifiedImageError, OSError):
+                chunk_results.append({"file_name": name, "error": "Not a valid image"})
+                continue
+
+            img_obj = GrayscaleImage.objects.create(
+                image=f,
+                content_hash=getattr(f, "sha256", None) or "",
+                location=location,
+                capacity=capacity,
+                sunlight_hours=sun_hours,
+                status=GrayscaleImage.STATUS_RUNNING,
+                started_at=timezone.now(),
+                tiled=tiled,
+            )
+            admitted += 1
+
+            if tiled:
+                # too large for one letterboxed frame: windows are read from the stored file
+                try:
+                    payload = analyze_image(img_obj, content_hash=img_obj.content_hash, tiled=True)
+                except Exception:
+                    logger.exception("Tiled analysis of %s failed", name)
+                    mark_failed(img_obj)
+                    payload = None
+                chunk_results.append(site_result(name, img_obj, payload))
+                continue
+
+            img_objs.append(img_obj)
+            prepared_list.append(prepared)
+            names.append(name)
+            chunk_results.append(None)
+
+        try:
+            payloads = analyze_batch(img_objs, prepared_list) if img_objs else []
+        except Exception:
+            # the chunk's rows were rolled back together; the rest of the site still runs
+            logger.exception("Batch analysis of %d image(s) failed", len(img_objs))
+            for img_obj in img_objs:
+                mark_failed(img_obj)
+            payloads = [None] * len(img_objs)
+
+        objs = iter(zip(names, img_objs, payloads))
+        for item in chunk_results:
+            results.append(site_result(*next(objs)) if item is None else item)
+
+    done = [item["summary"] for item in results if "summary" in item]
+    analysed = len(done)
+    total_loss = sum(summary["total_daily_loss_kwh"] for summary in done)
+    max_energy = capacity * sun_hours * analysed
+    site = {
+        "location": location,
+        "images": len(results),
+        "analysed": analysed,
+        "failed": len(results) - analysed,
+        "system_capacity_kw": capacity,
+        "sunlight_hours": sun_hours,
+        "total_daily_loss_kwh": round(total_loss, 3),
+        "mean_daily_loss_kwh": round(total_loss / analysed, 3) if analysed else 0,
+        "overall_loss_percentage": round(total_loss / max_energy * 100, 2) if max_energy else 0,
+    }
+    return results, site
+
+
+def site_result(name, img_obj, payload):
+    """One image's entry in the site results; payload None = its analysis failed."""
+    if payload is None:
+        return {"file_name": name, "job_id": str(img_obj.signature), "error": "Analysis failed"}
+    return {"file_name": name, "job_id": str(img_obj.signature), **payload}
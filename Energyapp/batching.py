@@ -0,0 +1,116 @@
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+
+
+# =====================================================
+# Dynamic micro-batching in front of one model
+# =====================================================
+class MicroBatcher:
+    """
+    Collects images submitted by concurrent requests for up to `window_ms`
+    (or until `max_batch` images are waiting), runs them as one batched
+    forward pass and hands every caller its own result.
+
+    `run_batch` takes a list of items and returns a list of results in the
+    same order.
+    """
+
+    def __init__(self, name, run_batch, window_ms=20, max_batch=8):
+        self.name = name
+        self.run_batch = run_batch
+        self.window = window_ms / 1000.0
+        self.max_batch = max(1, max_batch)
+
+        self._queue = queue.Queue()
+        self._thread = None
+        self._thread_pid = None
+        self._start_lock = threading.Lock()
+
+        # stats
+        self._stats_lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.images = 0
+        self.max_queue_depth = 0
+        self.total_wait_s = 0.0
+        self.max_wait_s = 0.0
+
+    def submit(self, item):
+        """Queues one item; returns a Future resolving to its result."""
+        self._ensure_thread()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+
+        depth = self._queue.qsize()
+        if depth > self.max_queue_depth:
+            self.max_queue_depth = depth
+        return future
+
+    def _ensure_thread(self):
+        # the collector thread does not survive a fork, so start one per process
+        with self._start_lock:
+            if self._thread is None or self._thread_pid != os.getpid():
+                self._thread = threading.Thread(
+                    target=self._loop, name=f"microbatch-{self.name}", daemon=True
+                )
+                self._thread.start()
+                self._thread_pid = os.getpid()
+
+    def _collect(self):
+        first = self._queue.get()
+        batch = [first]
+        deadline = first[2] + self.window
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._collect()
+            started = time.perf_counter()
+            self._record(batch, started)
+
+            try:
+                results = self.run_batch([item for item, _, _ in batch])
+            except Exception as exc:  # hand the failure to every waiting caller
+                for _, future, _ in batch:
+                    future.set_exception(exc)
+                continue
+
+            for (_, future, _), result in zip(batch, results):
+                future.set_result(result)
+
+    def _record(self, batch, started):
+        with self._stats_lock:
+            self.batch_sizes[len(batch)] += 1
+            self.images += len(batch)
+            for _, _, queued_at in batch:
+                wait = started - queued_at
+                self.total_wait_s += wait
+                self.max_wait_s = max(self.max_wait_s, wait)
+
+    def stats(self):
+        with self._stats_lock:
+            batches = sum(self.batch_sizes.values())
+            return {
+                "window_ms": round(self.window * 1000, 1),
+                "max_batch": self.max_batch,
+                "queue_depth": self._queue.qsize(),
+                "max_queue_depth": self.max_queue_depth,
+                "batches": batches,
+                "images": self.images,
+                "mean_batch_size": round(self.images / batches, 2) if batches else 0,
+                "batch_size_histogram": {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                "mean_wait_ms": round(self.total_wait_s / self.images * 1000, 2) if self.images else 0,
+                "max_wait_ms": round(self.max_wait_s * 1000, 2),
+            }
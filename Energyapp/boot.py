@@ -0,0 +1,64 @@
+import os
+import time
+
+from django.conf import settings
+from django.db import connection
+
+# never imported by management commands, the admin or the health checks
+HEAVY_MODULES = ("torch", "ultralytics", "cv2", "onnxruntime", "openvino")
+
+# boot timings of this process (seconds), shown by /readyz
+timings = {}
+
+
+# =====================================================
+# Serving processes only (wsgi.py / asgi.py)
+# =====================================================
+def serve(started):
+    """
+    Called once the WSGI/ASGI application exists; `started` is the
+    perf_counter() from before Django was set up. Loads the models here,
+    so `manage.py migrate`, `check`, the admin, ... never import torch.
+    Under gunicorn --preload this runs in the master and the forked
+    workers share the weights; they warm up in post_worker_init.
+    """
+    timings.clear()
+    timings["django_setup_s"] = round(time.perf_counter() - started, 3)
+
+    if getattr(settings, "ENERGY_PRELOAD_MODELS", True):
+        from .inference import engine
+
+        t0 = time.perf_counter()
+        engine.load(warmup=not getattr(settings, "ENERGY_DEFER_WARMUP", False))
+        timings["models_s"] = round(time.perf_counter() - t0, 3)
+
+    timings["boot_s"] = round(time.perf_counter() - started, 3)
+    timings["pid"] = os.getpid()
+
+
+def worker_started(started):
+    """gunicorn post_worker_init: time from fork until the worker can serve."""
+    timings["pid"] = os.getpid()
+    timings["worker_boot_s"] = round(time.perf_counter() - started, 3)
+
+
+# =====================================================
+# Readiness (liveness needs nothing: the process answers)
+# =====================================================
+def readiness():
+    """(ready, {check: ok}) for this worker process."""
+    checks = {}
+
+    try:
+        connection.ensure_connection()
+        checks["database"] = True
+    except Exception:
+        checks["database"] = False
+
+    if getattr(settings, "ENERGY_PRELOAD_MODELS", True):
+        from .inference import engine
+
+        # loaded (possibly in the gunicorn master) and warmed up in this process
+        checks["models"] = engine.ready and engine.warmed_pid == os.getpid()
+
+    return all(checks.values()), checks
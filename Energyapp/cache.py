@@ -0,0 +1,106 @@
+import hashlib
+import logging
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError
+from django.db.models import F
+from django.utils import timezone
+
+from . import metrics
+from .inference import engine
+from .models import DetectionCache
+
+logger = logging.getLogger(__name__)
+
+
+def hash_upload(file_obj):
+    """sha256 of an uploaded file, read chunk by chunk."""
+    digest = hashlib.sha256()
+    for chunk in file_obj.chunks():
+        digest.update(chunk)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
+
+# =====================================================
+# Result cache: repeat uploads skip inference entirely
+# =====================================================
+class ResultCache:
+    """
+    Maps upload hash + detection mode + model version + thresholds + cascade rules to stored
+    detections. Bounded to ENERGY_RESULT_CACHE_MAX_ENTRIES rows, evicting
+    the least recently used; entries of replaced model weights are purged.
+    """
+
+    def __init__(self):
+        self._purged_version = None
+
+    @property
+    def enabled(self):
+        return getattr(settings, "ENERGY_RESULT_CACHE_MAX_ENTRIES", 0) > 0
+
+    def make_key(self, content_hash, mode="full"):
+        from .cascade import CascadeRules
+        from .pipeline import BEST_CONF, SNOW_CONF, PANEL_CONF
+
+        raw = (
+            f"{content_hash}|{mode}|{engine.model_version}|{BEST_CONF}|{SNOW_CONF}|{PANEL_CONF}"
+            f"|{CascadeRules.from_settings().signature}"
+        )
+        return hashlib.sha256(raw.encode()).hexdigest()
+
+    def get(self, content_hash, mode="full"):
+        if not content_hash or not self.enabled:
+            return None
+
+        entry = DetectionCache.objects.filter(key=self.make_key(content_hash, mode)).first()
+        if entry is None:
+            metrics.result_cache.inc(result="miss")
+            return None
+
+        # the upload may have been cleaned up since the entry was written
+        if not default_storage.exists(entry.image):
+            entry.delete()
+            metrics.result_cache.inc(result="miss")
+            return None
+
+        metrics.result_cache.inc(result="hit")
+        DetectionCache.objects.filter(pk=entry.pk).update(hits=F("hits") + 1, last_used_at=timezone.now())
+        return entry
+
+    def put(self, content_hash, img_obj, width, height, detections, panels, mode="full"):
+        if not content_hash or not self.enabled:
+            return
+
+        version = engine.model_version
+        if self._purged_version != version:
+            DetectionCache.objects.exclude(model_version=version).delete()
+            self._purged_version = version
+
+        try:
+            DetectionCache.objects.create(
+                key=self.make_key(content_hash, mode),
+                content_hash=content_hash,
+                model_version=version,
+                width=width,
+                height=height,
+                detections=[list(d) for d in detections],
+                panels=panels,
+                image=img_obj.image.name,
+            )
+        except IntegrityError:
+            return  # a concurrent request cached the same upload
+        self.evict()
+
+    def evict(self):
+        limit = settings.ENERGY_RESULT_CACHE_MAX_ENTRIES
+        stale = list(
+            DetectionCache.objects.order_by("-last_used_at", "-pk").values_list("pk", flat=True)[limit:]
+        )
+        if stale:
+            DetectionCache.objects.filter(pk__in=stale).delete()
+            logger.debug("Evicted %d result cache entries", len(stale))
+
+
+result_cache = ResultCache()
@@ -0,0 +1,64 @@
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+
+# =====================================================
+# Configurable fault-detector cascade
+# =====================================================
+class CascadeRules:
+    """
+    Which fault detectors run, in which order, and when to stop.
+
+    `order` lists detector keys; the next one only runs when the previous
+    found no meaningful fault (any label not in `ignore_labels`). With a gate
+    classifier configured, its top class can pick the detector to start with
+    (`routes`, label -> detector key, or "none" to skip fault detection)
+    when it is at least `gate_min_conf` sure.
+    """
+
+    def __init__(self, order=("best", "snow"), ignore_labels=("Non-Defective",),
+                 gate=False, routes=None, gate_min_conf=0.8):
+        self.order = list(order)
+        self.ignore_labels = frozenset(ignore_labels)
+        self.gate = gate
+        self.routes = dict(routes or {})
+        self.gate_min_conf = gate_min_conf
+
+    @classmethod
+    def from_settings(cls):
+        return cls(
+            order=getattr(settings, "ENERGY_CASCADE_ORDER", ["best", "snow"]),
+            ignore_labels=getattr(settings, "ENERGY_CASCADE_IGNORE_LABELS", ["Non-Defective"]),
+            gate=bool(getattr(settings, "ENERGY_CASCADE_GATE_MODEL", "")),
+            routes=getattr(settings, "ENERGY_CASCADE_GATE_ROUTES", {}),
+            gate_min_conf=getattr(settings, "ENERGY_CASCADE_GATE_MIN_CONF", 0.8),
+        )
+
+    @property
+    def signature(self):
+        """Changes whenever the rules would change a result (part of the result cache key)."""
+        routes = ",".join(f"{k}:{v}" for k, v in sorted(self.routes.items())) if self.gate else ""
+        return f"{'>'.join(self.order)}|{','.join(sorted(self.ignore_labels))}|{routes}|{self.gate_min_conf}"
+
+    def validate(self, detectors):
+        """Raises ImproperlyConfigured for detector keys that are not in `detectors`."""
+        unknown = [key for key in self.order if key not in detectors]
+        if not self.order or unknown:
+            raise ImproperlyConfigured(
+                f"ENERGY_CASCADE_ORDER must list detectors out of {', '.join(detectors)}, got {self.order}"
+            )
+        unknown = [key for key in self.routes.values() if key != "none" and key not in detectors]
+        if unknown:
+            raise ImproperlyConfigured(f"ENERGY_CASCADE_GATE_ROUTES point at unknown detectors: {unknown}")
+
+    def is_meaningful(self, detections):
+        return any(lbl not in self.ignore_labels for lbl, _, _ in detections)
+
+    def plan(self, gate_label=None, gate_conf=0.0):
+        """Detector keys to try for one image, given the gate classifier's verdict."""
+        route = self.routes.get(gate_label) if gate_conf >= self.gate_min_conf else None
+        if route is None:
+            return list(self.order)
+        if route == "none":
+            return []
+        return [route] + [key for key in self.order if key != route]
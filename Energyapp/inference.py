@@ -0,0 +1,324 @@
+import contextvars
+import hashlib
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+from django.conf import settings
+
+from . import metrics
+from .batching import MicroBatcher
+from .stages import stage
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_DIR = os.path.join(BASE_DIR, "models")
+
+# key -> weights file inside MODEL_DIR
+MODEL_FILES = {
+    "best": "best.pt",
+    "snow": "snow.pt",
+    "panel": "panel_detect.pt",
+}
+
+# exported runtimes the engine can load instead of the .pt weights
+# (manage.py export_models writes them next to the originals)
+MODEL_FORMATS = ("pt", "onnx", "openvino")
+
+WARMUP_SIZE = 640
+
+# the fault cascade and the panel detector run side by side
+PARALLEL_BRANCHES = 2
+
+
+def weights_name(file_name, model_format="pt", int8=False):
+    """Name of the weights file (or OpenVINO directory) for a model in the given format."""
+    if model_format == "pt":
+        return file_name
+    stem = os.path.splitext(file_name)[0] + ("_int8" if int8 else "")
+    if model_format == "onnx":
+        return f"{stem}.onnx"
+    if model_format == "openvino":
+        return f"{stem}_openvino_model"
+    raise ValueError(f"Unknown model format {model_format!r}, expected one of {MODEL_FORMATS}")
+
+
+# =====================================================
+# Shared inference engine (one set of models per process)
+# =====================================================
+class InferenceEngine:
+    """
+    Owns the YOLO models used by the analysis pipeline.
+
+    Models are loaded and fused once. When the app is preloaded by the
+    gunicorn master (see gunicorn.conf.py) the weights are created before
+    the workers fork, so every worker shares them copy-on-write.
+    """
+
+    def __init__(self, model_dir=MODEL_DIR, model_files=None, model_format=None, int8=None):
+        self.model_dir = model_dir
+        if model_files is None:
+            model_files = dict(MODEL_FILES)
+            # optional image-level classifier in front of the fault cascade (see cascade.py)
+            gate = getattr(settings, "ENERGY_CASCADE_GATE_MODEL", "")
+            if gate:
+                model_files["gate"] = gate
+        self.model_files = dict(model_files)
+        # None = ENERGY_MODEL_FORMAT / ENERGY_MODEL_INT8, read when the models load
+        self._model_format = model_format
+        self._int8 = int8
+        self.models = {}
+        self.timings = {}
+        self.loaded_pid = None
+        self.warmed_pid = None
+        self.torch_threads = None
+        self._lock = threading.Lock()
+        # a YOLO predictor is not thread-safe, so each model runs one call at a time
+        self._model_locks = {key: threading.Lock() for key in self.model_files}
+        self._executor = None
+        self._executor_pid = None
+        self._slots = None
+        self._batchers = {}
+        self._model_version = None
+        # images run through each model / analyses finished, for invocations per analysis
+        self.invocations = Counter()
+        self.analyses = 0
+        self._count_lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return len(self.models) == len(self.model_files)
+
+    @property
+    def model_format(self):
+        if self._model_format is None:
+            return getattr(settings, "ENERGY_MODEL_FORMAT", "pt")
+        return self._model_format
+
+    @property
+    def int8(self):
+        if self._int8 is None:
+            return getattr(settings, "ENERGY_MODEL_INT8", False)
+        return self._int8
+
+    def weights_path(self, key):
+        return os.path.join(
+            self.model_dir, weights_name(self.model_files[key], self.model_format, self.int8)
+        )
+
+    def load(self, warmup=True):
+        with self._lock:
+            if not self.ready:
+                # imported here so that merely importing this module stays cheap
+                from ultralytics import YOLO
+
+                started = time.perf_counter()
+                for key in self.model_files:
+                    t0 = time.perf_counter()
+                    with stage("model_load"):
+                        if self.model_format == "pt":
+                            model = YOLO(self.weights_path(key))
+                            model.fuse()
+                        else:
+                            # exported graphs are already fused
+                            model = YOLO(self.weights_path(key), task="detect")
+                    self.models[key] = model
+                    self.timings[f"{key}_load_s"] = time.perf_counter() - t0
+
+                self.timings["load_total_s"] = time.perf_counter() - started
+                self.loaded_pid = os.getpid()
+                logger.info(
+                    "Loaded %d %s models in %.2fs",
+                    len(self.models), self.model_format, self.timings["load_total_s"],
+                )
+
+        if warmup:
+            self.warmup()
+        return self
+
+    def warmup(self, size=WARMUP_SIZE):
+        """Runs one dummy inference per model so the first request does not pay for it."""
+        with self._lock:
+            if self.warmed_pid == os.getpid():
+                return
+
+            self.configure_threads()
+
+            dummy = np.zeros((size, size, 3), dtype=np.uint8)
+            started = time.perf_counter()
+            for key, model in self.models.items():
+                t0 = time.perf_counter()
+                with stage("model_warmup"):
+                    model.predict(dummy, verbose=False)
+                self.timings[f"{key}_warmup_s"] = time.perf_counter() - t0
+
+            self.timings["warmup_total_s"] = time.perf_counter() - started
+            self.warmed_pid = os.getpid()
+            logger.info("Warmed up models in %.2fs (pid %d)", self.timings["warmup_total_s"], self.warmed_pid)
+
+    @property
+    def model_version(self):
+        """Short hash of all weight files; changes whenever any model is replaced."""
+        if self._model_version is None:
+            digest = hashlib.sha256()
+            for key in sorted(self.model_files):
+                digest.update(key.encode())
+                path = self.weights_path(key)
+                # OpenVINO exports are directories (.xml graph + .bin weights)
+                files = (
+                    [os.path.join(path, name) for name in sorted(os.listdir(path))]
+                    if os.path.isdir(path) else [path]
+                )
+                for file_path in files:
+                    with open(file_path, "rb") as fh:
+                        for chunk in iter(lambda: fh.read(1 << 20), b""):
+                            digest.update(chunk)
+            self._model_version = digest.hexdigest()[:16]
+        return self._model_version
+
+    # ---------------- CPU BUDGET ----------------
+    @property
+    def max_concurrent_analyses(self):
+        return max(1, int(getattr(settings, "ENERGY_MAX_CONCURRENT_ANALYSES", 1)))
+
+    def configure_threads(self):
+        """
+        Splits the cores between the concurrent branches of every analysis
+        this worker may run at once, so that they do not oversubscribe the CPU.
+        """
+        import torch
+
+        threads = int(getattr(settings, "ENERGY_TORCH_THREADS", 0))
+        if threads <= 0:
+            budget = PARALLEL_BRANCHES * self.max_concurrent_analyses
+            threads = max(1, (os.cpu_count() or 1) // budget)
+
+        torch.set_num_threads(threads)
+        self.torch_threads = threads
+
+    @contextmanager
+    def analysis_slot(self):
+        """Limits how many analyses run inference at the same time in this worker."""
+        with self._lock:
+            if self._slots is None:
+                self._slots = threading.BoundedSemaphore(self.max_concurrent_analyses)
+        with self._slots:
+            yield
+
+    def run_concurrently(self, *calls):
+        """Runs the given callables on the engine's thread pool and returns their results in order."""
+        # threads do not survive a fork, so every worker builds its own pool
+        with self._lock:
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(
+                    max_workers=PARALLEL_BRANCHES * self.max_concurrent_analyses,
+                    thread_name_prefix="inference",
+                )
+                self._executor_pid = os.getpid()
+
+        # each call runs in a copy of the caller's context, so stage timings follow it
+        futures = [self._executor.submit(contextvars.copy_context().run, call) for call in calls]
+        return [f.result() for f in futures]
+
+    def get(self, key):
+        if not self.ready:
+            self.load()
+        elif self.warmed_pid != os.getpid():
+            self.warmup()
+        return self.models[key]
+
+    # ---------------- PREDICTION ----------------
+    @property
+    def batching_enabled(self):
+        return getattr(settings, "ENERGY_MICROBATCH_WINDOW_MS", 0) > 0
+
+    def predict(self, key, prepared, conf):
+        """
+        Runs one model on a PreparedImage. The letterboxed tensor is shared by
+        all models; boxes are mapped back to the original image size.
+
+        With micro-batching enabled the image is queued and may share a
+        forward pass with images from other concurrent requests.
+        """
+        if self.batching_enabled:
+            return self._batcher(key, conf).submit(prepared).result()
+        return self.predict_batch(key, [prepared], conf)[0]
+
+    def predict_batch(self, key, prepared_list, conf):
+        """Runs one model on several PreparedImages in a single forward pass."""
+        import torch
+        from ultralytics.engine.results import Results
+
+        model = self.get(key)
+        batch = torch.cat([p.tensor for p in prepared_list])
+        with self._model_locks[key], stage(f"model:{key}"):
+            results = model.predict(batch, conf=conf, verbose=False)
+
+        self._count(key, len(prepared_list))
+
+        restored = []
+        for prepared, res in zip(prepared_list, results):
+            data = prepared.scale_boxes(res.boxes.data.clone())
+            restored.append(Results(prepared.placeholder, path=res.path, names=res.names, boxes=data))
+        return restored
+
+    def classify(self, key, prepared_list):
+        """Runs an image classification model (the cascade gate) on the letterboxed images."""
+        model = self.get(key)
+        # ultralytics treats numpy input as BGR
+        images = [np.ascontiguousarray(p.boxed[..., ::-1]) for p in prepared_list]
+        with self._model_locks[key], stage(f"model:{key}"):
+            results = model.predict(images, verbose=False)
+        self._count(key, len(prepared_list))
+        return results
+
+    # ---------------- COUNTERS ----------------
+    def _count(self, key, images):
+        with self._count_lock:
+            self.invocations[key] += images
+        metrics.model_images.inc(images, model=key)
+
+    def record_analysis(self):
+        with self._count_lock:
+            self.analyses += 1
+
+    def _batcher(self, key, conf):
+        with self._lock:
+            batcher = self._batchers.get((key, conf))
+            if batcher is None:
+                batcher = MicroBatcher(
+                    f"{key}@{conf}",
+                    lambda items: self.predict_batch(key, items, conf),
+                    window_ms=getattr(settings, "ENERGY_MICROBATCH_WINDOW_MS", 20),
+                    max_batch=getattr(settings, "ENERGY_MICROBATCH_MAX_SIZE", 8),
+                )
+                self._batchers[(key, conf)] = batcher
+        return batcher
+
+    def stats(self):
+        pid = os.getpid()
+        return {
+            "ready": self.ready,
+            "format": self.model_format + ("-int8" if self.int8 and self.model_format != "pt" else ""),
+            "pid": pid,
+            "preloaded": self.loaded_pid is not None and self.loaded_pid != pid,
+            "warmed_up": self.warmed_pid == pid,
+            "torch_threads": self.torch_threads,
+            "max_concurrent_analyses": self.max_concurrent_analyses,
+            "batching": {b.name: b.stats() for b in self._batchers.values()},
+            "invocations": {
+                "analyses": self.analyses,
+                "per_model": dict(self.invocations),
+                "per_analysis": round(sum(self.invocations.values()) / self.analyses, 3) if self.analyses else None,
+            },
+            "timings": {k: round(v, 4) for k, v in self.timings.items()},
+        }
+
+
+engine = InferenceEngine()
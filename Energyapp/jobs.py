@@ -0,0 +1,88 @@
+import logging
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import F
+from django.utils import timezone
+
+from .cache import hash_upload
+from .models import GrayscaleImage
+from .pipeline import analyze_image, mark_failed
+
+logger = logging.getLogger(__name__)
+
+
+# =====================================================
+# DB-backed analysis queue (rows of GrayscaleImage)
+# =====================================================
+def claim_next_job():
+    """
+    Atomically moves the oldest queued job to "running" and returns it.
+    The conditional UPDATE makes this safe with many worker processes.
+    """
+    while True:
+        job = (
+            GrayscaleImage.objects
+            .filter(status=GrayscaleImage.STATUS_QUEUED)
+            .order_by("created_at", "pk")
+            .first()
+        )
+        if job is None:
+            return None
+
+        claimed = GrayscaleImage.objects.filter(
+            pk=job.pk, status=GrayscaleImage.STATUS_QUEUED
+        ).update(
+            status=GrayscaleImage.STATUS_RUNNING,
+            started_at=timezone.now(),
+            attempts=F("attempts") + 1,
+        )
+        if claimed:
+            job.refresh_from_db()
+            return job
+        # another worker got it first, try the next one
+
+
+def run_job(job):
+    try:
+        # rows queued before the hash was stored are hashed again
+        analyze_image(job, content_hash=job.content_hash or hash_upload(job.image), tiled=job.tiled)
+    except Exception:
+        logger.exception("Analysis job %s failed", job.signature)
+        mark_failed(job)
+
+
+def requeue_stale_jobs(older_than_s, max_attempts=None):
+    """
+    Puts jobs back in the queue whose worker died while running them. A job
+    that already had `max_attempts` tries (it keeps killing its worker, e.g.
+    out of memory) is marked failed instead. Returns (requeued, failed).
+    """
+    max_attempts = max_attempts or settings.ENERGY_JOB_MAX_ATTEMPTS
+    stale = GrayscaleImage.objects.filter(
+        status=GrayscaleImage.STATUS_RUNNING,
+        started_at__lt=timezone.now() - timedelta(seconds=older_than_s),
+    )
+    failed = stale.filter(attempts__gte=max_attempts).update(
+        status=GrayscaleImage.STATUS_FAILED,
+        error=f"Worker died while running this job ({max_attempts} attempts)",
+        finished_at=timezone.now(),
+    )
+    requeued = stale.update(status=GrayscaleImage.STATUS_QUEUED)
+    if failed:
+        logger.warning("Gave up on %d job(s) after %d attempts", failed, max_attempts)
+    return requeued, failed
+
+
+def job_payload(job):
+    data = {
+        "job_id": str(job.signature),
+        "status": job.status,
+        "created_at": job.created_at.isoformat(),
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+    if job.status == GrayscaleImage.STATUS_DONE:
+        data["result"] = job.result
+    elif job.status == GrayscaleImage.STATUS_FAILED:
+        data["error"] = "Analysis failed"
+    return data
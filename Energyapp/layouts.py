@@ -0,0 +1,167 @@
+import logging
+
+import numpy as np
+from django.conf import settings
+from django.db.models import F
+from PIL import Image
+
+from . import metrics
+from .models import PanelLayout
+
+logger = logging.getLogger(__name__)
+
+# side of the grayscale thumbnail the frames are registered on
+FINGERPRINT_SIZE = 128
+
+
+# ---------------- FINGERPRINT ----------------
+def fingerprint(prepared):
+    """
+    Zero-mean, unit-variance grayscale thumbnail of the frame, cut from the
+    already letterboxed 640px copy so the full-size image is not touched again.
+    """
+    left, top = prepared.pad
+    new_w = max(1, round(prepared.width * prepared.ratio))
+    new_h = max(1, round(prepared.height * prepared.ratio))
+    content = prepared.boxed[top:top + new_h, left:left + new_w]
+
+    thumb = Image.fromarray(content).convert("L").resize((FINGERPRINT_SIZE, FINGERPRINT_SIZE), Image.BILINEAR)
+    fp = np.asarray(thumb, dtype=np.float32)
+    fp -= fp.mean()
+    fp /= fp.std() + 1e-6
+    return fp
+
+
+def _peak_offset(corr, i, axis):
+    """Sub-pixel position of the correlation peak along one axis (parabola through 3 points)."""
+    n = corr.shape[axis]
+    idx = [i[0], i[1]]
+    samples = []
+    for d in (-1, 0, 1):
+        idx[axis] = (i[axis] + d) % n
+        samples.append(corr[tuple(idx)])
+    left, mid, right = samples
+    denom = left - 2 * mid + right
+    return 0.0 if denom == 0 else 0.5 * (left - right) / denom
+
+
+# ---------------- REGISTRATION ----------------
+def register(reference, frame):
+    """
+    Phase correlation between two fingerprints. Returns (dx, dy, score):
+    the shift of `frame` relative to `reference` in fingerprint pixels and the
+    normalised cross-correlation of the overlapping part after that shift.
+    """
+    window = np.outer(np.hanning(FINGERPRINT_SIZE), np.hanning(FINGERPRINT_SIZE))
+    cross = np.fft.fft2(frame * window) * np.conj(np.fft.fft2(reference * window))
+    cross /= np.abs(cross) + 1e-9
+    corr = np.fft.ifft2(cross).real
+
+    peak = np.unravel_index(np.argmax(corr), corr.shape)
+    dy = peak[0] + _peak_offset(corr, peak, 0)
+    dx = peak[1] + _peak_offset(corr, peak, 1)
+    half = FINGERPRINT_SIZE / 2
+    dy = dy - FINGERPRINT_SIZE if dy > half else dy
+    dx = dx - FINGERPRINT_SIZE if dx > half else dx
+
+    # how well the frames agree once aligned (integer shift is enough here)
+    sx, sy = int(round(dx)), int(round(dy))
+    ref = reference[max(0, -sy):FINGERPRINT_SIZE - max(0, sy), max(0, -sx):FINGERPRINT_SIZE - max(0, sx)]
+    cur = frame[max(0, sy):FINGERPRINT_SIZE - max(0, -sy), max(0, sx):FINGERPRINT_SIZE - max(0, -sx)]
+    if ref.size == 0:
+        return dx, dy, 0.0
+    ref, cur = ref - ref.mean(), cur - cur.mean()
+    score = float((ref * cur).sum() / (np.sqrt((ref ** 2).sum() * (cur ** 2).sum()) + 1e-9))
+    return dx, dy, score
+
+
+def shift_boxes(panels, dx, dy, width, height):
+    """Moves boxes by (dx, dy) image pixels, clipped to the frame; boxes pushed out entirely are dropped."""
+    moved = []
+    for x1, y1, x2, y2 in panels:
+        box = [
+            int(min(max(x1 + dx, 0), width)),
+            int(min(max(y1 + dy, 0), height)),
+            int(min(max(x2 + dx, 0), width)),
+            int(min(max(y2 + dy, 0), height)),
+        ]
+        if box[2] > box[0] and box[3] > box[1]:
+            moved.append(box)
+    return moved
+
+
+# =====================================================
+# Per-site layout store
+# =====================================================
+class PanelLayouts:
+    """
+    Panel boxes per location. A new frame of a known site is registered
+    against the stored fingerprint; if it lines up (same frame size, small
+    shift, high correlation) the stored boxes are shifted onto it and the
+    panel model is skipped. Otherwise the caller runs full detection.
+    """
+
+    @property
+    def enabled(self):
+        return getattr(settings, "ENERGY_PANEL_LAYOUTS", False)
+
+    def match(self, location, prepared):
+        """Panel boxes aligned to `prepared`, or None when panel detection has to run."""
+        if not location or not self.enabled:
+            return None
+
+        layout = PanelLayout.objects.filter(location=location).first()
+        if layout is None:
+            metrics.panel_layouts.inc(result="absent")
+            return None
+
+        if (layout.width, layout.height) != (prepared.width, prepared.height):
+            return self._miss(layout, "frame size changed")
+
+        reference = np.frombuffer(bytes(layout.fingerprint), dtype=np.float16)
+        reference = reference.astype(np.float32).reshape(FINGERPRINT_SIZE, FINGERPRINT_SIZE)
+        dx, dy, score = register(reference, fingerprint(prepared))
+
+        max_shift = settings.ENERGY_LAYOUT_MAX_SHIFT * FINGERPRINT_SIZE
+        if abs(dx) > max_shift or abs(dy) > max_shift:
+            return self._miss(layout, f"camera moved ({dx:.1f}, {dy:.1f} px)")
+        if score < settings.ENERGY_LAYOUT_MIN_CORRELATION:
+            return self._miss(layout, f"low correlation {score:.2f}")
+
+        PanelLayout.objects.filter(pk=layout.pk).update(hits=F("hits") + 1)
+        metrics.panel_layouts.inc(result="hit")
+        scale_x = prepared.width / FINGERPRINT_SIZE
+        scale_y = prepared.height / FINGERPRINT_SIZE
+        return shift_boxes(layout.panels, dx * scale_x, dy * scale_y, prepared.width, prepared.height)
+
+    def store(self, location, prepared, panels, replace=False):
+        """
+        Saves the layout of a site from a full panel detection: the first
+        inspection of a location, or any calibration upload (`replace`).
+        """
+        if not location or not self.enabled or not panels:
+            return
+        values = {
+            "width": prepared.width,
+            "height": prepared.height,
+            "panels": panels,
+            "fingerprint": fingerprint(prepared).astype(np.float16).tobytes(),
+            "hits": 0,
+            "misses": 0,
+        }
+        if replace:
+            PanelLayout.objects.update_or_create(location=location, defaults=values)
+        else:
+            _, created = PanelLayout.objects.get_or_create(location=location, defaults=values)
+            if not created:
+                return
+        logger.info("Stored panel layout for %s (%d panels)", location, len(panels))
+
+    def _miss(self, layout, reason):
+        PanelLayout.objects.filter(pk=layout.pk).update(misses=F("misses") + 1)
+        metrics.panel_layouts.inc(result="miss")
+        logger.info("Panel layout of %s not reused: %s", layout.location, reason)
+        return None
+
+
+panel_layouts = PanelLayouts()
@@ -0,0 +1,251 @@
+import numpy as np
+
+# ---------------- ENERGY LOSS CONSTANTS ----------------
+FAULT_LOSS = {
+    "Non-Defective": 0.00,
+    "Dusty": 0.12,
+    "Bird-drop": 0.18,
+    "Snow-Covered": 0.28,
+    "Physical Damage": 0.40,
+    "Electrical-Damage": 0.55,
+}
+
+
+# panel x fault cells intersected in one NumPy block
+DENSE_MAX_CELLS = 1_000_000
+
+
+# =====================================================
+# Energy loss from panel boxes and fault detections
+# =====================================================
+def compute_energy_loss(w, h, detections, panels, capacity, sun_hours, loss_table=None):
+    """
+    Overlaps every fault box with every panel box and turns the covered
+    fraction of each panel into kWh lost per day.
+
+    detections: [(label, confidence, [x1, y1, x2, y2]), ...]
+    panels:     [[x1, y1, x2, y2], ...] (whole image when empty)
+
+    The panel x fault intersection matrix is computed with NumPy. Sums are
+    accumulated in the same order as compute_energy_loss_loop, so the
+    numbers are identical to it.
+    """
+    if loss_table is None:
+        loss_table = FAULT_LOSS
+
+    max_energy = capacity * sun_hours
+
+    if not panels:
+        panels = [(0, 0, w, h)]
+
+    pan = np.asarray(panels, dtype=np.float64).reshape(-1, 4)
+    det = np.asarray([box for _, _, box in detections], dtype=np.float64).reshape(-1, 4)
+    rates = np.asarray([loss_table.get(lbl, 0) for lbl, _, _ in detections], dtype=np.float64)
+
+    area = np.maximum(1, (pan[:, 2] - pan[:, 0]) * (pan[:, 3] - pan[:, 1]))
+    panel_losses = np.zeros(len(pan))
+    hits_per_panel = [[] for _ in range(len(pan))]
+
+    for rows, cols in _candidate_blocks(pan, det):
+        if not len(cols):
+            continue
+        p, d = pan[rows], det[cols]
+
+        iw = np.minimum(p[:, None, 2], d[None, :, 2]) - np.maximum(p[:, None, 0], d[None, :, 0])
+        ih = np.minimum(p[:, None, 3], d[None, :, 3]) - np.maximum(p[:, None, 1], d[None, :, 1])
+        hit = (iw > 0) & (ih > 0)
+
+        fraction = (iw * ih) / area[rows, None]
+        loss_fraction = rates[None, cols] * fraction
+        daily_loss = np.where(hit, loss_fraction * capacity * sun_hours, 0.0)
+
+        # cumsum adds left to right like the loop does (np.sum would pair up terms)
+        panel_losses[rows] = np.cumsum(daily_loss, axis=1)[:, -1]
+
+        pi, di = np.nonzero(hit)
+        for r, c, frac, lf, dl in zip(
+            rows[pi].tolist(), cols[di].tolist(),
+            fraction[pi, di].tolist(), loss_fraction[pi, di].tolist(), daily_loss[pi, di].tolist(),
+        ):
+            hits_per_panel[r].append((c, frac, lf, dl))
+
+    total_daily_loss = float(np.cumsum(panel_losses)[-1])
+    panel_data = []
+
+    for idx, (panel_loss, hits) in enumerate(zip(panel_losses.tolist(), hits_per_panel), start=1):
+        fault_records = []
+        for c, fraction, loss_fraction, daily_loss in hits:
+            lbl, conf, _ = detections[c]
+            fault_records.append({
+                "fault": lbl,
+                "confidence": conf,
+                "affected_area": round(fraction * 100, 2),
+                "loss_percentage": round(loss_fraction * 100, 2),
+                "daily_loss": round(daily_loss, 3),
+            })
+
+        half = len(fault_records) // 2
+
+        panel_data.append({
+            "panel_number": idx,
+            "panel_loss": round(panel_loss, 3),
+            "left": fault_records[:half],
+            "right": fault_records[half:]
+        })
+
+    return {
+        "panels": panels,
+        "panel_data": panel_data,
+        "max_energy": max_energy,
+        "total_daily_loss": total_daily_loss,
+        "final_energy": max(max_energy - total_daily_loss, 0),
+    }
+
+
+def _candidate_blocks(pan, det, max_cells=None):
+    """
+    Yields (panel indices, fault indices) blocks to intersect densely.
+
+    Small inputs are one block. For large ones the panels are swept left to
+    right in x-sorted blocks and each block only gets the faults whose x
+    range reaches it, which keeps every block's matrix under max_cells.
+    Fault indices stay in ascending order so sums keep the loop's order.
+    """
+    if max_cells is None:
+        max_cells = DENSE_MAX_CELLS
+
+    n_pan, n_det = len(pan), len(det)
+    if n_pan * n_det <= max_cells:
+        yield np.arange(n_pan), np.arange(n_det)
+        return
+
+    order = np.argsort(pan[:, 0], kind="stable")
+    by_x1 = np.argsort(det[:, 0], kind="stable")
+    sorted_x1 = det[by_x1, 0]
+    block = max(1, max_cells // max(1, n_det))
+
+    for start in range(0, n_pan, block):
+        rows = order[start:start + block]
+        x_min, x_max = pan[rows, 0].min(), pan[rows, 2].max()
+
+        # faults starting before the block ends and ending after it starts
+        reach = by_x1[:np.searchsorted(sorted_x1, x_max, side="left")]
+        cols = np.sort(reach[det[reach, 2] > x_min])
+        yield rows, cols
+
+
+def summarize(location, capacity, sun_hours, loss):
+    """The "summary" and "panel_analysis" parts of the API response."""
+    max_energy = loss["max_energy"]
+    total_daily_loss = loss["total_daily_loss"]
+
+    summary = {
+        "location": location,
+        "total_panels": len(loss["panels"]),
+        "system_capacity_kw": capacity,
+        "sunlight_hours": sun_hours,
+        "max_possible_energy": round(max_energy, 3),
+        "final_energy": round(loss["final_energy"], 3),
+        "total_daily_loss_kwh": round(total_daily_loss, 3),
+        "overall_loss_percentage":
+            round((total_daily_loss / max_energy) * 100, 2),
+    }
+
+    response_panels = []
+    for p in loss["panel_data"]:
+        response_panels.append({
+            "panel_number": p["panel_number"],
+            "panel_loss_kwh": p["panel_loss"],
+            "faults_left": p["left"],
+            "faults_right": p["right"],
+        })
+    return summary, response_panels
+
+
+def parse_loss_table(raw):
+    """
+    Validates a user supplied loss table ({fault name: fraction 0..1}).
+    Faults it does not mention keep their default multiplier.
+    """
+    if not isinstance(raw, dict):
+        raise ValueError("loss_table must be an object of fault name -> fraction")
+
+    table = dict(FAULT_LOSS)
+    for name, value in raw.items():
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            raise ValueError(f"Loss for {name!r} is not a number")
+        if not 0 <= value <= 1:
+            raise ValueError(f"Loss for {name!r} must be between 0 and 1")
+        table[str(name)] = value
+    return table
+
+
+# ---------------- REFERENCE IMPLEMENTATION ----------------
+def compute_energy_loss_loop(w, h, detections, panels, capacity, sun_hours, loss_table=None):
+    """
+    Reference pure-Python version of compute_energy_loss (one panel x fault
+    pair at a time). Kept for the benchmark and to check the vectorized
+    version against.
+    """
+    if loss_table is None:
+        loss_table = FAULT_LOSS
+
+    max_energy = capacity * sun_hours
+
+    if not panels:
+        panels = [(0, 0, w, h)]
+
+    total_daily_loss = 0
+    panel_data = []
+
+    # ---------- PANEL LOOP ----------
+    for idx, (px1, py1, px2, py2) in enumerate(panels, start=1):
+        pw, ph = px2 - px1, py2 - py1
+        area = max(1, pw * ph)
+
+        panel_loss = 0
+        fault_records = []
+
+        for lbl, conf, (fx1, fy1, fx2, fy2) in detections:
+
+            ix1 = max(px1, fx1)
+            iy1 = max(py1, fy1)
+            ix2 = min(px2, fx2)
+            iy2 = min(py2, fy2)
+
+            if ix2 > ix1 and iy2 > iy1:
+                fault_area = (ix2 - ix1) * (iy2 - iy1)
+                fraction = fault_area / area
+                loss_fraction = loss_table.get(lbl, 0) * fraction
+                daily_loss = loss_fraction * capacity * sun_hours
+
+                fault_records.append({
+                    "fault": lbl,
+                    "confidence": conf,
+                    "affected_area": round(fraction * 100, 2),
+                    "loss_percentage": round(loss_fraction * 100, 2),
+                    "daily_loss": round(daily_loss, 3),
+                })
+
+                panel_loss += daily_loss
+
+        total_daily_loss += panel_loss
+
+        half = len(fault_records) // 2
+
+        panel_data.append({
+            "panel_number": idx,
+            "panel_loss": round(panel_loss, 3),
+            "left": fault_records[:half],
+            "right": fault_records[half:]
+        })
+
+    return {
+        "panels": panels,
+        "panel_data": panel_data,
+        "max_energy": max_energy,
+        "total_daily_loss": total_daily_loss,
+        "final_energy": max(max_energy - total_daily_loss, 0),
+    }
@@ -0,0 +1,58 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from Energyapp.loss import FAULT_LOSS, compute_energy_loss, compute_energy_loss_loop
+
+
+def random_boxes(n, width, height, rng):
+    labels = list(FAULT_LOSS)
+    boxes = []
+    for _ in range(n):
+        x, y = rng.randint(0, width - 10), rng.randint(0, height - 10)
+        boxes.append([x, y, min(width, x + rng.randint(20, 600)), min(height, y + rng.randint(20, 400))])
+    detections = [(rng.choice(labels), round(rng.random(), 3), box) for box in boxes]
+    panels = [list(box) for box in boxes]
+    rng.shuffle(panels)
+    return detections, panels
+
+
+def best_of(fn, repeat):
+    timings = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - t0)
+    return min(timings), result
+
+
+class Command(BaseCommand):
+    help = "Micro-benchmark: vectorized panel/fault loss math vs. the original Python loop."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000],
+                            help="Number of panels (and of faults) per run")
+        parser.add_argument("--repeat", type=int, default=5)
+        parser.add_argument("--width", type=int, default=8000)
+        parser.add_argument("--height", type=int, default=6000)
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        rng = random.Random(opts["seed"])
+        w, h = opts["width"], opts["height"]
+
+        self.stdout.write(f"{'boxes':>7} {'loop ms':>10} {'numpy ms':>10} {'speedup':>8}")
+        for n in opts["sizes"]:
+            detections, panels = random_boxes(n, w, h, rng)
+            args = (w, h, detections, panels, 5.0, 5.0)
+
+            loop_s, expected = best_of(lambda: compute_energy_loss_loop(*args), opts["repeat"])
+            vec_s, actual = best_of(lambda: compute_energy_loss(*args), opts["repeat"])
+
+            if actual != expected:
+                raise CommandError(f"Vectorized result differs from the loop at {n} boxes")
+
+            self.stdout.write(
+                f"{n:>7} {loop_s * 1000:>10.2f} {vec_s * 1000:>10.2f} {loop_s / vec_s:>7.1f}x"
+            )
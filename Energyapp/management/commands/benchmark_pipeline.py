@@ -0,0 +1,381 @@
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, contextmanager
+from datetime import datetime, timezone
+from unittest import mock
+
+import numpy as np
+from django.conf import settings
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connection
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from Energyapp.inference import engine
+from Energyapp.models import GrayscaleImage, YOLOOutput
+from Energyapp.pipeline import analyze_image
+from Energyapp.preprocess import PreparedImage
+from Energyapp.render import get_annotated
+from Energyapp.stages import recording, stage
+
+DEFAULT_IMAGES = [
+    os.path.join(settings.MEDIA_ROOT, "uploaded_images"),
+    os.path.join(settings.MEDIA_ROOT, "grayscale_images"),
+]
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp")
+
+BACKENDS = ("stub", "real")
+MODES = ("client", "inprocess")
+
+
+# =====================================================
+# Deterministic stand-in for the YOLO models
+# =====================================================
+class StubBox:
+    def __init__(self, cls, conf, xyxy):
+        self.cls = np.array([cls])
+        self.conf = np.array([conf])
+        self.xyxy = np.array([xyxy], dtype=float)
+
+
+class StubResult:
+    def __init__(self, names, boxes=(), probs=None):
+        self.names = names
+        self.boxes = list(boxes)
+        self.probs = probs
+
+
+class StubProbs:
+    def __init__(self, top1, top1conf):
+        self.top1 = top1
+        self.top1conf = top1conf
+
+
+class StubDetector:
+    """
+    Replaces engine.predict_batch / engine.classify with fake models whose
+    boxes depend only on the image content and the model, so every run sees
+    the same detections. `cost_ms` sleeps per image and model to stand in
+    for a forward pass; 0 measures the pipeline around the models only.
+    """
+
+    NAMES = {
+        "best": {0: "clean", 1: "dusty", 2: "bird-drop", 3: "physical-damage"},
+        "snow": {0: "snow"},
+        "panel": {0: "panel"},
+    }
+    PANEL_GRID = (2, 4)  # rows x columns
+
+    def __init__(self, cost_ms=0.0):
+        self.cost_ms = cost_ms
+
+    def patches(self):
+        return [
+            mock.patch.object(engine, "predict_batch", self.predict_batch),
+            mock.patch.object(engine, "classify", self.classify),
+            mock.patch.object(engine, "_model_version", "stub"),
+        ]
+
+    def _rng(self, key, prepared):
+        seed = zlib.crc32(prepared.boxed[::16, ::16].tobytes(), zlib.crc32(key.encode()))
+        return np.random.default_rng(seed)
+
+    def _boxes(self, key, prepared):
+        w, h = prepared.width, prepared.height
+        if key == "panel":
+            rows, cols = self.PANEL_GRID
+            return [
+                StubBox(0, 0.9, [c * w / cols, r * h / rows, (c + 1) * w / cols, (r + 1) * h / rows])
+                for r in range(rows) for c in range(cols)
+            ]
+
+        rng = self._rng(key, prepared)
+        boxes = []
+        for _ in range(rng.integers(0, 4)):
+            x, y = rng.uniform(0, 0.8) * w, rng.uniform(0, 0.8) * h
+            bw, bh = rng.uniform(0.05, 0.2) * w, rng.uniform(0.05, 0.2) * h
+            cls = int(rng.integers(0, len(self.NAMES[key])))
+            boxes.append(StubBox(cls, round(float(rng.uniform(0.3, 0.95)), 3), [x, y, x + bw, y + bh]))
+        return boxes
+
+    def predict_batch(self, key, prepared_list, conf):
+        with stage(f"model:{key}"):
+            if self.cost_ms:
+                time.sleep(self.cost_ms * len(prepared_list) / 1000)
+            results = [StubResult(self.NAMES.get(key, {0: key}), self._boxes(key, p)) for p in prepared_list]
+        engine._count(key, len(prepared_list))
+        return results
+
+    def classify(self, key, prepared_list):
+        # never confident enough to route: every image takes the default cascade
+        engine._count(key, len(prepared_list))
+        return [StubResult({0: "unknown"}, probs=StubProbs(0, 0.0)) for _ in prepared_list]
+
+
+# =====================================================
+# One request, driven either way
+# =====================================================
+FORM = {"location": "benchmark", "capacity": "5", "sunHours": "5"}
+
+# turned away by admission control: counted apart from failures
+SHED = "shed"
+SHED_STATUSES = (429, 503)
+
+
+def request_via_client(path):
+    """POST to the analysis endpoint, then download the preview (renders the annotation)."""
+    client = Client()
+    with open(path, "rb") as fh:
+        response = client.post("/", dict(FORM, greyImage=fh))
+    if response.status_code in SHED_STATUSES:
+        return SHED
+    if response.status_code != 200:
+        raise RuntimeError(f"{response.status_code}: {response.content[:200]!r}")
+    preview = client.get(response.json()["preview_url"])
+    if preview.status_code != 200:
+        raise RuntimeError(f"preview {preview.status_code}")
+
+
+def request_in_process(path):
+    """Same work as the endpoint, calling the pipeline directly (no HTTP / upload handling)."""
+    with open(path, "rb") as fh:
+        prepared = PreparedImage.from_upload(fh)
+        img_obj = GrayscaleImage.objects.create(
+            image=File(fh, name=os.path.basename(path)),
+            location=FORM["location"],
+            capacity=float(FORM["capacity"]),
+            sunlight_hours=float(FORM["sunHours"]),
+        )
+    payload = analyze_image(img_obj, prepared)
+    get_annotated(YOLOOutput.objects.get(download_token=payload["download_token"]), "preview")
+
+
+def timed_request(run, path):
+    """(latency in s, {stage: ms}, error or None)"""
+    started = time.perf_counter()
+    error = None
+    with recording() as timer:
+        try:
+            if run(path) == SHED:
+                error = SHED
+        except Exception as exc:
+            error = f"{type(exc).__name__}: {exc}"
+        finally:
+            close_old_connections()
+    return time.perf_counter() - started, timer.as_ms(), error
+
+
+# ---------------- STATISTICS ----------------
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else 0.0
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux, in bytes on macOS; it never goes down
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def summarize_run(latencies, stage_samples, errors, wall):
+    stage_names = sorted({name for sample in stage_samples for name in sample})
+    return {
+        # successful requests only, so throughput is goodput under overload
+        "requests": len(latencies),
+        "errors": sum(1 for error in errors if error != SHED),
+        "shed": sum(1 for error in errors if error == SHED),
+        "throughput_rps": round(len(latencies) / wall, 3) if wall else 0.0,
+        "latency_ms": {
+            "mean": round(float(np.mean(latencies)) * 1000, 3) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "max": round(max(latencies, default=0) * 1000, 3),
+        },
+        # every request contributes, a stage it did not reach counts as 0 ms
+        "stages_ms": {
+            name: {
+                "mean": round(float(np.mean([s.get(name, 0.0) for s in stage_samples])), 3),
+                "p95": round(percentile([s.get(name, 0.0) for s in stage_samples], 95), 3),
+            }
+            for name in stage_names
+        },
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def run_key(run):
+    return run["backend"], run["mode"], run["concurrency"]
+
+
+class Command(BaseCommand):
+    help = (
+        "End-to-end benchmark of the analysis pipeline: through the test client and in-process, "
+        "with the real models and/or a deterministic stub. Reports per-stage latency, throughput "
+        "per number of concurrent clients and peak RSS; writes JSON and compares against a baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--backend", nargs="+", choices=BACKENDS, default=["stub"])
+        parser.add_argument("--mode", nargs="+", choices=MODES, default=list(MODES))
+        parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16],
+                            help="Concurrent clients (threads)")
+        parser.add_argument("--requests", type=int, default=32, help="Requests per concurrency level")
+        parser.add_argument("--warmup", type=int, default=2, help="Untimed requests before each backend/mode")
+        parser.add_argument("--images", nargs="+", default=DEFAULT_IMAGES,
+                            help="Image files or directories (default: the samples in media/)")
+        parser.add_argument("--stub-ms", type=float, default=0.0,
+                            help="Simulated forward pass per image and stub model")
+        parser.add_argument("--with-caches", action="store_true",
+                            help="Keep the result cache and panel layouts on (repeat uploads then skip the models)")
+        parser.add_argument("--output", help="Write the results to this JSON file")
+        parser.add_argument("--compare", help="Baseline JSON from an earlier --output")
+        parser.add_argument("--tolerance", type=float, default=0.15,
+                            help="Allowed throughput drop / p95 latency rise vs. the baseline (fraction)")
+
+    def handle(self, *args, **opts):
+        images = self.collect_images(opts["images"])
+        if "real" in opts["backend"]:
+            try:
+                engine.load()
+            except ImportError as exc:
+                raise CommandError(f"The real models need {exc.name}; use --backend stub")
+
+        results = {
+            "meta": {
+                "started_at": datetime.now(timezone.utc).isoformat(),
+                "python": platform.python_version(),
+                "platform": platform.platform(),
+                "cpu_count": os.cpu_count(),
+                "images": [os.path.relpath(p, settings.BASE_DIR) for p in images],
+                "requests_per_level": opts["requests"],
+                "stub_ms": opts["stub_ms"],
+                "with_caches": opts["with_caches"],
+                "max_concurrent_analyses": engine.max_concurrent_analyses,
+                "model_format": engine.model_format,
+            },
+            "runs": [],
+        }
+
+        with self.isolated_environment(opts["with_caches"]):
+            for backend in opts["backend"]:
+                with ExitStack() as stack:
+                    if backend == "stub":
+                        for patch in StubDetector(opts["stub_ms"]).patches():
+                            stack.enter_context(patch)
+                    results["meta"].setdefault("model_version", {})[backend] = engine.model_version
+
+                    for mode in opts["mode"]:
+                        run = request_via_client if mode == "client" else request_in_process
+                        for i in range(opts["warmup"]):
+                            timed_request(run, images[i % len(images)])
+                        for concurrency in opts["concurrency"]:
+                            summary = self.run_level(run, images, concurrency, opts["requests"])
+                            summary = dict(backend=backend, mode=mode, concurrency=concurrency, **summary)
+                            results["runs"].append(summary)
+                            self.report(summary)
+
+        if opts["output"]:
+            with open(opts["output"], "w") as fh:
+                json.dump(results, fh, indent=2)
+            self.stdout.write(f"Results written to {opts['output']}")
+        if opts["compare"]:
+            self.compare(results, opts["compare"], opts["tolerance"])
+
+    # ---------------- SETUP ----------------
+    def collect_images(self, sources):
+        images = []
+        for source in sources:
+            if os.path.isdir(source):
+                images += sorted(
+                    os.path.join(source, name) for name in os.listdir(source)
+                    if name.lower().endswith(IMAGE_EXTENSIONS)
+                )
+            elif os.path.isfile(source):
+                images.append(source)
+        if not images:
+            raise CommandError("No sample images found; pass --images")
+        return images
+
+    @contextmanager
+    def isolated_environment(self, with_caches):
+        """A throwaway database file and MEDIA_ROOT, so benchmark rows never reach the real ones."""
+        media = tempfile.mkdtemp(prefix="benchmark-media-")
+        db_dir = tempfile.mkdtemp(prefix="benchmark-db-")
+        overrides = dict(
+            MEDIA_ROOT=media,
+            FILE_UPLOAD_TEMP_DIR=os.path.join(media, "tmp"),
+            ENERGY_PRERENDER_VARIANTS=[],
+        )
+        if not with_caches:
+            overrides.update(ENERGY_RESULT_CACHE_MAX_ENTRIES=0, ENERGY_PANEL_LAYOUTS=False)
+        os.makedirs(overrides["FILE_UPLOAD_TEMP_DIR"])
+
+        setup_test_environment()
+        # a file, not SQLite's shared in-memory database: the clients write from several threads
+        connection.settings_dict.setdefault("TEST", {})["NAME"] = os.path.join(db_dir, "benchmark.sqlite3")
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            with override_settings(**overrides):
+                self.stdout.write(f"Benchmark database {connection.settings_dict['NAME']}, media {media}")
+                yield
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+            shutil.rmtree(media, ignore_errors=True)
+            shutil.rmtree(db_dir, ignore_errors=True)
+
+    # ---------------- MEASUREMENT ----------------
+    def run_level(self, run, images, concurrency, n_requests):
+        paths = [images[i % len(images)] for i in range(n_requests)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="client") as pool:
+            samples = list(pool.map(lambda path: timed_request(run, path), paths))
+        wall = time.perf_counter() - started
+
+        errors = [error for _, _, error in samples if error]
+        for error in sorted(set(errors) - {SHED}):
+            self.stderr.write(f"request failed: {error}")
+        ok = [(latency, stages) for latency, stages, error in samples if not error]
+        return summarize_run([latency for latency, _ in ok], [stages for _, stages in ok], errors, wall)
+
+    def report(self, run):
+        latency = run["latency_ms"]
+        self.stdout.write(
+            f"{run['backend']:>5} {run['mode']:>9} x{run['concurrency']:<3} "
+            f"{run['throughput_rps']:>8.2f} req/s  p50 {latency['p50']:>8.1f} ms  p95 {latency['p95']:>8.1f} ms  "
+            f"rss {run['peak_rss_mb']:.0f} MB"
+            + (f"  {run['shed']} shed" if run["shed"] else "")
+            + (f"  {run['errors']} error(s)" if run["errors"] else "")
+        )
+        for name, values in run["stages_ms"].items():
+            self.stdout.write(f"{'':>22}{name:<16} {values['mean']:>8.2f} ms  p95 {values['p95']:>8.2f} ms")
+
+    # ---------------- REGRESSION CHECK ----------------
+    def compare(self, results, baseline_path, tolerance):
+        with open(baseline_path) as fh:
+            baseline = {run_key(run): run for run in json.load(fh)["runs"]}
+
+        regressions = []
+        self.stdout.write(f"\nCompared with {baseline_path}:")
+        for run in results["runs"]:
+            before = baseline.get(run_key(run))
+            if before is None:
+                continue
+            rps_change = run["throughput_rps"] / before["throughput_rps"] - 1 if before["throughput_rps"] else 0.0
+            p95_change = run["latency_ms"]["p95"] / before["latency_ms"]["p95"] - 1 if before["latency_ms"]["p95"] else 0.0
+            label = "{} {} x{}".format(*run_key(run))
+            self.stdout.write(f"  {label:<22} throughput {rps_change:+.1%}  p95 {p95_change:+.1%}")
+            if rps_change < -tolerance or p95_change > tolerance:
+                regressions.append(label)
+
+        if regressions:
+            raise CommandError(f"Regression beyond {tolerance:.0%}: {', '.join(regressions)}")
+        self.stdout.write(self.style.SUCCESS(f"No regression beyond {tolerance:.0%}"))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from Energyapp import rollups
+
+
+class Command(BaseCommand):
+    help = "Compares the daily loss rollup table with a fresh aggregation of the raw analyses."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--tolerance", type=float, default=rollups.TOLERANCE,
+                            help="Relative difference allowed for summed values")
+        parser.add_argument("--show", type=int, default=20, help="Mismatching rows to print")
+
+    def handle(self, *args, **opts):
+        diffs = rollups.differences(opts["tolerance"])
+        if not diffs:
+            self.stdout.write(self.style.SUCCESS("Rollups match the raw analyses"))
+            return
+
+        for (location, day, fault_name), have, want in diffs[:opts["show"]]:
+            self.stdout.write(f"{location or '-'} {day} {fault_name}: stored {have}, expected {want}")
+        raise CommandError(f"{len(diffs)} rollup row(s) differ, run manage.py rebuild_rollups")
@@ -0,0 +1,87 @@
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from Energyapp.boot import HEAVY_MODULES
+
+# run in a fresh interpreter each, so nothing is already imported
+CHECK_PROBE = """
+import json, os, sys
+import django
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "energy.settings")
+django.setup()
+from django.core.management import call_command
+call_command("check", verbosity=0)
+print(json.dumps({"heavy": [m for m in %r if m in sys.modules]}))
+"""
+
+BOOT_PROBE = """
+import json, os, sys
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "energy.settings")
+import energy.wsgi
+from Energyapp import boot
+ready, checks = boot.readiness()
+print(json.dumps({"timings": boot.timings, "ready": ready, "checks": checks}))
+"""
+
+
+def run_probe(code):
+    """(wall seconds including interpreter start, parsed JSON of the last output line)"""
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-c", code], cwd=settings.BASE_DIR, capture_output=True, text=True,
+    )
+    elapsed = time.perf_counter() - started
+    if proc.returncode != 0:
+        raise CommandError(f"Probe failed:\n{proc.stderr.strip()}")
+    return elapsed, json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+class Command(BaseCommand):
+    help = (
+        "Measures `manage.py check` and the boot of a serving process in fresh interpreters, "
+        "and fails when they exceed their targets or the command path imports the inference stack."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--repeat", type=int, default=3, help="Runs per probe (the median is reported)")
+        parser.add_argument("--check-target", type=float, default=2.0, help="Seconds allowed for `check`")
+        parser.add_argument("--boot-target", type=float, default=20.0,
+                            help="Seconds allowed until a serving process is ready")
+        parser.add_argument("--skip-boot", action="store_true",
+                            help="Only probe `check` (no models needed)")
+
+    def handle(self, *args, **opts):
+        failures = []
+
+        runs = [run_probe(CHECK_PROBE % (HEAVY_MODULES,)) for _ in range(opts["repeat"])]
+        check_s = statistics.median(elapsed for elapsed, _ in runs)
+        heavy = sorted({m for _, result in runs for m in result["heavy"]})
+        self.stdout.write(f"manage.py check: {check_s:.2f}s (target {opts['check_target']:.2f}s)")
+        if heavy:
+            failures.append(f"`check` imported {', '.join(heavy)}")
+        if check_s > opts["check_target"]:
+            failures.append(f"`check` took {check_s:.2f}s")
+
+        if not opts["skip_boot"]:
+            runs = [run_probe(BOOT_PROBE) for _ in range(opts["repeat"])]
+            boot_s = statistics.median(elapsed for elapsed, _ in runs)
+            result = runs[-1][1]
+            preload = "models preloaded" if settings.ENERGY_PRELOAD_MODELS else "models load on first request"
+            self.stdout.write(
+                f"serving boot: {boot_s:.2f}s (target {opts['boot_target']:.2f}s, {preload}) "
+                f"{json.dumps(result['timings'])}"
+            )
+            if not result["ready"]:
+                failures.append(f"serving process not ready: {result['checks']}")
+            if boot_s > opts["boot_target"]:
+                failures.append(f"serving boot took {boot_s:.2f}s")
+
+        if failures:
+            raise CommandError("; ".join(failures))
+        self.stdout.write(self.style.SUCCESS("Startup within targets"))
@@ -0,0 +1,262 @@
+import io
+import os
+import re
+import shutil
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from PIL import Image
+
+from Energyapp.batch import chunked
+from Energyapp.models import DetectionCache, GrayscaleImage, ResizedImage, StoredBlob, YOLOOutput
+from Energyapp.render import FORMATS, VARIANTS, variant_name
+from Energyapp.storage import blob_storage, hash_file
+
+# directories under MEDIA_ROOT written by the app (samples and FILE_UPLOAD_TEMP_DIR are never touched)
+MANAGED_DIRS = ("uploaded_images", "yolo_outputs", "resized_images")
+
+BLOB_NAME = re.compile(r"/[0-9a-f]{2}/[0-9a-f]{64}\.\w+$")
+VARIANT_NAME = re.compile(r"yolo_output_([0-9a-f-]{36})_\w+\.(jpg|webp)$")
+
+# an archive must save at least this fraction of the original to replace it
+MIN_SAVING = 0.1
+
+
+# ---------------- REFERENCES ----------------
+def referenced_names():
+    """Every media name a row points at."""
+    names = set(GrayscaleImage.objects.values_list("image", flat=True).iterator())
+    names |= set(YOLOOutput.objects.exclude(image="").values_list("image", flat=True).iterator())
+    names |= set(DetectionCache.objects.values_list("image", flat=True).iterator())
+    names |= set(ResizedImage.objects.values_list("image", flat=True).iterator())
+    return names
+
+
+def reference_counts():
+    """name -> rows of the content-addressed fields that point at it (what StoredBlob.refcount tracks)."""
+    counts = Counter(GrayscaleImage.objects.values_list("image", flat=True).iterator())
+    counts.update(YOLOOutput.objects.exclude(image="").values_list("image", flat=True).iterator())
+    return counts
+
+
+def repoint(old, new):
+    """Moves every reference from `old` to `new`; returns how many content-addressed rows moved."""
+    moved = GrayscaleImage.objects.filter(image=old).update(image=new)
+    moved += YOLOOutput.objects.filter(image=old).update(image=new)
+    DetectionCache.objects.filter(image=old).update(image=new)
+    return moved
+
+
+def has_renders(name):
+    """
+    Whether an annotated image was already drawn from this original. Renders
+    are served with an immutable ETag that does not change with the source, so
+    re-drawing one from a re-encoded original would serve different bytes as
+    the same version.
+    """
+    outputs = YOLOOutput.objects.filter(input_image__image=name).values_list("download_token", "image")
+    for token, image in outputs.iterator():
+        if image or any(default_storage.exists(variant_name(token, v, fmt)) for v in VARIANTS for fmt in FORMATS):
+            return True
+    return False
+
+
+def add_references(name, digest, size, count, **extra):
+    blobs = StoredBlob.objects.filter(name=name)
+    if not blobs.update(refcount=F("refcount") + count, **extra):
+        StoredBlob.objects.create(name=name, sha256=digest, size=size, refcount=count, **extra)
+
+
+def remove_if_unreferenced(name):
+    """After a repoint commits: the old file goes unless an upload referenced it again meanwhile."""
+    if StoredBlob.objects.filter(name=name).exists() or GrayscaleImage.objects.filter(image=name).exists():
+        return
+    remove_file(name)
+
+
+def remove_file(name):
+    try:
+        size = blob_storage.size(name)
+        blob_storage.delete(name)
+        return size
+    except FileNotFoundError:
+        return 0
+
+
+class Command(BaseCommand):
+    help = (
+        "Media retention: moves files stored before content addressing into blobs (merging duplicates), "
+        "re-encodes old originals at a lower JPEG quality and deletes files no row references."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--dedupe", action="store_true",
+                            help="Move pre-content-addressing files into blobs, merging identical ones")
+        parser.add_argument("--archive-older-than", type=int, metavar="DAYS",
+                            help="Re-encode originals last uploaded more than DAYS ago (not yet rendered)")
+        parser.add_argument("--quality", type=int, default=60, help="JPEG quality of archived originals")
+        parser.add_argument("--delete-orphans", action="store_true",
+                            help="Delete files and blobs that no row references")
+        parser.add_argument("--min-age-hours", type=float, default=24,
+                            help="Never delete files younger than this (uploads still in flight)")
+        parser.add_argument("--recount", action="store_true", help="Recompute blob reference counts")
+        parser.add_argument("--dry-run", action="store_true", help="Report, change nothing")
+
+    def handle(self, *args, **opts):
+        if not any((opts["dedupe"], opts["archive_older_than"] is not None, opts["delete_orphans"], opts["recount"])):
+            raise CommandError("Nothing to do: pass --dedupe, --archive-older-than, --delete-orphans or --recount")
+        self.dry_run = opts["dry_run"]
+
+        if opts["dedupe"]:
+            self.dedupe()
+        if opts["archive_older_than"] is not None:
+            self.archive(timezone.now() - timedelta(days=opts["archive_older_than"]), opts["quality"])
+        if opts["delete_orphans"]:
+            self.delete_orphans(opts["min_age_hours"] * 3600)
+        if opts["recount"]:
+            self.recount()
+
+    def report(self, action, files, freed):
+        prefix = "[dry run] " if self.dry_run else ""
+        self.stdout.write(f"{prefix}{action}: {files} file(s), {freed / (1 << 20):.1f} MB freed")
+
+    # ---------------- DEDUPE ----------------
+    def dedupe(self):
+        legacy = {
+            name for name in referenced_names() if name and not BLOB_NAME.search(name)
+        }
+        merged = freed = 0
+        for old in sorted(legacy):
+            if not blob_storage.exists(old):
+                self.stderr.write(f"missing: {old}")
+                continue
+            with blob_storage.open(old, "rb") as fh:
+                digest, size = hash_file(fh), fh.size
+            new = blob_storage.blob_name(old, digest)
+            duplicate = blob_storage.exists(new)
+            merged += 1
+            freed += size if duplicate else 0
+            if self.dry_run:
+                continue
+
+            if not duplicate:
+                # a second name for the same inode until the old one goes
+                os.makedirs(os.path.dirname(blob_storage.path(new)), exist_ok=True)
+                try:
+                    os.link(blob_storage.path(old), blob_storage.path(new))
+                except OSError:
+                    shutil.copy2(blob_storage.path(old), blob_storage.path(new))
+            with transaction.atomic():
+                add_references(new, digest, size, repoint(old, new))
+                transaction.on_commit(lambda name=old: remove_if_unreferenced(name))
+
+        self.report("dedupe", merged, freed)
+
+    # ---------------- ARCHIVE ----------------
+    def archive(self, cutoff, quality):
+        # originals whose every upload is older than the cutoff and not waiting for analysis
+        recent = set(
+            GrayscaleImage.objects.filter(created_at__gte=cutoff).values_list("image", flat=True).iterator()
+        ) | set(
+            GrayscaleImage.objects.exclude(status__in=[GrayscaleImage.STATUS_DONE, GrayscaleImage.STATUS_FAILED])
+            .values_list("image", flat=True).iterator()
+        )
+        blobs = StoredBlob.objects.filter(
+            name__startswith="uploaded_images/", archived_at__isnull=True, created_at__lt=cutoff,
+        ).exclude(name__in=recent)
+
+        archived = freed = rendered = 0
+        for blob in blobs.iterator():
+            if has_renders(blob.name):
+                rendered += 1
+                continue
+            try:
+                data = self.reencode(blob.name, quality)
+            except (OSError, Image.DecompressionBombError) as exc:
+                self.stderr.write(f"cannot re-encode {blob.name}: {exc}")
+                continue
+            if data is None or len(data) > blob.size * (1 - MIN_SAVING):
+                continue
+
+            archived += 1
+            freed += blob.size - len(data)
+            if self.dry_run:
+                continue
+            with transaction.atomic():
+                new = blob_storage.save(f"{os.path.dirname(os.path.dirname(blob.name))}/archive.jpg", ContentFile(data))
+                # save() counted one reference, the moved rows bring the rest
+                StoredBlob.objects.filter(name=new).update(
+                    refcount=F("refcount") - 1 + repoint(blob.name, new), archived_at=timezone.now(),
+                )
+                blob.delete()
+                transaction.on_commit(lambda name=blob.name: remove_if_unreferenced(name))
+
+        self.report(f"archive (JPEG quality {quality})", archived, freed)
+        if rendered:
+            self.stdout.write(f"archive: {rendered} original(s) kept, their annotated images are rendered")
+
+    def reencode(self, name, quality):
+        """The original as a lower-quality JPEG with the same pixel grid (stored boxes stay valid)."""
+        with blob_storage.open(name, "rb") as fh, Image.open(fh) as im:
+            exif = im.info.get("exif")
+            if im.mode not in ("RGB", "L"):
+                im = im.convert("RGB")
+            buffer = io.BytesIO()
+            im.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True,
+                    **({"exif": exif} if exif else {}))
+        return buffer.getvalue()
+
+    # ---------------- ORPHANS ----------------
+    def delete_orphans(self, min_age_s):
+        referenced = referenced_names()
+        tokens = {str(t) for t in YOLOOutput.objects.values_list("download_token", flat=True).iterator()}
+        newest = time.time() - min_age_s
+
+        orphans = []
+        for directory in MANAGED_DIRS:
+            root = blob_storage.path(directory)
+            for dirpath, _, files in os.walk(root):
+                for file_name in files:
+                    path = os.path.join(dirpath, file_name)
+                    name = os.path.relpath(path, blob_storage.location).replace(os.sep, "/")
+                    if name in referenced or os.path.getmtime(path) > newest:
+                        continue
+                    variant = VARIANT_NAME.search(file_name)
+                    if variant and variant.group(1) in tokens:
+                        continue  # rendered variant of a live output
+                    orphans.append(name)
+
+        freed = sum(blob_storage.size(name) for name in orphans)
+        if not self.dry_run:
+            for batch in chunked(orphans, 500):
+                StoredBlob.objects.filter(name__in=batch).delete()
+                for name in batch:
+                    remove_file(name)
+            # unreferenced blobs whose file is already gone
+            gone = [
+                blob.pk for blob in StoredBlob.objects.filter(refcount__lte=0).only("name").iterator()
+                if blob.name not in referenced and not blob_storage.exists(blob.name)
+            ]
+            for batch in chunked(gone, 500):
+                StoredBlob.objects.filter(pk__in=batch).delete()
+
+        self.report("orphans deleted", len(orphans), freed)
+
+    # ---------------- RECOUNT ----------------
+    def recount(self):
+        counts = reference_counts()
+        fixed = 0
+        for blob in StoredBlob.objects.only("name", "refcount").iterator():
+            actual = counts.get(blob.name, 0)
+            if blob.refcount != actual:
+                fixed += 1
+                if not self.dry_run:
+                    StoredBlob.objects.filter(pk=blob.pk).update(refcount=actual)
+        self.stdout.write(f"{'[dry run] ' if self.dry_run else ''}recount: {fixed} blob(s) corrected")
@@ -0,0 +1,263 @@
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+
+import numpy as np
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from Energyapp.batch import IMAGE_EXTENSIONS
+from Energyapp.inference import MODEL_DIR, MODEL_FILES, InferenceEngine, weights_name
+from Energyapp.pipeline import BEST_CONF, PANEL_CONF, SNOW_CONF
+from Energyapp.preprocess import MODEL_INPUT_SIZE, PreparedImage
+
+CONFS = {"best": BEST_CONF, "snow": SNOW_CONF, "panel": PANEL_CONF}
+
+
+def list_images(folder):
+    if not os.path.isdir(folder):
+        return []
+    return sorted(
+        os.path.join(folder, name) for name in os.listdir(folder)
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+    )
+
+
+def load_prepared(path):
+    with open(path, "rb") as fh:
+        return PreparedImage.from_upload(fh)
+
+
+# ---------------- EXPORT ----------------
+def export_onnx(pt_path, int8, calibration):
+    """ONNX graph with a dynamic batch axis; INT8 via ONNX Runtime static quantization."""
+    from ultralytics import YOLO
+
+    fp32_path = YOLO(pt_path).export(format="onnx", imgsz=MODEL_INPUT_SIZE, dynamic=True, simplify=True)
+    if not int8:
+        return fp32_path
+
+    import onnx
+    from onnxruntime.quantization import (
+        CalibrationDataReader, QuantFormat, QuantType, quantize_static,
+    )
+
+    input_name = onnx.load(fp32_path, load_external_data=False).graph.input[0].name
+
+    class LetterboxedImages(CalibrationDataReader):
+        """Feeds the calibration uploads exactly as the engine feeds them at inference time."""
+
+        def __init__(self):
+            self._paths = iter(calibration)
+
+        def get_next(self):
+            path = next(self._paths, None)
+            if path is None:
+                return None
+            boxed = load_prepared(path).boxed
+            chw = boxed.transpose(2, 0, 1)[None].astype(np.float32) / 255.0
+            return {input_name: chw}
+
+    int8_path = os.path.join(os.path.dirname(pt_path), weights_name(os.path.basename(pt_path), "onnx", int8=True))
+    quantize_static(
+        fp32_path, int8_path, LetterboxedImages(),
+        quant_format=QuantFormat.QDQ,
+        activation_type=QuantType.QUInt8,
+        weight_type=QuantType.QInt8,
+        per_channel=True,
+    )
+
+    # ultralytics reads class names, stride and image size from the model metadata
+    source, quantized = onnx.load(fp32_path), onnx.load(int8_path)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(source.metadata_props)
+    onnx.save(quantized, int8_path)
+    return int8_path
+
+
+def export_openvino(pt_path, int8, calibration):
+    """OpenVINO IR; INT8 via NNCF post-training quantization on the calibration uploads."""
+    from ultralytics import YOLO
+
+    model = YOLO(pt_path)
+    if not int8:
+        return model.export(format="openvino", imgsz=MODEL_INPUT_SIZE, dynamic=True)
+
+    # ultralytics takes the calibration set from a dataset YAML
+    workdir = tempfile.mkdtemp(prefix="energy-calib-")
+    try:
+        images = os.path.join(workdir, "images")
+        os.makedirs(images)
+        for i, path in enumerate(calibration):
+            os.symlink(os.path.abspath(path), os.path.join(images, f"{i:05d}{os.path.splitext(path)[1]}"))
+        data = os.path.join(workdir, "calibration.yaml")
+        with open(data, "w") as fh:  # JSON is valid YAML
+            json.dump({"path": workdir, "train": "images", "val": "images", "names": model.names}, fh)
+        return model.export(format="openvino", imgsz=MODEL_INPUT_SIZE, dynamic=True, int8=True, data=data)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+EXPORTERS = {"onnx": export_onnx, "openvino": export_openvino}
+
+
+# ---------------- ACCURACY CHECK ----------------
+def as_boxes(result):
+    data = result.boxes.data.cpu().numpy()
+    return data[:, :4].astype(np.float64), data[:, 5].astype(int)
+
+
+def match_detections(expected, actual, iou_threshold):
+    """
+    Greedy same-class matching, highest IoU first.
+    Returns (matched pairs, sum of their IoUs).
+    """
+    (boxes_e, cls_e), (boxes_a, cls_a) = expected, actual
+    if not len(boxes_e) or not len(boxes_a):
+        return 0, 0.0
+
+    x1 = np.maximum(boxes_e[:, None, 0], boxes_a[None, :, 0])
+    y1 = np.maximum(boxes_e[:, None, 1], boxes_a[None, :, 1])
+    x2 = np.minimum(boxes_e[:, None, 2], boxes_a[None, :, 2])
+    y2 = np.minimum(boxes_e[:, None, 3], boxes_a[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_e = (boxes_e[:, 2] - boxes_e[:, 0]) * (boxes_e[:, 3] - boxes_e[:, 1])
+    area_a = (boxes_a[:, 2] - boxes_a[:, 0]) * (boxes_a[:, 3] - boxes_a[:, 1])
+    iou = inter / np.maximum(area_e[:, None] + area_a[None, :] - inter, 1e-9)
+    iou[cls_e[:, None] != cls_a[None, :]] = 0
+
+    matched, total = 0, 0.0
+    while True:
+        i, j = np.unravel_index(np.argmax(iou), iou.shape)
+        if iou[i, j] < iou_threshold:
+            return matched, total
+        matched, total = matched + 1, total + iou[i, j]
+        iou[i, :] = 0
+        iou[:, j] = 0
+
+
+def timed(engine, key, prepared):
+    t0 = time.perf_counter()
+    result = engine.predict_batch(key, [prepared], CONFS[key])[0]
+    return result, time.perf_counter() - t0
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1000 if values else 0.0
+
+
+class Command(BaseCommand):
+    help = (
+        "Exports best.pt, snow.pt and panel_detect.pt to ONNX Runtime or OpenVINO "
+        "(optionally INT8), then checks detections against the PyTorch models and reports latency. "
+        "Serve the exports with ENERGY_MODEL_FORMAT (and ENERGY_MODEL_INT8=1)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--format", choices=sorted(EXPORTERS), default="onnx")
+        parser.add_argument("--int8", action="store_true", help="Quantize to INT8 using uploaded images for calibration")
+        parser.add_argument("--images", default=os.path.join(settings.MEDIA_ROOT, "uploaded_images"),
+                            help="Folder with calibration / evaluation images")
+        parser.add_argument("--calibration-size", type=int, default=200)
+        parser.add_argument("--eval-size", type=int, default=50)
+        parser.add_argument("--iou", type=float, default=0.5, help="IoU for a detection to count as the same")
+        parser.add_argument("--min-agreement", type=float, default=0.9,
+                            help="Fail when recall or precision vs. PyTorch falls below this")
+        parser.add_argument("--skip-export", action="store_true", help="Only run the check on existing exports")
+        parser.add_argument("--report", help="Also write the report as JSON to this file")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **opts):
+        fmt, int8 = opts["format"], opts["int8"]
+
+        images = list_images(opts["images"])
+        random.Random(opts["seed"]).shuffle(images)
+        calibration = images[:opts["calibration_size"]]
+        # evaluate on images the quantizer has not seen when there are enough of them
+        evaluation = images[opts["calibration_size"]:][:opts["eval_size"]] or images[:opts["eval_size"]]
+
+        if int8 and not calibration:
+            raise CommandError(f"INT8 export needs calibration images, none found in {opts['images']}")
+
+        if not opts["skip_export"]:
+            # includes the cascade gate classifier when one is configured
+            for key, file_name in InferenceEngine(model_format="pt").model_files.items():
+                t0 = time.perf_counter()
+                path = EXPORTERS[fmt](os.path.join(MODEL_DIR, file_name), int8, calibration)
+                self.stdout.write(f"Exported {key}: {path} ({time.perf_counter() - t0:.1f}s)")
+
+        if not evaluation:
+            self.stdout.write(self.style.WARNING(f"No images in {opts['images']}, skipping the accuracy check"))
+            return
+
+        report = self.compare(fmt, int8, evaluation, opts["iou"])
+        if opts["report"]:
+            with open(opts["report"], "w") as fh:
+                json.dump(report, fh, indent=2)
+
+        failed = [
+            key for key, row in report["models"].items()
+            if min(row["recall"], row["precision"]) < opts["min_agreement"]
+        ]
+        if failed:
+            raise CommandError(
+                f"Exported {', '.join(failed)} disagree with PyTorch beyond --min-agreement {opts['min_agreement']}"
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"Set ENERGY_MODEL_FORMAT={fmt}" + (" and ENERGY_MODEL_INT8=1" if int8 else "") + " to serve these models"
+        ))
+
+    def compare(self, fmt, int8, paths, iou_threshold):
+        baseline = InferenceEngine(model_format="pt").load()
+        candidate = InferenceEngine(model_format=fmt, int8=int8).load()
+        label = fmt + (" INT8" if int8 else "")
+
+        self.stdout.write(f"Comparing {label} with PyTorch on {len(paths)} image(s)")
+        self.stdout.write(
+            f"{'model':>6} {'pt boxes':>9} {'new boxes':>10} {'recall':>7} {'precision':>10} {'mean IoU':>9} "
+            f"{'pt p50 ms':>10} {'new p50 ms':>11} {'pt p95 ms':>10} {'new p95 ms':>11} {'speedup':>8}"
+        )
+
+        report = {"format": fmt, "int8": int8, "images": len(paths), "models": {}}
+        for key in MODEL_FILES:
+            n_expected = n_actual = matched = 0
+            iou_sum = 0.0
+            pt_times, new_times = [], []
+
+            for path in paths:
+                prepared = load_prepared(path)
+                expected, pt_s = timed(baseline, key, prepared)
+                actual, new_s = timed(candidate, key, prepared)
+                pt_times.append(pt_s)
+                new_times.append(new_s)
+
+                expected, actual = as_boxes(expected), as_boxes(actual)
+                n_expected += len(expected[0])
+                n_actual += len(actual[0])
+                m, s = match_detections(expected, actual, iou_threshold)
+                matched, iou_sum = matched + m, iou_sum + s
+
+            row = {
+                "baseline_boxes": n_expected,
+                "exported_boxes": n_actual,
+                "recall": matched / n_expected if n_expected else 1.0,
+                "precision": matched / n_actual if n_actual else 1.0,
+                "mean_iou": iou_sum / matched if matched else 0.0,
+                "pt_p50_ms": percentile(pt_times, 50),
+                "exported_p50_ms": percentile(new_times, 50),
+                "pt_p95_ms": percentile(pt_times, 95),
+                "exported_p95_ms": percentile(new_times, 95),
+            }
+            row["speedup"] = statistics.median(pt_times) / max(statistics.median(new_times), 1e-9)
+            report["models"][key] = row
+
+            self.stdout.write(
+                f"{key:>6} {n_expected:>9} {n_actual:>10} {row['recall']:>7.3f} {row['precision']:>10.3f} "
+                f"{row['mean_iou']:>9.3f} {row['pt_p50_ms']:>10.1f} {row['exported_p50_ms']:>11.1f} "
+                f"{row['pt_p95_ms']:>10.1f} {row['exported_p95_ms']:>11.1f} {row['speedup']:>7.2f}x"
+            )
+        return report
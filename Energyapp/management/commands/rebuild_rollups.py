@@ -0,0 +1,14 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from Energyapp import rollups
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the daily loss rollup table from the latest analyses."
+
+    def handle(self, *args, **opts):
+        started = time.perf_counter()
+        rows = rollups.rebuild()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {rows} rollup row(s) in {time.perf_counter() - started:.2f}s"))
@@ -0,0 +1,194 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import close_old_connections, connections
+
+from Energyapp.batch import chunked
+from Energyapp.inference import PARALLEL_BRANCHES, engine
+from Energyapp.models import GrayscaleImage, YOLOOutput
+from Energyapp.pipeline import detection_outputs, finish_analyses, load_prepared, run_detection_batch
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHECKPOINT = os.path.join(settings.BASE_DIR, "reprocess_checkpoint.json")
+
+# per worker process
+_decoder = None
+
+
+# ---------------- WORKER PROCESS ----------------
+def worker_init(torch_threads, prefetch):
+    global _decoder
+
+    # forked children must not reuse the parent's DB connection
+    connections.close_all()
+    settings.ENERGY_TORCH_THREADS = torch_threads
+    engine.warmup()
+    _decoder = ThreadPoolExecutor(max_workers=prefetch, thread_name_prefix="decode")
+
+
+def decode_batch(img_objs):
+    """
+    [(img_obj, PreparedImage or None)]; unreadable uploads come back with None.
+    Uploads of the same bytes share one stored blob and are decoded once.
+    """
+    decoded, by_blob = [], {}
+    for img_obj in img_objs:
+        name = img_obj.image.name
+        if name not in by_blob:
+            try:
+                by_blob[name] = load_prepared(img_obj)
+            except Exception:
+                logger.exception("Cannot decode upload %s", img_obj.pk)
+                by_blob[name] = None
+        decoded.append((img_obj, by_blob[name]))
+    return decoded
+
+
+def reprocess_chunk(pks, batch_size):
+    """
+    Re-analyses one chunk of uploads with the current models. Uploads that
+    already have an output of this model version are skipped, so a chunk
+    may safely run twice. Decoding of the next batch overlaps inference of
+    the current one; duplicate uploads (same blob) are sorted next to each
+    other and run through the models once. Returns (max pk, analysed,
+    skipped, failed pks).
+    """
+    close_old_connections()
+    version = engine.model_version
+    done = set(
+        YOLOOutput.objects.filter(input_image_id__in=pks, model_version=version)
+        .values_list("input_image_id", flat=True)
+    )
+    img_objs = list(GrayscaleImage.objects.filter(pk__in=pks).exclude(pk__in=done).order_by("image", "pk"))
+    batches = list(chunked(img_objs, batch_size))
+
+    analysed, failed = 0, []
+    pending = _decoder.submit(decode_batch, batches[0]) if batches else None
+    for i in range(len(batches)):
+        decoded = pending.result()
+        if i + 1 < len(batches):
+            pending = _decoder.submit(decode_batch, batches[i + 1])
+
+        failed.extend(img_obj.pk for img_obj, prepared in decoded if prepared is None)
+        decoded = [(img_obj, prepared) for img_obj, prepared in decoded if prepared is not None]
+        if not decoded:
+            continue
+
+        try:
+            unique = list({id(prepared): prepared for _, prepared in decoded}.values())
+            results = dict(zip(map(id, unique), run_detection_batch(unique)))
+            finish_analyses([
+                (img_obj, *detection_outputs(prepared, *results[id(prepared)]))
+                for img_obj, prepared in decoded
+            ])
+            analysed += len(decoded)
+        except Exception:
+            logger.exception("Re-analysis of uploads %s failed", [img_obj.pk for img_obj, _ in decoded])
+            failed.extend(img_obj.pk for img_obj, _ in decoded)
+
+    return max(pks), analysed, len(done), failed
+
+
+# ---------------- CHECKPOINT ----------------
+def read_checkpoint(path, version):
+    if not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        state = json.load(fh)
+    return state if state.get("model_version") == version else None
+
+
+def write_checkpoint(path, state):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as fh:
+        json.dump(state, fh, indent=2)
+    os.replace(tmp, path)
+
+
+class Command(BaseCommand):
+    help = (
+        "Re-analyses stored uploads with the current models (after a model upgrade). "
+        "Multi-process, batched, resumable from a checkpoint file."
+    )
+
+    def add_arguments(self, parser):
+        cores = os.cpu_count() or 1
+        parser.add_argument("--processes", type=int, default=max(1, cores // PARALLEL_BRANCHES))
+        parser.add_argument("--batch-size", type=int, default=settings.ENERGY_BATCH_SIZE,
+                            help="Images per forward pass")
+        parser.add_argument("--chunk-size", type=int, default=64, help="Uploads handed to a process at a time")
+        parser.add_argument("--prefetch", type=int, default=2, help="Decoder threads per process")
+        parser.add_argument("--checkpoint", default=DEFAULT_CHECKPOINT)
+        parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint")
+        parser.add_argument("--limit", type=int, default=None, help="Stop after this many uploads")
+
+    def handle(self, *args, **opts):
+        processes = max(1, opts["processes"])
+        # every process runs two branches (fault cascade, panels) side by side
+        torch_threads = max(1, (os.cpu_count() or 1) // (processes * PARALLEL_BRANCHES))
+
+        # load once in the parent so the forked workers share the weights
+        engine.load(warmup=False)
+        version = engine.model_version
+
+        state = None if opts["restart"] else read_checkpoint(opts["checkpoint"], version)
+        if state is None:
+            state = {"model_version": version, "last_pk": 0, "analysed": 0, "skipped": 0, "failed": []}
+        else:
+            self.stdout.write(f"Resuming after upload {state['last_pk']} ({state['analysed']} analysed so far)")
+
+        queryset = GrayscaleImage.objects.filter(
+            pk__gt=state["last_pk"], status=GrayscaleImage.STATUS_DONE
+        ).order_by("pk")
+        pks = list(queryset.values_list("pk", flat=True)[:opts["limit"]])
+        if not pks:
+            self.stdout.write("Nothing to re-analyse")
+            return
+        self.stdout.write(
+            f"Re-analysing {len(pks)} upload(s) with models {version}: "
+            f"{processes} process(es) x {torch_threads * PARALLEL_BRANCHES} thread(s)"
+        )
+
+        connections.close_all()
+        ctx = multiprocessing.get_context("fork")
+        started = time.perf_counter()
+        analysed = 0
+
+        with ctx.Pool(processes, initializer=worker_init, initargs=(torch_threads, opts["prefetch"])) as pool:
+            tasks = [(chunk, opts["batch_size"]) for chunk in chunked(pks, opts["chunk_size"])]
+            try:
+                # imap keeps chunk order, so the checkpoint only ever moves past finished chunks
+                for last_pk, n_done, n_skipped, failed in pool.imap(_run_chunk, tasks):
+                    analysed += n_done
+                    state["last_pk"] = last_pk
+                    state["analysed"] += n_done
+                    state["skipped"] += n_skipped
+                    state["failed"].extend(failed)
+                    write_checkpoint(opts["checkpoint"], state)
+
+                    elapsed = time.perf_counter() - started
+                    self.stdout.write(
+                        f"upload {last_pk}: {state['analysed']} analysed, {state['skipped']} skipped, "
+                        f"{len(state['failed'])} failed, {analysed / elapsed:.2f} images/s"
+                    )
+            except KeyboardInterrupt:
+                pool.terminate()
+                raise CommandError(f"Interrupted, resume with the same command (checkpoint {opts['checkpoint']})")
+
+        elapsed = time.perf_counter() - started
+        self.stdout.write(self.style.SUCCESS(
+            f"Done: {analysed} image(s) in {elapsed:.1f}s, {analysed / elapsed if elapsed else 0:.2f} images/s"
+        ))
+        if state["failed"]:
+            self.stdout.write(self.style.WARNING(f"Failed uploads: {state['failed']}"))
+
+
+def _run_chunk(args):
+    return reprocess_chunk(*args)
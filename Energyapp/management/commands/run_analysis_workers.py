@@ -0,0 +1,89 @@
+import multiprocessing
+import os
+import signal
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections, connections
+
+from Energyapp import metrics
+from Energyapp.inference import engine
+from Energyapp.jobs import claim_next_job, requeue_stale_jobs, run_job
+
+# how often the supervisor looks for jobs whose worker died (seconds)
+REQUEUE_INTERVAL_S = 60
+
+
+def worker_loop(poll_interval, max_jobs):
+    # forked children must not reuse the parent's DB connection
+    connections.close_all()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    engine.warmup()
+
+    done = 0
+    while max_jobs is None or done < max_jobs:
+        close_old_connections()
+        job = claim_next_job()
+        if job is None:
+            time.sleep(poll_interval)
+            continue
+        run_job(job)
+        done += 1
+
+
+class Command(BaseCommand):
+    help = "Runs a local pool of processes that execute queued analysis jobs (POST /jobs/)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--processes", type=int, default=max(1, (os.cpu_count() or 2) // 2))
+        parser.add_argument("--poll-interval", type=float, default=1.0, help="Seconds to sleep when the queue is empty")
+        parser.add_argument("--max-jobs", type=int, default=None, help="Restart a process after this many jobs")
+        parser.add_argument("--stale-after", type=int, default=900, help="Requeue jobs left running this long (seconds)")
+        parser.add_argument("--max-attempts", type=int, default=settings.ENERGY_JOB_MAX_ATTEMPTS,
+                            help="Mark a job failed after its worker died this many times")
+
+    def requeue(self, opts):
+        requeued, failed = requeue_stale_jobs(opts["stale_after"], opts["max_attempts"])
+        if requeued or failed:
+            self.stdout.write(f"Requeued {requeued} stale job(s), {failed} failed after {opts['max_attempts']} attempts")
+
+    def handle(self, *args, **opts):
+        metrics.store.clear()
+        self.requeue(opts)
+
+        # load once in the parent so the forked workers share the weights
+        engine.load(warmup=False)
+        connections.close_all()
+
+        ctx = multiprocessing.get_context("fork")
+        procs = {}
+
+        def spawn():
+            p = ctx.Process(target=worker_loop, args=(opts["poll_interval"], opts["max_jobs"]), daemon=True)
+            p.start()
+            procs[p.pid] = p
+
+        for _ in range(opts["processes"]):
+            spawn()
+        self.stdout.write(f"Started {len(procs)} analysis worker(s)")
+
+        try:
+            next_requeue = time.monotonic() + REQUEUE_INTERVAL_S
+            while True:
+                time.sleep(1)
+                for pid, p in list(procs.items()):
+                    if not p.is_alive():
+                        del procs[pid]
+                        spawn()
+                # a worker killed mid-job (OOM, segfault) leaves its job "running"
+                if time.monotonic() >= next_requeue:
+                    self.requeue(opts)
+                    connections.close_all()  # not inherited by the next fork
+                    next_requeue = time.monotonic() + REQUEUE_INTERVAL_S
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping workers")
+            for p in procs.values():
+                p.terminate()
+            for p in procs.values():
+                p.join()
@@ -0,0 +1,128 @@
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+
+from .render import FORMATS, RENDER_VERSION
+
+RANGE = re.compile(r"^bytes=(\d*)-(\d*)$")
+CHUNK_SIZE = 64 * 1024
+
+
+# =====================================================
+# Annotated image delivery
+# =====================================================
+def negotiate(request):
+    """(format, negotiated from Accept?): ?format= wins, else WebP when the client accepts it."""
+    fmt = request.GET.get("format")
+    if fmt:
+        return fmt, False
+    if getattr(settings, "ENERGY_MEDIA_WEBP", True) and "image/webp" in request.headers.get("Accept", ""):
+        return "webp", True
+    return "jpeg", True
+
+
+def etag(download_token, variant, fmt):
+    """
+    Strong ETag of a render. A download token's boxes never change (rescoring
+    only redoes the loss math), so the token, variant, format and drawing
+    version identify the bytes without reading them.
+    """
+    return f'"{download_token}-{variant}-{fmt}-r{RENDER_VERSION}"'
+
+
+def not_modified(request, tag, vary):
+    """304 for a revalidation with this ETag, answered before any database or file access."""
+    response = get_conditional_response(request, etag=tag)
+    if response is not None:
+        cache_headers(response, tag, vary)
+    return response
+
+
+def cache_headers(response, tag, vary):
+    response["ETag"] = tag
+    response["Cache-Control"] = settings.ENERGY_MEDIA_CACHE_CONTROL
+    if vary:
+        response["Vary"] = "Accept"
+    return response
+
+
+def serve(request, storage, name, fmt, tag, filename, vary=False):
+    """
+    Sends a stored render: handed off to the front-end server (X-Accel-Redirect
+    / X-Sendfile) when ENERGY_MEDIA_ACCEL is set, so the worker only looks up
+    the name; otherwise streamed from here with single-range support.
+    """
+    content_type = FORMATS[fmt][1]
+    disposition = f"inline; filename*=UTF-8''{quote(filename)}"
+    accel = getattr(settings, "ENERGY_MEDIA_ACCEL", "")
+
+    if accel == "nginx":
+        response = HttpResponse(content_type=content_type)
+        response["X-Accel-Redirect"] = quote(settings.ENERGY_MEDIA_ACCEL_PREFIX + name)
+    elif accel == "sendfile":
+        response = HttpResponse(content_type=content_type)
+        response["X-Sendfile"] = storage.path(name)
+    else:
+        response = _file_response(request, storage, name, content_type, tag)
+
+    response["Content-Disposition"] = disposition
+    response["Accept-Ranges"] = "bytes"
+    return cache_headers(response, tag, vary)
+
+
+def _file_response(request, storage, name, content_type, tag):
+    size = storage.size(name)
+    byte_range = _parse_range(request, size, tag)
+
+    if byte_range is None:
+        # whole file: gunicorn sends it with sendfile() through wsgi.file_wrapper
+        return FileResponse(storage.open(name, "rb"), content_type=content_type)
+    if byte_range is False:
+        response = HttpResponse(status=416, content_type=content_type)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    start, end = byte_range
+    fh = storage.open(name, "rb")
+    fh.seek(start)
+    response = StreamingHttpResponse(_read(fh, end - start + 1), status=206, content_type=content_type)
+    response["Content-Length"] = str(end - start + 1)
+    response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return response
+
+
+def _parse_range(request, size, tag):
+    """(start, end) inclusive, None for the whole file, False when unsatisfiable."""
+    header = request.headers.get("Range")
+    if not header or request.method != "GET":
+        return None
+    # If-Range: only honour the range when the client's copy is still this one
+    if_range = request.headers.get("If-Range")
+    if if_range is not None and if_range != tag:
+        return None
+
+    match = RANGE.match(header.strip())
+    if not match or match.groups() == ("", ""):
+        return None  # multiple or malformed ranges: send everything
+    first, last = match.groups()
+    if first:
+        start = int(first)
+        end = min(int(last), size - 1) if last else size - 1
+    else:
+        start, end = max(size - int(last), 0), size - 1  # suffix: the last N bytes
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def _read(fh, remaining):
+    with fh:
+        while remaining > 0:
+            chunk = fh.read(min(CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
@@ -0,0 +1,305 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Prometheus' default buckets, in seconds
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+# =====================================================
+# Minimal in-process metrics (Prometheus text format)
+# =====================================================
+class Metric:
+    kind = None
+
+    def __init__(self, name, help_text, labels=()):
+        self.name = name
+        self.help = help_text
+        self.label_names = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def _labels(self, key, extra=()):
+        pairs = list(zip(self.label_names, key)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines += self._samples()
+        return lines
+
+    def empty(self):
+        """A new metric with the same definition and no samples (what other processes' states merge into)."""
+        clone = object.__new__(type(self))
+        clone.__dict__.update(self.__dict__, _lock=threading.Lock())
+        clone.reset()
+        return clone
+
+    def state(self):
+        """JSON-serialisable samples, written to the multiprocess directory."""
+        with self._lock:
+            return [[list(key), value] for key, value in self._items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+        store.changed()
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    def reset(self):
+        self._values = {}
+
+    def absorb(self, state):
+        for key, value in state:
+            key = tuple(key)
+            self._values[key] = self._values.get(key, 0) + value
+
+    def _items(self):
+        return list(self._values.items())
+
+    def _samples(self):
+        return [f"{self.name}{self._labels(key)} {_number(v)}" for key, v in sorted(self._values.items())]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labels=(), buckets=DURATION_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(buckets)
+        self._series = {}  # labels -> [per-bucket counts (+inf last), sum]
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][index] += 1
+            series[1] += value
+        store.changed()
+
+    def count(self, **labels):
+        series = self._series.get(self._key(labels))
+        return sum(series[0]) if series else 0
+
+    def reset(self):
+        self._series = {}
+
+    def absorb(self, state):
+        for key, (counts, total) in state:
+            series = self._series.setdefault(tuple(key), [[0] * (len(self.buckets) + 1), 0.0])
+            series[0] = [a + b for a, b in zip(series[0], counts)]
+            series[1] += total
+
+    def _items(self):
+        return [(key, [list(counts), total]) for key, (counts, total) in self._series.items()]
+
+    def _samples(self):
+        lines = []
+        for key, (counts, total) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, n in zip(self.buckets + ("+Inf",), counts):
+                cumulative += n
+                le = bound if bound == "+Inf" else _number(bound)
+                lines.append(f"{self.name}_bucket{self._labels(key, [('le', le)])} {cumulative}")
+            lines.append(f"{self.name}_sum{self._labels(key)} {_number(total)}")
+            lines.append(f"{self.name}_count{self._labels(key)} {cumulative}")
+        return lines
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# ---------------- THE METRICS ----------------
+# Kept per process; with ENERGY_METRICS_DIR every process also writes them to a
+# file there and a scrape adds all files up (see MultiprocessStore)
+stage_seconds = Histogram(
+    "energy_stage_duration_seconds", "Time spent per pipeline stage.", labels=("stage",),
+)
+request_seconds = Histogram(
+    "energy_request_duration_seconds", "Request latency per view.", labels=("view", "method", "status"),
+)
+analyses = Counter("energy_analyses_total", "Analyses finished (loss computed and saved).")
+cascade_fallbacks = Counter(
+    "energy_cascade_fallbacks_total",
+    "Images re-run on a later cascade detector because the earlier one found no meaningful fault.",
+    labels=("detector",),
+)
+panels_per_image = Histogram(
+    "energy_panels_per_image", "Panels per analysed image.", buckets=COUNT_BUCKETS,
+)
+faults_per_image = Histogram(
+    "energy_faults_per_image", "Fault detections per analysed image.", buckets=COUNT_BUCKETS,
+)
+faults = Counter("energy_faults_total", "Fault detections by label.", labels=("fault",))
+result_cache = Counter(
+    "energy_result_cache_requests_total", "Result cache lookups.", labels=("result",),
+)
+panel_layouts = Counter(
+    "energy_panel_layout_requests_total", "Stored panel layout lookups.", labels=("result",),
+)
+admission = Counter(
+    "energy_admission_requests_total",
+    "Admission decisions: admitted at once, admitted after queueing, queue_full (429), timeout (503).",
+    labels=("result",),
+)
+admission_wait_seconds = Histogram(
+    "energy_admission_wait_seconds", "Time queued requests waited for an inference slot.",
+)
+model_images = Counter("energy_model_images_total", "Images run through each model.", labels=("model",))
+
+REGISTRY = [
+    stage_seconds, request_seconds, analyses, cascade_fallbacks,
+    panels_per_image, faults_per_image, faults, result_cache, panel_layouts,
+    admission, admission_wait_seconds, model_images,
+]
+
+
+# =====================================================
+# Aggregation across processes (gunicorn and analysis workers)
+# =====================================================
+class MultiprocessStore:
+    """
+    Each process keeps its metrics in memory and, when ENERGY_METRICS_DIR is
+    set, a background thread rewrites `<dir>/<pid>.json` with its cumulative
+    samples at most every FLUSH_INTERVAL_S. A scrape adds up the files of all
+    processes, dead ones included, so counters only go up whichever worker
+    answers. Files of a previous run are removed by clear() at start-up.
+    """
+
+    FLUSH_INTERVAL_S = 1.0
+    # an idle process still checks that its file is there (another service's clear())
+    REWRITE_INTERVAL_S = 30.0
+
+    def __init__(self):
+        self._dirty = threading.Event()
+        self._guard = threading.Lock()
+        self._flusher_pid = None
+
+    @property
+    def directory(self):
+        return getattr(settings, "ENERGY_METRICS_DIR", "")
+
+    def changed(self):
+        if not self.directory:
+            return
+        self._dirty.set()
+        if self._flusher_pid != os.getpid():
+            with self._guard:
+                if self._flusher_pid != os.getpid():
+                    self._flusher_pid = os.getpid()
+                    threading.Thread(target=self._flush_loop, name="metrics-flush", daemon=True).start()
+
+    def _flush_loop(self):
+        while True:
+            self._dirty.wait(self.REWRITE_INTERVAL_S)
+            time.sleep(self.FLUSH_INTERVAL_S)
+            if not self.directory:
+                continue
+            if self._dirty.is_set() or not os.path.exists(self._path()):
+                try:
+                    self.flush()
+                except OSError as exc:
+                    logger.warning("Cannot write metrics to %s: %s", self.directory, exc)
+
+    def _path(self, pid=None):
+        return os.path.join(self.directory, f"{pid or os.getpid()}.json")
+
+    def flush(self):
+        """Writes this process's samples (atomically: readers never see half a file)."""
+        self._dirty.clear()
+        os.makedirs(self.directory, exist_ok=True)
+        path = self._path()
+        with open(f"{path}.tmp", "w") as fh:
+            json.dump({metric.name: metric.state() for metric in REGISTRY}, fh)
+        os.replace(f"{path}.tmp", path)
+
+    def collect(self):
+        """The registry with the samples of every process added up."""
+        self.flush()  # this process's own samples are always current
+        merged = {metric.name: metric.empty() for metric in REGISTRY}
+        for file_name in os.listdir(self.directory):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, file_name)) as fh:
+                    states = json.load(fh)
+            except (OSError, ValueError):
+                continue  # removed meanwhile
+            for name, state in states.items():
+                if name in merged:
+                    merged[name].absorb(state)
+        return list(merged.values())
+
+    def clear(self):
+        """Removes the files of a previous run; call once before the processes start."""
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith((".json", ".tmp")):
+                try:
+                    os.remove(os.path.join(self.directory, file_name))
+                except FileNotFoundError:
+                    pass
+
+
+def _reset_in_child():
+    # a forked process starts counting from zero (the parent's samples are in
+    # the parent's file) and must not inherit locks held by the parent's threads
+    for metric in REGISTRY:
+        metric._lock = threading.Lock()
+        metric.reset()
+    store.__init__()
+
+
+store = MultiprocessStore()
+os.register_at_fork(after_in_child=_reset_in_child)
+
+
+def render(engine=None):
+    """
+    All metrics in the Prometheus text exposition format: of every process
+    with ENERGY_METRICS_DIR, otherwise of the process that answered.
+    """
+    lines = []
+    for metric in store.collect() if store.directory else REGISTRY:
+        lines += metric.render()
+
+    if engine is not None:
+        lines += [
+            "# HELP energy_models_loaded Whether the models are loaded in this process.",
+            "# TYPE energy_models_loaded gauge",
+            f"energy_models_loaded {int(engine.ready)}",
+        ]
+    return "\n".join(lines) + "\n"
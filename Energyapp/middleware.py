@@ -0,0 +1,56 @@
+import time
+
+from django.conf import settings
+
+from . import metrics
+from .admission import Rejected, admission
+from .stages import recording
+
+
+class RequestMetricsMiddleware:
+    """
+    Times every request per view and collects its pipeline stages; with
+    ENERGY_SERVER_TIMING the stages go out as a Server-Timing header.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        started = time.perf_counter()
+        with recording() as timer:
+            response = self.get_response(request)
+        elapsed = time.perf_counter() - started
+
+        match = getattr(request, "resolver_match", None)
+        view = match.url_name if match is not None and match.url_name else "unmatched"
+        metrics.request_seconds.observe(elapsed, view=view, method=request.method, status=response.status_code)
+
+        if getattr(settings, "ENERGY_SERVER_TIMING", False) and timer.stages:
+            response["Server-Timing"] = server_timing(timer.as_ms(), elapsed * 1000)
+        return response
+
+
+def server_timing(stages_ms, total_ms):
+    # metric names are HTTP tokens, ':' is not allowed
+    entries = [f"{name.replace(':', '.')};dur={ms:.1f}" for name, ms in stages_ms.items()]
+    entries.append(f"total;dur={total_ms:.1f}")
+    return ", ".join(entries)
+
+
+class AdmissionMiddleware:
+    """Releases a request's inference slots and turns admission rejections into 429/503."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        try:
+            return self.get_response(request)
+        finally:
+            admission.release(request)
+
+    def process_exception(self, request, exception):
+        if isinstance(exception, Rejected):
+            return exception.response()
+        return None
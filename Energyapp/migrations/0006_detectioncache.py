@@ -0,0 +1,31 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Energyapp', '0005_grayscaleimage_job_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DetectionCache',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('content_hash', models.CharField(max_length=64)),
+                ('model_version', models.CharField(db_index=True, max_length=32)),
+                ('width', models.IntegerField()),
+                ('height', models.IntegerField()),
+                ('detections', models.JSONField()),
+                ('panels', models.JSONField()),
+                ('image', models.CharField(max_length=255)),
+                ('annotated', models.CharField(max_length=255)),
+                ('hits', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('last_used_at', models.DateTimeField(auto_now_add=True, db_index=True)),
+            ],
+        ),
+    ]
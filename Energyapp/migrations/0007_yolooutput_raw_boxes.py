@@ -0,0 +1,33 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:04
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Energyapp', '0006_detectioncache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='yolooutput',
+            name='detections',
+            field=models.JSONField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='yolooutput',
+            name='image_height',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='yolooutput',
+            name='image_width',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='yolooutput',
+            name='panel_boxes',
+            field=models.JSONField(blank=True, null=True),
+        ),
+    ]
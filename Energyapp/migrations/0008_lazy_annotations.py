@@ -0,0 +1,22 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Energyapp', '0007_yolooutput_raw_boxes'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='detectioncache',
+            name='annotated',
+        ),
+        migrations.AlterField(
+            model_name='yolooutput',
+            name='image',
+            field=models.ImageField(blank=True, upload_to='yolo_outputs/'),
+        ),
+    ]
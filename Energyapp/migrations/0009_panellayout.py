@@ -0,0 +1,27 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Energyapp', '0008_lazy_annotations'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PanelLayout',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location', models.CharField(max_length=100, unique=True)),
+                ('width', models.IntegerField()),
+                ('height', models.IntegerField()),
+                ('panels', models.JSONField()),
+                ('fingerprint', models.BinaryField()),
+                ('hits', models.IntegerField(default=0)),
+                ('misses', models.IntegerField(default=0)),
+                ('calibrated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
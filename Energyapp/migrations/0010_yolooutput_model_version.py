@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Energyapp', '0009_panellayout'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='yolooutput',
+            name='model_version',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=32),
+        ),
+    ]
@@ -0,0 +1,49 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:18
+
+from django.db import migrations, models
+from django.db.models import Max
+
+
+def mark_superseded_outputs(apps, schema_editor):
+    """Only the newest YOLOOutput of every image stays is_latest."""
+    YOLOOutput = apps.get_model("Energyapp", "YOLOOutput")
+    latest = (
+        YOLOOutput.objects.values("input_image").annotate(latest=Max("id")).values("latest")
+    )
+    YOLOOutput.objects.exclude(id__in=latest).update(is_latest=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Energyapp', '0010_yolooutput_model_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='yolooutput',
+            name='is_latest',
+            field=models.BooleanField(default=True),
+        ),
+        migrations.RunPython(mark_superseded_outputs, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='faultdetail',
+            index=models.Index(fields=['fault_name'], name='Energyapp_f_fault_n_71abe8_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='grayscaleimage',
+            index=models.Index(fields=['location', 'created_at'], name='Energyapp_g_locatio_ee58c7_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='grayscaleimage',
+            index=models.Index(fields=['created_at'], name='Energyapp_g_created_3d1e96_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='panelanalysis',
+            index=models.Index(fields=['panel_loss_kwh', 'id'], name='Energyapp_p_panel_l_8e013a_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='yolooutput',
+            index=models.Index(fields=['is_latest', 'input_image'], name='Energyapp_y_is_late_bafaed_idx'),
+        ),
+    ]
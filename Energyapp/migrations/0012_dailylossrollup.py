@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:20
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Energyapp', '0011_analytics_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyLossRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('location', models.CharField(max_length=100)),
+                ('day', models.DateField()),
+                ('fault_name', models.CharField(max_length=200)),
+                ('images', models.IntegerField(default=0)),
+                ('loss_percentage_total', models.FloatField(default=0)),
+                ('faults', models.IntegerField(default=0)),
+                ('daily_loss_kwh', models.FloatField(default=0)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['fault_name', 'day'], name='Energyapp_d_fault_n_82560b_idx')],
+                'constraints': [models.UniqueConstraint(fields=('location', 'day', 'fault_name'), name='unique_daily_loss_rollup')],
+            },
+        ),
+    ]
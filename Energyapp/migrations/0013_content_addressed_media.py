@@ -0,0 +1,36 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:30
+
+import Energyapp.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Energyapp', '0012_dailylossrollup'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StoredBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255, unique=True)),
+                ('sha256', models.CharField(db_index=True, max_length=64)),
+                ('size', models.BigIntegerField(default=0)),
+                ('refcount', models.IntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('archived_at', models.DateTimeField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='grayscaleimage',
+            name='image',
+            field=models.ImageField(storage=Energyapp.storage.get_blob_storage, upload_to='uploaded_images/'),
+        ),
+        migrations.AlterField(
+            model_name='yolooutput',
+            name='image',
+            field=models.ImageField(blank=True, storage=Energyapp.storage.get_blob_storage, upload_to='yolo_outputs/'),
+        ),
+    ]
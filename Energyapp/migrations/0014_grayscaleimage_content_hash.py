@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Energyapp', '0013_content_addressed_media'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='grayscaleimage',
+            name='content_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
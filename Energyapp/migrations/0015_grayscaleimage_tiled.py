@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 12:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Energyapp', '0014_grayscaleimage_content_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='grayscaleimage',
+            name='tiled',
+            field=models.BooleanField(default=False),
+        ),
+    ]
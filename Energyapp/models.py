@@ -1,11 +1,27 @@
 from django.db import models
 import uuid
 
+from .storage import get_blob_storage
+
 # =====================================================
 # Stores the uploaded original image
 # =====================================================
 class GrayscaleImage(models.Model):
-    image = models.ImageField(upload_to='uploaded_images/')
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    # stored by content hash, identical uploads share one file (see storage.py)
+    image = models.ImageField(upload_to='uploaded_images/', storage=get_blob_storage)
+    # sha256 of the upload (result cache key), computed while it streamed in
+    content_hash = models.CharField(max_length=64, blank=True, default="")
     signature = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -14,6 +30,23 @@ class GrayscaleImage(models.Model):
     capacity = models.FloatField(null=True, blank=True)
     sunlight_hours = models.FloatField(null=True, blank=True)
 
+    # ANALYSIS JOB STATE (the table doubles as the async job queue)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_DONE, db_index=True)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    attempts = models.IntegerField(default=0)
+    # run tile by tile (large orthomosaics), decided when the upload arrives
+    tiled = models.BooleanField(default=False)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # site / fleet analytics filter by location and group by day
+            models.Index(fields=["location", "created_at"]),
+            models.Index(fields=["created_at"]),
+        ]
+
     def __str__(self):
         return str(self.signature)
 
@@ -34,7 +67,8 @@ class ResizedImage(models.Model):
 # =====================================================
 class YOLOOutput(models.Model):
     input_image = models.ForeignKey(GrayscaleImage, on_delete=models.CASCADE)
-    image = models.ImageField(upload_to='yolo_outputs/')
+    # full-size annotated image, rendered on first download (see render.py)
+    image = models.ImageField(upload_to='yolo_outputs/', storage=get_blob_storage, blank=True)
     download_token = models.UUIDField(default=uuid.uuid4, editable=False, unique=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -43,6 +77,21 @@ class YOLOOutput(models.Model):
     total_daily_loss_kwh = models.FloatField(null=True, blank=True)
     loss_percentage = models.FloatField(null=True, blank=True)
 
+    # Raw model output, enough to re-score without re-running YOLO
+    image_width = models.IntegerField(null=True, blank=True)
+    image_height = models.IntegerField(null=True, blank=True)
+    detections = models.JSONField(null=True, blank=True)   # [[label, confidence, [x1, y1, x2, y2]], ...]
+    panel_boxes = models.JSONField(null=True, blank=True)  # [[x1, y1, x2, y2], ...]
+    # InferenceEngine.model_version that produced the boxes (blank before it was tracked)
+    model_version = models.CharField(max_length=32, blank=True, default="", db_index=True)
+    # False once the image was analysed again (reprocessing); analytics only count the latest
+    is_latest = models.BooleanField(default=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["is_latest", "input_image"]),
+        ]
+
     def __str__(self):
         return str(self.download_token)
 
@@ -56,6 +105,12 @@ class PanelAnalysis(models.Model):
     panel_number = models.IntegerField()
     panel_loss_kwh = models.FloatField()
 
+    class Meta:
+        indexes = [
+            # worst panels, keyset paginated on (loss, id)
+            models.Index(fields=["panel_loss_kwh", "id"]),
+        ]
+
     def __str__(self):
         return f"Panel {self.panel_number} | Loss {self.panel_loss_kwh} kWh"
 
@@ -72,5 +127,108 @@ class FaultDetail(models.Model):
     loss_percentage = models.FloatField()
     daily_loss = models.FloatField()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["fault_name"]),
+        ]
+
     def __str__(self):
         return f"{self.fault_name} ({self.daily_loss} kWh)"
+
+
+# =====================================================
+# Content-addressed cache of detections
+# (upload hash + model version + thresholds -> results)
+# =====================================================
+class DetectionCache(models.Model):
+    key = models.CharField(max_length=64, unique=True)
+    content_hash = models.CharField(max_length=64)
+    model_version = models.CharField(max_length=32, db_index=True)
+
+    width = models.IntegerField()
+    height = models.IntegerField()
+    detections = models.JSONField()
+    panels = models.JSONField()
+
+    # already stored upload, reused by repeat uploads
+    image = models.CharField(max_length=255)
+
+    hits = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return f"{self.content_hash[:12]} ({self.hits} hits)"
+
+    def as_analysis(self):
+        """Same shape as pipeline.detection_outputs()"""
+        detections = [(lbl, conf, box) for lbl, conf, box in self.detections]
+        return self.width, self.height, detections, self.panels
+
+
+# =====================================================
+# Panel boxes of a fixed-camera site, reused by
+# later inspections of the same location
+# =====================================================
+class PanelLayout(models.Model):
+    location = models.CharField(max_length=100, unique=True)
+
+    width = models.IntegerField()
+    height = models.IntegerField()
+    panels = models.JSONField()         # [[x1, y1, x2, y2], ...]
+    fingerprint = models.BinaryField()  # float16 grayscale thumbnail used for registration
+
+    hits = models.IntegerField(default=0)
+    misses = models.IntegerField(default=0)
+    calibrated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.location} ({len(self.panels)} panels)"
+
+
+# =====================================================
+# Pre-aggregated loss per location x day x fault type,
+# kept up to date as analyses are saved (see rollups.py)
+# =====================================================
+class DailyLossRollup(models.Model):
+    # fault_name of the per-image totals row of a location and day
+    ALL_FAULTS = "*"
+
+    location = models.CharField(max_length=100)  # "" for uploads without a location
+    day = models.DateField()
+    fault_name = models.CharField(max_length=200)
+
+    # ALL_FAULTS rows: analysed images and their YOLOOutput totals
+    images = models.IntegerField(default=0)
+    loss_percentage_total = models.FloatField(default=0)
+    # fault rows: FaultDetail count; daily loss is summed on both kinds of rows
+    faults = models.IntegerField(default=0)
+    daily_loss_kwh = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=["location", "day", "fault_name"], name="unique_daily_loss_rollup"),
+        ]
+        indexes = [
+            models.Index(fields=["fault_name", "day"]),
+        ]
+
+    def __str__(self):
+        return f"{self.location} {self.day} {self.fault_name}: {self.daily_loss_kwh:.3f} kWh"
+
+
+# =====================================================
+# Files of the content-addressed media storage and the
+# number of rows referencing each (see storage.py)
+# =====================================================
+class StoredBlob(models.Model):
+    name = models.CharField(max_length=255, unique=True)
+    sha256 = models.CharField(max_length=64, db_index=True)
+    size = models.BigIntegerField(default=0)
+    refcount = models.IntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # set when compact_media re-encoded an old original at a lower quality
+    archived_at = models.DateTimeField(null=True, blank=True)
+
+    def __str__(self):
+        return f"{self.name} ({self.refcount} refs)"
@@ -0,0 +1,428 @@
+import logging
+import math
+import os
+import time
+import traceback
+
+from django.conf import settings
+from django.db import transaction
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from .cache import result_cache
+from .cascade import CascadeRules
+from .inference import engine
+from .layouts import panel_layouts
+from .loss import compute_energy_loss, summarize
+from .models import (
+    GrayscaleImage,
+    YOLOOutput,
+    PanelAnalysis,
+    FaultDetail
+)
+from . import metrics, rollups
+from .preprocess import PreparedImage
+from .render import prerender_later, variant_name
+from .stages import stage
+from .tiling import open_raster, run_tiled_detection
+
+logger = logging.getLogger(__name__)
+
+# ---------------- CONFIDENCE THRESHOLDS ----------------
+BEST_CONF = 0.25
+SNOW_CONF = 0.2
+PANEL_CONF = 0.2
+DETECTOR_CONFS = {"best": BEST_CONF, "snow": SNOW_CONF}
+
+# uploads that send no location; shared by every such client, so never a "site"
+DEFAULT_LOCATION = "Home"
+
+# ---------------- LABEL NORMALIZATION ----------------
+def normalize(lbl):
+    lbl = lbl.strip().lower()
+    mapping = {
+        "clean": "Non-Defective",
+        "non-defective": "Non-Defective",
+        "dusty": "Dusty",
+        "bird": "Bird-drop",
+        "bird-drop": "Bird-drop",
+        "snow": "Snow-Covered",
+        "physical damage": "Physical Damage",
+        "faulty_solar_panel": "Physical Damage",
+        "electrical-damage": "Electrical-Damage",
+    }
+    return mapping.get(lbl, lbl.title())
+
+
+# ---------------- DETECTION HELPERS ----------------
+def extract_detections(res):
+    detections = []
+    for b in res.boxes:
+        lbl = normalize(res.names[int(b.cls[0])])
+        conf = float(b.conf[0])
+        box = list(map(int, b.xyxy[0].tolist()))
+        detections.append((lbl, conf, box))
+    return detections
+
+
+def run_fault_cascade(prepared):
+    """best.pt first; if it finds nothing meaningful, fall back to snow.pt (see CascadeRules)"""
+    single = lambda key, items, conf: [engine.predict(key, items[0], conf=conf)]
+    return run_fault_cascade_batch([prepared], predict=single)[0]
+
+
+def run_fault_cascade_batch(prepared_list, predict=None):
+    """
+    Same cascade for many images, one batched forward pass per model and step.
+    Returns [(detections, result of the last detector run), ...].
+    """
+    predict = predict or engine.predict_batch
+    rules = CascadeRules.from_settings()
+
+    plans = [rules.plan()] * len(prepared_list)
+    if rules.gate:
+        plans = [
+            rules.plan(res.names[res.probs.top1], float(res.probs.top1conf))
+            for res in engine.classify("gate", prepared_list)
+        ]
+
+    outcomes = [([], None)] * len(prepared_list)
+    pending = [i for i, plan in enumerate(plans) if plan]
+    step = 0
+    while pending:
+        by_detector = {}
+        for i in pending:
+            by_detector.setdefault(plans[i][step], []).append(i)
+
+        pending = []
+        for key, indices in by_detector.items():
+            if step:
+                metrics.cascade_fallbacks.inc(len(indices), detector=key)
+            results = predict(key, [prepared_list[i] for i in indices], DETECTOR_CONFS[key])
+            for i, res in zip(indices, results):
+                outcomes[i] = (extract_detections(res), res)
+                if not rules.is_meaningful(outcomes[i][0]) and step + 1 < len(plans[i]):
+                    pending.append(i)
+        step += 1
+    return outcomes
+
+
+# ---------------- DETECTION STAGE ----------------
+def run_detection(prepared):
+    """Fault cascade and panel detection, run concurrently. Returns (detections, final_res, panel_res)."""
+    with engine.analysis_slot():
+        (detections, final_res), panel_res = engine.run_concurrently(
+            lambda: run_fault_cascade(prepared),
+            lambda: engine.predict("panel", prepared, conf=PANEL_CONF),
+        )
+    return detections, final_res, panel_res
+
+
+def run_detection_batch(prepared_list):
+    """run_detection for many images with batched inference."""
+    with engine.analysis_slot():
+        cascades, panel_results = engine.run_concurrently(
+            lambda: run_fault_cascade_batch(prepared_list),
+            lambda: engine.predict_batch("panel", prepared_list, conf=PANEL_CONF),
+        )
+    return [
+        (detections, final_res, panel_res)
+        for (detections, final_res), panel_res in zip(cascades, panel_results)
+    ]
+
+
+def detect_site(prepared, location, calibrate=False):
+    """
+    Full-image detection for an inspection of `location`. When the stored
+    panel layout of the site lines up with this frame only the fault cascade
+    runs; otherwise (or when calibrating) the panel model runs as well and
+    its boxes become the site layout if there was none yet.
+    Returns (width, height, detections, panels).
+    """
+    if location == DEFAULT_LOCATION:
+        location = None  # no site to match against or to store
+    if not calibrate:
+        panels = panel_layouts.match(location, prepared)
+        if panels is not None:
+            with engine.analysis_slot():
+                detections, _ = run_fault_cascade(prepared)
+            return prepared.width, prepared.height, detections, panels
+
+    analysis = detection_outputs(prepared, *run_detection(prepared))
+    panel_layouts.store(location, prepared, analysis[3], replace=calibrate)
+    return analysis
+
+
+# ---------------- USER INPUTS ----------------
+def parse_energy_inputs(data, location=DEFAULT_LOCATION, capacity=5, sun_hours=5):
+    """
+    Reads location / capacity / sunHours from request data (POST dict or
+    JSON object), falling back to the given defaults for missing keys.
+    Raises ValueError with a message for the client on missing, non-finite
+    or non-positive numbers.
+    """
+    location = data.get("location", location)
+    capacity = _positive_number(data.get("capacity", capacity), "capacity")
+    sun_hours = _positive_number(data.get("sunHours", sun_hours), "sunHours")
+    return location, capacity, sun_hours
+
+
+def _positive_number(raw, name):
+    try:
+        value = float(raw)
+    except (TypeError, ValueError):
+        raise ValueError(f"{name} must be a number")
+    if not math.isfinite(value) or value <= 0:
+        raise ValueError(f"{name} must be a positive number")
+    return value
+
+
+# =====================================================
+# Full analysis of stored uploads
+# =====================================================
+def analyze_image(img_obj, prepared=None, content_hash=None, tiled=False, calibrate=False, check_cache=True):
+    """
+    Runs detection, energy-loss math, annotation and persistence for one
+    GrayscaleImage and returns the JSON summary sent to the client.
+    `prepared` may be passed when the upload was already decoded.
+    With a `content_hash` the detections are looked up in / stored to the
+    result cache. `tiled` runs the models tile by tile (large orthomosaics).
+    `calibrate` re-detects the panels and stores them as the site layout.
+    `check_cache=False` skips the lookup when the caller already missed.
+    """
+    mode = "tiled" if tiled else "full"
+    cached = None if calibrate or not check_cache else result_cache.get(content_hash, mode)
+    if cached is not None:
+        return finish_analysis(img_obj, *cached.as_analysis())
+
+    if tiled:
+        analysis = detect_tiled(img_obj)
+    else:
+        if prepared is None:
+            prepared = load_prepared(img_obj)
+        analysis = detect_site(prepared, img_obj.location, calibrate=calibrate)
+
+    result_cache.put(content_hash, img_obj, *analysis, mode=mode)
+    return finish_analysis(img_obj, *analysis)
+
+
+def detect_tiled(img_obj):
+    """Tiled detection straight from the stored upload. Returns (width, height, detections, panels)."""
+    try:
+        raster = open_raster(path=img_obj.image.path)
+    except NotImplementedError:  # storage without local paths
+        with img_obj.image.open("rb") as fh:
+            raster = open_raster(file_obj=fh)
+
+    try:
+        return run_tiled_detection(
+            raster,
+            {**DETECTOR_CONFS, "panel": PANEL_CONF},
+            normalize,
+            CascadeRules.from_settings(),
+            tile_size=settings.ENERGY_TILE_SIZE,
+            overlap=settings.ENERGY_TILE_OVERLAP,
+            batch_size=settings.ENERGY_BATCH_SIZE,
+        )
+    finally:
+        raster.close()
+
+
+def wants_tiled(file_obj, requested=None):
+    """Tiled mode when the client asks for it, or automatically for very large images."""
+    if requested is not None and requested != "":
+        return requested.lower() in ("1", "true", "yes")
+    size = getattr(file_obj, "image_size", None)  # known for streamed uploads
+    if size is None:
+        with Image.open(file_obj) as im:
+            size = im.size
+        file_obj.seek(0)
+    return max(size) > settings.ENERGY_TILED_AUTO_SIDE
+
+
+def load_prepared(img_obj):
+    with img_obj.image.open("rb") as fh:
+        return PreparedImage.from_upload(fh)
+
+
+def detection_outputs(prepared, detections, final_res, panel_res):
+    """
+    Turns raw model results into what the rest of the pipeline needs:
+    (width, height, detections, panel boxes). The annotated image is not
+    drawn here; render.get_annotated draws it from the stored detections
+    the first time it is downloaded.
+    """
+    panels = [list(map(int, b.xyxy[0].tolist())) for b in panel_res.boxes]
+    return prepared.width, prepared.height, detections, panels
+
+
+def finish_analysis(img_obj, w, h, detections, panels):
+    """Everything after inference: loss math, DB rows, summary."""
+    return finish_analyses([(img_obj, w, h, detections, panels)])[0]
+
+
+def finish_analyses(analyses):
+    """
+    finish_analysis for many images at once: [(img_obj, w, h, detections, panels), ...].
+    All rows are written in one transaction, one INSERT per table.
+    Returns the JSON payloads in order.
+    """
+    scored = []
+    for img_obj, w, h, detections, panels in analyses:
+        engine.record_analysis()
+        metrics.analyses.inc()
+        metrics.panels_per_image.observe(len(panels))
+        metrics.faults_per_image.observe(len(detections))
+        for lbl, _, _ in detections:
+            metrics.faults.inc(fault=lbl)
+        location = img_obj.location
+        SYSTEM_CAPACITY = img_obj.capacity
+        SUNLIGHT = img_obj.sunlight_hours
+
+        with stage("loss"):
+            loss = compute_energy_loss(w, h, detections, panels, SYSTEM_CAPACITY, SUNLIGHT)
+            summary, response_panels = summarize(location, SYSTEM_CAPACITY, SUNLIGHT, loss)
+        scored.append((img_obj, w, h, detections, panels, summary, response_panels, loss["panel_data"]))
+
+    # ---------- SAVE (one transaction, bulk inserts) ----------
+    payloads = []
+    with stage("db_writes"), transaction.atomic():
+        outputs, persistence = save_analysis_rows([
+            (img_obj, w, h, detections, panels, summary, panel_data)
+            for img_obj, w, h, detections, panels, summary, _, panel_data in scored
+        ])
+
+        finished_at = timezone.now()
+        for yolo_obj, counts, (img_obj, *_, summary, response_panels, _) in zip(outputs, persistence, scored):
+            token = yolo_obj.download_token
+            payload = {
+                "message": "Energy Loss Analysis Completed",
+                "summary": summary,
+                "panel_analysis": response_panels,
+                "download_url": annotated_url(token, "full"),
+                "preview_url": annotated_url(token, "preview"),
+                "thumbnail_url": annotated_url(token, "thumbnail"),
+                "download_token": str(token),
+                "file_name": os.path.basename(variant_name(token, "full")),
+                "persistence": counts,
+            }
+            payloads.append(payload)
+
+            img_obj.status = GrayscaleImage.STATUS_DONE
+            img_obj.result = payload
+            img_obj.finished_at = finished_at
+
+        if len(scored) == 1:
+            scored[0][0].save(update_fields=["status", "result", "finished_at"])
+        else:
+            GrayscaleImage.objects.bulk_update([a[0] for a in scored], ["status", "result", "finished_at"])
+
+        for yolo_obj in outputs:
+            transaction.on_commit(lambda obj=yolo_obj: prerender_later(obj, settings.ENERGY_PRERENDER_VARIANTS))
+    return payloads
+
+
+def mark_failed(img_obj):
+    """Records the exception being handled on the image row: failed, with a short traceback."""
+    GrayscaleImage.objects.filter(pk=img_obj.pk).update(
+        status=GrayscaleImage.STATUS_FAILED,
+        error=traceback.format_exc(limit=5),
+        finished_at=timezone.now(),
+    )
+
+
+def annotated_url(download_token, variant):
+    return f"{reverse('annotated_image', args=[download_token])}?size={variant}"
+
+
+def save_analysis_rows(analyses):
+    """
+    Writes the YOLOOutput plus all PanelAnalysis / FaultDetail rows of every
+    analysis with one INSERT per table. Must run inside a transaction.
+    `analyses` is [(img_obj, w, h, detections, panels, summary, panel_data), ...].
+    Returns (yolo_objs, [{"rows_inserted": ..., "db_ms": ...}, ...]).
+    """
+    started = time.perf_counter()
+    version = engine.model_version
+
+    # re-analysed images: the previous outputs stop counting in analytics
+    superseded = list(YOLOOutput.objects.filter(
+        input_image__in=[a[0] for a in analyses], is_latest=True
+    ).values_list("id", flat=True))
+    if superseded:
+        YOLOOutput.objects.filter(id__in=superseded).update(is_latest=False)
+
+    # ---------- SAVE YOLO OUTPUT (with raw boxes for re-scoring) ----------
+    outputs = YOLOOutput.objects.bulk_create([
+        YOLOOutput(
+            input_image=img_obj,
+            total_panels=summary["total_panels"],
+            total_daily_loss_kwh=summary["total_daily_loss_kwh"],
+            loss_percentage=summary["overall_loss_percentage"],
+            image_width=w,
+            image_height=h,
+            detections=[list(d) for d in detections],
+            panel_boxes=[list(p) for p in panels],
+            model_version=version,
+        )
+        for img_obj, w, h, detections, panels, summary, _ in analyses
+    ])
+
+    # ---------- SAVE PANEL + FAULTS ----------
+    # bulk_create sets the primary keys (RETURNING), so faults can point at their panel
+    panel_recs = PanelAnalysis.objects.bulk_create([
+        PanelAnalysis(
+            yolo_output=yolo_obj,
+            panel_number=p["panel_number"],
+            panel_loss_kwh=p["panel_loss"]
+        )
+        for yolo_obj, (*_, panel_data) in zip(outputs, analyses)
+        for p in panel_data
+    ])
+
+    panel_iter = iter(panel_recs)
+    faults, counts = [], []
+    for *_, panel_data in analyses:
+        n_faults = len(faults)
+        for p in panel_data:
+            panel_rec = next(panel_iter)
+            faults.extend(
+                FaultDetail(
+                    panel=panel_rec,
+                    fault_name=f["fault"],
+                    confidence=f["confidence"],
+                    affected_area=f["affected_area"],
+                    loss_percentage=f["loss_percentage"],
+                    daily_loss=f["daily_loss"]
+                )
+                for f in p["left"] + p["right"]
+            )
+        counts.append((len(panel_data), len(faults) - n_faults))
+    FaultDetail.objects.bulk_create(faults)
+
+    # ---------- DAILY ROLLUPS ----------
+    rollups.apply_outputs(added_ids=[o.id for o in outputs], removed_ids=superseded)
+
+    db_ms = round((time.perf_counter() - started) * 1000, 2)
+    persistence = [
+        {
+            "rows_inserted": 1 + n_panels + n_faults,
+            "panels_inserted": n_panels,
+            "faults_inserted": n_faults,
+            "db_ms": db_ms,  # for the whole write when several analyses are saved together
+        }
+        for n_panels, n_faults in counts
+    ]
+    logger.info("Saved %d analyses (%d rows) in %.2f ms", len(outputs),
+                sum(p["rows_inserted"] for p in persistence), db_ms)
+    return outputs, persistence
+
+
+def analyze_batch(img_objs, prepared_list):
+    """analyze_image for several uploads, sharing batched forward passes."""
+    detections = run_detection_batch(prepared_list)
+    return finish_analyses([
+        (img_obj, *detection_outputs(prepared, *dets))
+        for img_obj, prepared, dets in zip(img_objs, prepared_list, detections)
+    ])
@@ -0,0 +1,103 @@
+import threading
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from .stages import stage
+
+# Square input size shared by all three models
+MODEL_INPUT_SIZE = 640
+PAD_VALUE = 114
+
+
+# ---------------- DECODING ----------------
+def decode_upload(file_obj):
+    """Decodes an uploaded file (or any binary file object) into an RGB array."""
+    file_obj.seek(0)
+    with Image.open(file_obj) as im:
+        # the models used to read the file with cv2, which honours EXIF orientation
+        im = ImageOps.exif_transpose(im)
+        array = np.asarray(im.convert("RGB"))
+    file_obj.seek(0)
+    return array
+
+
+# ---------------- LETTERBOX ----------------
+def letterbox(array, size=MODEL_INPUT_SIZE):
+    """
+    Resizes keeping aspect ratio and pads to a size x size square,
+    the same way the ultralytics predictor does it (cv2 INTER_LINEAR, which
+    does not antialias; PIL's bilinear would and shift the confidences).
+    Returns (letterboxed array, ratio, (pad_x, pad_y)).
+    """
+    import cv2  # on first use: `check`, migrations and the admin never load it (boot.HEAVY_MODULES)
+
+    h, w = array.shape[:2]
+    ratio = min(size / h, size / w)
+    new_w, new_h = max(1, round(w * ratio)), max(1, round(h * ratio))
+
+    if (new_w, new_h) != (w, h):
+        resized = cv2.resize(np.ascontiguousarray(array), (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+    else:
+        resized = array
+
+    pad_x = (size - new_w) / 2
+    pad_y = (size - new_h) / 2
+    top, left = int(round(pad_y - 0.1)), int(round(pad_x - 0.1))
+
+    out = np.full((size, size, 3), PAD_VALUE, dtype=np.uint8)
+    out[top:top + new_h, left:left + new_w] = resized
+    return out, ratio, (left, top)
+
+
+# =====================================================
+# An image decoded once and letterboxed once
+# =====================================================
+class PreparedImage:
+    """
+    Holds the decoded upload and the letterboxed tensor that is fed to every
+    model, so the same JPEG is never read or decoded twice per request.
+    """
+
+    def __init__(self, array, size=MODEL_INPUT_SIZE):
+        self.array = array  # H x W x 3, RGB, uint8
+        self.height, self.width = array.shape[:2]
+        self.size = size
+        self.boxed, self.ratio, self.pad = letterbox(array, size)
+        self._tensor = None
+        self._lock = threading.Lock()  # models may run on this image concurrently
+
+    @classmethod
+    def from_upload(cls, file_obj, size=MODEL_INPUT_SIZE):
+        with stage("decode"):
+            return cls(decode_upload(file_obj), size)
+
+    @property
+    def tensor(self):
+        """1 x 3 x size x size float tensor in [0, 1], RGB (what ultralytics expects for tensors)."""
+        with self._lock:
+            if self._tensor is None:
+                import torch
+
+                chw = np.ascontiguousarray(self.boxed.transpose(2, 0, 1))
+                self._tensor = torch.from_numpy(chw).unsqueeze(0).float().div_(255.0)
+        return self._tensor
+
+    @property
+    def placeholder(self):
+        """
+        Zero-copy stand-in for the original frame in ultralytics Results, which
+        only take its shape: boxes are already mapped back and the annotated
+        image is drawn later from the stored file (render.py).
+        """
+        return np.broadcast_to(np.zeros(3, dtype=np.uint8), (self.height, self.width, 3))
+
+    def scale_boxes(self, xyxy):
+        """Maps boxes from letterbox coordinates back to the original image (in place)."""
+        pad_x, pad_y = self.pad
+        xyxy[:, [0, 2]] -= pad_x
+        xyxy[:, [1, 3]] -= pad_y
+        xyxy[:, :4] /= self.ratio
+        xyxy[:, [0, 2]] = xyxy[:, [0, 2]].clamp(0, self.width)
+        xyxy[:, [1, 3]] = xyxy[:, [1, 3]].clamp(0, self.height)
+        return xyxy
@@ -0,0 +1,128 @@
+from collections import defaultdict
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+
+from .models import DailyLossRollup, FaultDetail, YOLOOutput
+
+ALL_FAULTS = DailyLossRollup.ALL_FAULTS
+VALUE_FIELDS = ("images", "loss_percentage_total", "faults", "daily_loss_kwh")
+
+# incremental float sums drift a little from a fresh SUM()
+TOLERANCE = 1e-6
+
+
+# =====================================================
+# Aggregation of raw analyses
+# =====================================================
+def aggregate(outputs):
+    """
+    Rollup values of a YOLOOutput queryset, computed in the database:
+    {(location, day, fault_name): {"images": ..., "faults": ..., ...}}.
+    """
+    totals = defaultdict(lambda: dict.fromkeys(VALUE_FIELDS, 0))
+
+    per_image = (
+        outputs.annotate(day=TruncDate("input_image__created_at"))
+        .values("input_image__location", "day")
+        .annotate(
+            n=Count("id"),
+            pct=Sum("loss_percentage"),
+            loss=Sum("total_daily_loss_kwh"),
+        )
+    )
+    for row in per_image:
+        values = totals[(row["input_image__location"] or "", row["day"], ALL_FAULTS)]
+        values["images"] += row["n"]
+        values["loss_percentage_total"] += row["pct"] or 0
+        values["daily_loss_kwh"] += row["loss"] or 0
+
+    per_fault = (
+        FaultDetail.objects.filter(panel__yolo_output__in=outputs)
+        .annotate(day=TruncDate("panel__yolo_output__input_image__created_at"))
+        .values("panel__yolo_output__input_image__location", "day", "fault_name")
+        .annotate(n=Count("id"), loss=Sum("daily_loss"))
+    )
+    for row in per_fault:
+        values = totals[(row["panel__yolo_output__input_image__location"] or "", row["day"], row["fault_name"])]
+        values["faults"] += row["n"]
+        values["daily_loss_kwh"] += row["loss"] or 0
+
+    return dict(totals)
+
+
+# =====================================================
+# Incremental maintenance
+# =====================================================
+def apply_outputs(added_ids=(), removed_ids=()):
+    """
+    Adds the contribution of newly saved YOLOOutputs and subtracts that of
+    superseded ones. Runs inside the transaction that writes the analyses.
+    """
+    deltas = defaultdict(lambda: dict.fromkeys(VALUE_FIELDS, 0))
+    for ids, sign in ((added_ids, 1), (removed_ids, -1)):
+        if not ids:
+            continue
+        for key, values in aggregate(YOLOOutput.objects.filter(id__in=list(ids))).items():
+            for field, value in values.items():
+                deltas[key][field] += sign * value
+
+    for (location, day, fault_name), delta in deltas.items():
+        _increment(location, day, fault_name, delta)
+
+
+def _increment(location, day, fault_name, delta):
+    rows = DailyLossRollup.objects.filter(location=location, day=day, fault_name=fault_name)
+    increments = {field: F(field) + value for field, value in delta.items()}
+
+    if not rows.update(**increments):
+        try:
+            with transaction.atomic():
+                DailyLossRollup.objects.create(location=location, day=day, fault_name=fault_name, **delta)
+        except IntegrityError:
+            # created by a concurrent analysis in the meantime
+            rows.update(**increments)
+
+    # a location/day whose only analysis was superseded
+    rows.filter(images__lte=0, faults__lte=0).delete()
+
+
+# =====================================================
+# Rebuild / consistency check
+# =====================================================
+def expected_rollups():
+    return aggregate(YOLOOutput.objects.filter(is_latest=True))
+
+
+@transaction.atomic
+def rebuild():
+    """Replaces the whole table with a fresh aggregation of the latest analyses. Returns the row count."""
+    expected = expected_rollups()
+    DailyLossRollup.objects.all().delete()
+    DailyLossRollup.objects.bulk_create(
+        [
+            DailyLossRollup(location=location, day=day, fault_name=fault_name, **values)
+            for (location, day, fault_name), values in expected.items()
+        ],
+        batch_size=1000,
+    )
+    return len(expected)
+
+
+def differences(tolerance=TOLERANCE):
+    """[(key, stored values or None, expected values or None), ...] for every row that disagrees."""
+    expected = expected_rollups()
+    stored = {
+        (row["location"], row["day"], row["fault_name"]): {field: row[field] for field in VALUE_FIELDS}
+        for row in DailyLossRollup.objects.values("location", "day", "fault_name", *VALUE_FIELDS)
+    }
+
+    diffs = []
+    for key in sorted(set(expected) | set(stored), key=lambda k: (k[0], k[1], k[2])):
+        have, want = stored.get(key), expected.get(key)
+        if have is None or want is None or any(
+            abs(have[field] - want[field]) > tolerance * max(1.0, abs(want[field])) for field in VALUE_FIELDS
+        ):
+            diffs.append((key, have, want))
+    return diffs
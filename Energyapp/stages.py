@@ -0,0 +1,56 @@
+import contextvars
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from . import metrics
+
+_current = contextvars.ContextVar("energy_stage_timer", default=None)
+
+
+# =====================================================
+# Per-request stage timings (decode, models, loss, DB, ...)
+# =====================================================
+class StageTimer:
+    """Seconds spent per pipeline stage while it was the active recorder."""
+
+    def __init__(self, parent=None):
+        self.stages = defaultdict(float)
+        self.parent = parent  # an enclosing recording sees the stages too
+        self._lock = threading.Lock()  # the two detection branches run on different threads
+
+    def add(self, name, seconds):
+        with self._lock:
+            self.stages[name] += seconds
+        if self.parent is not None:
+            self.parent.add(name, seconds)
+
+    def as_ms(self):
+        with self._lock:
+            return {name: round(seconds * 1000, 3) for name, seconds in self.stages.items()}
+
+
+@contextmanager
+def recording():
+    """Collects the stages of everything run in this context (and in copies of it)."""
+    timer = StageTimer(parent=_current.get())
+    token = _current.set(timer)
+    try:
+        yield timer
+    finally:
+        _current.reset(token)
+
+
+@contextmanager
+def stage(name):
+    """Times a stage into the metrics histogram, and into the active recording if any."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - started
+        metrics.stage_seconds.observe(seconds, stage=name)
+        timer = _current.get()
+        if timer is not None:
+            timer.add(name, seconds)
@@ -0,0 +1,127 @@
+import hashlib
+import os
+import tempfile
+
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.core.files.storage import FileSystemStorage
+from django.db import IntegrityError, transaction
+from django.db.models import F
+
+# ".jpeg" and ".jpg" uploads of the same bytes share one blob
+EXTENSION_ALIASES = {".jpeg": ".jpg", ".tif": ".tiff"}
+
+
+def hash_file(content):
+    digest = hashlib.sha256()
+    content.seek(0)
+    for chunk in content.chunks():
+        digest.update(chunk)
+    content.seek(0)
+    return digest.hexdigest()
+
+
+# =====================================================
+# Content-addressed media storage
+# =====================================================
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    Stores every file under the sha256 of its bytes, next to the field's
+    upload_to directory: "uploaded_images/ab/ab12...ef.jpg". Saving bytes
+    that are already stored writes nothing and returns the existing name.
+
+    StoredBlob keeps a reference count per file: +1 per save() or retain(),
+    -1 when a row that referenced it is deleted. Files are never deleted
+    here; `manage.py compact_media` removes blobs nobody references (after
+    checking the database, the count is a hint).
+    """
+
+    def blob_name(self, name, digest):
+        directory = os.path.dirname(name)
+        ext = os.path.splitext(name)[1].lower()
+        ext = EXTENSION_ALIASES.get(ext, ext)
+        return os.path.join(directory, digest[:2], f"{digest}{ext}")
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+
+        # streamed uploads were hashed while they arrived
+        digest = getattr(content, "sha256", None) or hash_file(content)
+        name = super().save(self.blob_name(name, digest), content, max_length=max_length)
+        self.retain(name, digest=digest, size=content.size)
+        return name
+
+    def get_available_name(self, name, max_length=None):
+        # the name is the content: an existing file is the same file
+        return name
+
+    def _save(self, name, content):
+        full_path = self.path(name)
+        if os.path.exists(full_path):
+            return name
+
+        directory = os.path.dirname(full_path)
+        os.makedirs(directory, exist_ok=True)
+        if hasattr(content, "temporary_file_path"):
+            # a concurrent save of the same bytes may win the race; replacing
+            # a file with identical content is harmless
+            file_move_safe(content.temporary_file_path(), full_path, allow_overwrite=True)
+        else:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".incoming-")
+            try:
+                with os.fdopen(fd, "wb") as fh:
+                    for chunk in content.chunks():
+                        fh.write(chunk)
+                os.replace(tmp_path, full_path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+        if self.file_permissions_mode is not None:
+            os.chmod(full_path, self.file_permissions_mode)
+        return name
+
+    # ---------------- REFERENCE COUNTS ----------------
+    def retain(self, name, digest=None, size=None):
+        """Counts one more reference to `name` (a row that points at an already stored file)."""
+        from .models import StoredBlob
+
+        if not name:
+            return
+        blobs = StoredBlob.objects.filter(name=name)
+        if blobs.update(refcount=F("refcount") + 1):
+            return
+        if digest is None or size is None:
+            if not self.exists(name):
+                return
+            with self.open(name, "rb") as fh:
+                digest, size = hash_file(fh), fh.size
+        try:
+            with transaction.atomic():
+                StoredBlob.objects.create(name=name, sha256=digest, size=size, refcount=1)
+        except IntegrityError:
+            blobs.update(refcount=F("refcount") + 1)
+
+    def release(self, name):
+        from .models import StoredBlob
+
+        if name:
+            StoredBlob.objects.filter(name=name).update(refcount=F("refcount") - 1)
+
+
+blob_storage = ContentAddressedStorage()
+
+
+def get_blob_storage():
+    """Storage of the media fields (a callable, so migrations do not serialize the instance)."""
+    return blob_storage
+
+
+def release_on_delete(sender, instance, **kwargs):
+    """post_delete receiver: a deleted row no longer references its image."""
+    if instance.image:
+        blob_storage.release(instance.image.name)
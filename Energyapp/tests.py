@@ -1,3 +1,1022 @@
-from django.test import TestCase
+import hashlib
+import io
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import DatabaseError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from PIL import Image
+
+from . import analytics, loss, metrics, rollups
+from .admission import admission
+from .batch import analyze_site, iter_zip_images
+from .batching import MicroBatcher
+from .boot import HEAVY_MODULES
+from .cache import ResultCache, result_cache
+from .cascade import CascadeRules
+from .inference import engine
+from .jobs import requeue_stale_jobs, run_job
+from .layouts import FINGERPRINT_SIZE, register, shift_boxes
+from .loss import FAULT_LOSS
+from .management.commands.check_startup import CHECK_PROBE, run_probe
+from .middleware import server_timing
+from .models import DailyLossRollup, DetectionCache, FaultDetail, GrayscaleImage, PanelAnalysis, StoredBlob, YOLOOutput
+from .pipeline import finish_analyses, finish_analysis, run_fault_cascade_batch
+from .preprocess import PreparedImage
+from .storage import blob_storage
+from .tiling import merge_boxes, tile_windows
+
+
+def make_analysis(location, day, panel_losses, fault="Dusty", is_latest=True):
+    """One analysed upload with one fault per panel, inspected on `day`."""
+    img = GrayscaleImage.objects.create(image="uploaded_images/x.jpg", location=location, capacity=5, sunlight_hours=5)
+    GrayscaleImage.objects.filter(pk=img.pk).update(
+        created_at=datetime(2025, 6, day, 12, tzinfo=timezone.utc)
+    )
+    output = YOLOOutput.objects.create(
+        input_image=img,
+        total_panels=len(panel_losses),
+        total_daily_loss_kwh=sum(panel_losses),
+        loss_percentage=sum(panel_losses) / 25 * 100,
+        is_latest=is_latest,
+    )
+    for number, loss in enumerate(panel_losses, start=1):
+        panel = PanelAnalysis.objects.create(yolo_output=output, panel_number=number, panel_loss_kwh=loss)
+        FaultDetail.objects.create(
+            panel=panel, fault_name=fault, confidence=0.9,
+            affected_area=0.5, loss_percentage=10, daily_loss=loss,
+        )
+    if is_latest:
+        rollups.apply_outputs(added_ids=[output.id])
+    return output
+
+
+def jpeg_bytes(size=(64, 48), color="gray"):
+    """A small valid JPEG upload."""
+    image = io.BytesIO()
+    Image.new("RGB", size, color).save(image, format="JPEG")
+    return image.getvalue()
+
+
+class MediaTestMixin:
+    """
+    Uploads and admission slots in temporary directories (removed afterwards)
+    and a fixed engine model version: the weights are not in the repository.
+    """
+
+    model_version = "test"
+
+    def setUp(self):
+        super().setUp()
+        self.override(MEDIA_ROOT=self.temp_dir(), ENERGY_ADMISSION_DIR=self.temp_dir())
+        self.version = mock.patch.object(engine, "_model_version", self.model_version)
+        self.version.start()
+        self.addCleanup(self.version.stop)
+
+    def temp_dir(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path, ignore_errors=True)
+        return path
+
+    def override(self, **options):
+        overrides = override_settings(**options)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+
+def walk_pages(test, url, key, **params):
+    """Follows next_cursor until the end; returns every item."""
+    items, cursor = [], None
+    while True:
+        query = dict(params, **({"cursor": cursor} if cursor else {}))
+        data = test.client.get(url, query).json()
+        items += data[key]
+        cursor = data["next_cursor"]
+        if cursor is None:
+            return items
+
+
+class FleetAnalyticsTests(TestCase):
+
+    def setUp(self):
+        make_analysis("Alpha", 1, [1.0, 2.0])
+        make_analysis("Alpha", 2, [0.5], fault="Bird-drop")
+        make_analysis("Beta", 2, [3.0])
+        # superseded by a re-analysis: never counted
+        make_analysis("Beta", 2, [100.0], is_latest=False)
+
+    def test_fleet_summary(self):
+        data = self.client.get(reverse("fleet_summary")).json()
+
+        self.assertEqual(data["totals"]["images"], 3)
+        self.assertEqual(data["totals"]["total_daily_loss_kwh"], 6.5)
+        self.assertEqual(
+            [(row["fault"], row["faults"], row["total_daily_loss_kwh"]) for row in data["loss_by_fault"]],
+            [("Dusty", 3, 6.0), ("Bird-drop", 1, 0.5)],
+        )
+        self.assertEqual([s["location"] for s in data["sites"]], ["Alpha", "Beta"])
+        self.assertIsNone(data["next_cursor"])
+
+    def test_site_summary(self):
+        data = self.client.get(reverse("site_summary", args=["Alpha"])).json()
+        self.assertEqual(data["totals"]["images"], 2)
+        self.assertEqual(data["totals"]["total_daily_loss_kwh"], 3.5)
+
+        response = self.client.get(reverse("site_summary", args=["Nowhere"]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_daily_loss(self):
+        days = walk_pages(self, reverse("daily_loss"), "days", limit=1)
+        self.assertEqual([(d["date"], d["total_daily_loss_kwh"]) for d in days],
+                         [("2025-06-02", 3.5), ("2025-06-01", 3.0)])
+
+        data = self.client.get(reverse("daily_loss"), {"location": "Alpha", "from": "2025-06-02"}).json()
+        self.assertEqual([d["total_daily_loss_kwh"] for d in data["days"]], [0.5])
+
+    def test_worst_panels_keyset_pages(self):
+        make_analysis("Gamma", 3, [2.0, 2.0, 2.0])  # ties are ordered by id
+
+        panels = walk_pages(self, reverse("worst_panels"), "panels", limit=2)
+        losses = [p["panel_loss_kwh"] for p in panels]
+        self.assertEqual(losses, sorted(losses, reverse=True))
+        self.assertEqual(len({p["panel_id"] for p in panels}), 7)
+        self.assertNotIn(100.0, losses)
+
+    def test_invalid_parameters(self):
+        self.assertEqual(self.client.get(reverse("worst_panels"), {"cursor": "nope"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("daily_loss"), {"from": "June"}).status_code, 400)
+        self.assertEqual(self.client.get(reverse("fleet_summary"), {"limit": "x"}).status_code, 400)
+
+    def test_cursors_of_the_wrong_shape(self):
+        for name, values in (
+            ("daily_loss", ["zzz"]), ("daily_loss", [{"day": 1}]), ("daily_loss", [None]),
+            ("fleet_summary", [{"a": 1}]), ("fleet_summary", [3]),
+            ("worst_panels", ["x", 1]), ("worst_panels", [1.0]),
+        ):
+            response = self.client.get(reverse(name), {"cursor": analytics.encode_cursor(values)})
+            self.assertEqual(response.status_code, 400, (name, values))
+            self.assertEqual(response.json()["error"], "Invalid cursor")
+
+
+class DailyLossRollupTests(TestCase):
+
+    def test_incremental_rollups_match_a_rebuild(self):
+        make_analysis("Alpha", 1, [1.0, 2.0])
+        make_analysis("Alpha", 1, [0.25], fault="Snow-Covered")
+        old = make_analysis("Beta", 3, [4.0])
+
+        # re-analysis of Beta's image: the old output is subtracted again
+        replacement = make_analysis("Beta", 3, [1.5], fault="Bird-drop", is_latest=False)
+        YOLOOutput.objects.filter(pk=old.pk).update(is_latest=False)
+        YOLOOutput.objects.filter(pk=replacement.pk).update(is_latest=True)
+        rollups.apply_outputs(added_ids=[replacement.id], removed_ids=[old.id])
+
+        self.assertEqual(rollups.differences(), [])
+        self.assertFalse(DailyLossRollup.objects.filter(fault_name="Dusty", location="Beta").exists())
+
+        alpha = DailyLossRollup.objects.get(location="Alpha", fault_name=DailyLossRollup.ALL_FAULTS)
+        self.assertEqual((alpha.images, alpha.daily_loss_kwh), (2, 3.25))
+
+        rows = DailyLossRollup.objects.count()
+        self.assertEqual(rollups.rebuild(), rows)
+        self.assertEqual(rollups.differences(), [])
+
+    def test_check_reports_drift(self):
+        make_analysis("Alpha", 1, [1.0])
+        DailyLossRollup.objects.filter(fault_name="Dusty").update(daily_loss_kwh=5)
+        self.assertEqual(len(rollups.differences()), 1)
+
+
+class AnalyticsQueryCountTests(TestCase):
+    """The number of queries must not grow with the number of rows (no N+1)."""
+
+    def grow(self, n):
+        for i in range(n):
+            make_analysis(f"Site {i:03d}", 1 + i % 28, [1.0 + i, 0.5], fault=["Dusty", "Snow-Covered"][i % 2])
+
+    def assert_constant_queries(self, expected, url, **params):
+        self.grow(2)
+        with self.assertNumQueries(expected):
+            self.client.get(url, params)
+        self.grow(40)
+        with self.assertNumQueries(expected):
+            self.client.get(url, params)
+
+    def test_fleet_summary_queries(self):
+        # totals, loss by fault, one page of sites
+        self.assert_constant_queries(3, reverse("fleet_summary"), limit=100)
+
+    def test_site_summary_queries(self):
+        self.grow(1)
+        with self.assertNumQueries(2):
+            self.client.get(reverse("site_summary", args=["Site 000"]))
+
+    def test_daily_loss_queries(self):
+        self.assert_constant_queries(1, reverse("daily_loss"), limit=100)
+
+    def test_worst_panels_queries(self):
+        # panels with their image, then their faults in one prefetch
+        self.assert_constant_queries(2, reverse("worst_panels"), limit=100)
+
+
+class StartupTests(TestCase):
+
+    def test_management_commands_do_not_import_the_inference_stack(self):
+        _, result = run_probe(CHECK_PROBE % (HEAVY_MODULES,))
+        self.assertEqual(result["heavy"], [])
+
+    def test_liveness_and_readiness(self):
+        self.assertEqual(self.client.get(reverse("healthz")).status_code, 200)
+
+        with override_settings(ENERGY_PRELOAD_MODELS=False):
+            response = self.client.get(reverse("readyz"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["checks"], {"database": True})
+
+        # expected to be preloaded, but this process never loaded them
+        with override_settings(ENERGY_PRELOAD_MODELS=True):
+            response = self.client.get(reverse("readyz"))
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(response.json()["checks"]["models"])
+
+
+class ContentAddressedStorageTests(MediaTestMixin, TestCase):
+
+    def upload(self, data):
+        img = GrayscaleImage(capacity=5, sunlight_hours=5)
+        img.image.save("panel.jpeg", ContentFile(data))
+        return img
+
+    def test_identical_uploads_share_one_blob(self):
+        first, second = self.upload(b"same bytes"), self.upload(b"same bytes")
+        other = self.upload(b"other bytes")
+
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertNotEqual(first.image.name, other.image.name)
+        self.assertTrue(first.image.name.endswith(".jpg"))
+        self.assertEqual(StoredBlob.objects.get(name=first.image.name).refcount, 2)
+
+        first.delete()
+        self.assertEqual(StoredBlob.objects.get(name=second.image.name).refcount, 1)
+        self.assertTrue(blob_storage.exists(second.image.name))
+
+    def test_compact_media_deletes_orphans_only(self):
+        kept = self.upload(b"kept")
+        orphan = self.upload(b"orphan")
+        orphan.delete()
+
+        call_command("compact_media", "--delete-orphans", "--min-age-hours", "0", stdout=io.StringIO())
+
+        self.assertTrue(blob_storage.exists(kept.image.name))
+        self.assertFalse(blob_storage.exists(orphan.image.name))
+        self.assertEqual(list(StoredBlob.objects.values_list("name", flat=True)), [kept.image.name])
+
+    def test_archive_skips_originals_with_renders(self):
+        rng = np.random.default_rng(0)
+        outputs = []
+        for _ in range(2):
+            noise = io.BytesIO()
+            Image.fromarray(rng.integers(0, 256, (96, 128, 3), dtype=np.uint8)).save(noise, "JPEG", quality=95)
+            outputs.append(YOLOOutput.objects.create(
+                input_image=self.upload(noise.getvalue()), detections=[], panel_boxes=[],
+            ))
+        rendered, plain = outputs
+        original = rendered.input_image.image.name
+        self.client.get(reverse("annotated_image", args=[rendered.download_token]), {"size": "preview"})
+
+        call_command("compact_media", "--archive-older-than", "0", stdout=io.StringIO())
+
+        rendered.input_image.refresh_from_db()
+        plain.input_image.refresh_from_db()
+        self.assertEqual(rendered.input_image.image.name, original)
+        self.assertIsNone(StoredBlob.objects.get(name=original).archived_at)
+        self.assertIsNotNone(StoredBlob.objects.get(name=plain.input_image.image.name).archived_at)
+
+
+class AnnotatedImageDeliveryTests(MediaTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.override(ENERGY_MEDIA_ACCEL="")
+        img = GrayscaleImage(capacity=5, sunlight_hours=5)
+        img.image.save("panel.jpg", ContentFile(jpeg_bytes()))
+        output = YOLOOutput.objects.create(
+            input_image=img, detections=[["Dusty", 0.9, [4, 4, 30, 30]]], panel_boxes=[],
+        )
+        self.url = reverse("annotated_image", args=[output.download_token])
+
+    def test_conditional_and_range_requests(self):
+        response = self.client.get(self.url)
+        body = b"".join(response.streaming_content)
+        self.assertEqual(response["Content-Type"], "image/jpeg")
+        self.assertIn("immutable", response["Cache-Control"])
+
+        with self.assertNumQueries(0):
+            revalidated = self.client.get(self.url, HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEqual(revalidated.status_code, 304)
+
+        partial = self.client.get(self.url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(partial.status_code, 206)
+        self.assertEqual(partial["Content-Range"], f"bytes 10-19/{len(body)}")
+        self.assertEqual(b"".join(partial.streaming_content), body[10:20])
+
+        self.assertEqual(self.client.get(self.url, HTTP_RANGE=f"bytes={len(body)}-").status_code, 416)
+
+    def test_webp_for_clients_that_accept_it(self):
+        response = self.client.get(self.url, {"size": "preview"}, HTTP_ACCEPT="image/webp,*/*")
+        self.assertEqual(response["Content-Type"], "image/webp")
+        self.assertIn("Accept", response["Vary"])
+        self.assertEqual(self.client.get(self.url, {"format": "gif"}).status_code, 400)
+
+
+class BatchArchiveTests(TestCase):
+
+    def test_oversized_members_are_skipped_before_inflating(self):
+        archive = io.BytesIO()
+        with zipfile.ZipFile(archive, "w", zipfile.ZIP_DEFLATED) as zf:
+            zf.writestr("site/a.jpg", b"\xff\xd8\xff" + b"\0" * 997)
+            zf.writestr("bomb.png", b"\0" * 100_000)  # compresses to ~100 bytes
+            zf.writestr("b.jpg", b"\xff\xd8\xff" + b"\0" * 997)
+            zf.writestr("c.jpg", b"\xff\xd8\xff" + b"\0" * 997)
+            zf.writestr("notes.txt", b"ignored")
+        archive.seek(0)
+
+        members = list(iter_zip_images(archive, max_member_bytes=10_000, max_total_bytes=2_500))
+
+        self.assertEqual([name for name, _ in members], ["a.jpg", "bomb.png", "b.jpg", "c.jpg"])
+        self.assertEqual(members[0][1].read(3), b"\xff\xd8\xff")
+        self.assertEqual(members[1][1].reason, "Image is too large")
+        self.assertEqual(members[2][1].size, 1000)
+        self.assertEqual(members[3][1].reason, "Archive is too large")
+
+
+class BatchSiteTests(MediaTestMixin, TestCase):
+
+    def test_failed_chunk_is_reported_per_image(self):
+        uploads = [(name, SimpleUploadedFile(name, jpeg_bytes())) for name in ("a.jpg", "b.jpg")]
+        seen = []
+
+        def analyze_batch(img_objs, prepared_list):
+            seen.append([GrayscaleImage.objects.get(pk=obj.pk).status for obj in img_objs])
+            if len(seen) == 1:
+                raise RuntimeError("model crashed")
+            return [{"summary": {"total_daily_loss_kwh": 1.5}}]
+
+        with mock.patch("Energyapp.batch.analyze_batch", side_effect=analyze_batch), self.assertLogs("Energyapp.batch"):
+            results, site = analyze_site(uploads, "Roof", 5, 4, batch_size=1)
+
+        self.assertEqual(seen, [[GrayscaleImage.STATUS_RUNNING]] * 2)
+        self.assertEqual(results[0]["error"], "Analysis failed")
+        self.assertEqual(results[1]["summary"]["total_daily_loss_kwh"], 1.5)
+        self.assertEqual((site["analysed"], site["failed"], site["total_daily_loss_kwh"]), (1, 1, 1.5))
+
+        failed = GrayscaleImage.objects.get(signature=results[0]["job_id"])
+        self.assertEqual(failed.status, GrayscaleImage.STATUS_FAILED)
+        self.assertIn("model crashed", failed.error)
+
+
+class JobQueueTests(TestCase):
+
+    def test_stale_jobs_are_requeued_until_max_attempts(self):
+        started = datetime(2025, 6, 1, tzinfo=timezone.utc)
+        retry = GrayscaleImage.objects.create(image="uploaded_images/x.jpg", status="running", started_at=started, attempts=1)
+        poison = GrayscaleImage.objects.create(image="uploaded_images/x.jpg", status="running", started_at=started, attempts=3)
+
+        self.assertEqual(requeue_stale_jobs(60, max_attempts=3), (1, 1))
+        retry.refresh_from_db()
+        poison.refresh_from_db()
+        self.assertEqual(retry.status, GrayscaleImage.STATUS_QUEUED)
+        self.assertEqual(poison.status, GrayscaleImage.STATUS_FAILED)
+
+    def test_invalid_energy_inputs(self):
+        for url in (reverse("index"), reverse("job_list"), reverse("batch_analysis")):
+            response = self.client.post(url, {"capacity": "five"})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()["error"], "capacity must be a number")
+
+
+@override_settings(ENERGY_TILED_AUTO_SIDE=50)
+class TiledRoutingTests(MediaTestMixin, TestCase):
+    """Images above ENERGY_TILED_AUTO_SIDE are analysed tile by tile on every path, not only Index."""
+
+    def setUp(self):
+        super().setUp()
+        detect = mock.patch("Energyapp.pipeline.detect_tiled", return_value=(64, 48, [], [[0, 0, 64, 48]]))
+        self.detect_tiled = detect.start()
+        self.addCleanup(detect.stop)
+        self.data = jpeg_bytes()
+
+    def test_queued_oversize_upload_runs_tiled(self):
+        response = self.client.post(reverse("job_list"), {"greyImage": SimpleUploadedFile("site.jpg", self.data)})
+        job = GrayscaleImage.objects.get(signature=response.json()["job_id"])
+        self.assertTrue(job.tiled)
+
+        run_job(job)
+        self.detect_tiled.assert_called_once_with(job)
+        job.refresh_from_db()
+        self.assertEqual(job.status, GrayscaleImage.STATUS_DONE)
+
+    def test_queued_upload_can_opt_out(self):
+        response = self.client.post(
+            reverse("job_list"), {"greyImage": SimpleUploadedFile("site.jpg", self.data), "tiled": "0"}
+        )
+        self.assertFalse(GrayscaleImage.objects.get(signature=response.json()["job_id"]).tiled)
+
+    def test_oversize_batch_image_runs_tiled(self):
+        with mock.patch("Energyapp.batch.analyze_batch") as analyze_batch:
+            results, site = analyze_site([("site.jpg", SimpleUploadedFile("site.jpg", self.data))], "Roof", 5, 4)
+
+        analyze_batch.assert_not_called()
+        self.detect_tiled.assert_called_once()
+        self.assertEqual(site["analysed"], 1)
+        self.assertTrue(GrayscaleImage.objects.get(signature=results[0]["job_id"]).tiled)
+
+
+class EnergyLossEquivalenceTests(TestCase):
+    """compute_energy_loss must give exactly the numbers of the reference loop."""
+
+    LABELS = list(FAULT_LOSS) + ["Unknown"]
+
+    def random_case(self, rng, n_panels, n_faults, w=2000, h=1500):
+        def box():
+            x1, y1 = int(rng.integers(-50, w)), int(rng.integers(-50, h))
+            # some boxes are empty or inverted
+            return [x1, y1, x1 + int(rng.integers(-20, 400)), y1 + int(rng.integers(-20, 400))]
+
+        panels = [box() for _ in range(n_panels)]
+        detections = [
+            (self.LABELS[int(rng.integers(len(self.LABELS)))], round(float(rng.random()), 4), box())
+            for _ in range(n_faults)
+        ]
+        return w, h, detections, panels, float(rng.uniform(1, 50)), float(rng.uniform(1, 10))
+
+    def assertSameLoss(self, case):
+        self.assertEqual(loss.compute_energy_loss(*case), loss.compute_energy_loss_loop(*case))
+
+    def test_random_layouts(self):
+        rng = np.random.default_rng(7)
+        for _ in range(200):
+            self.assertSameLoss(self.random_case(rng, int(rng.integers(0, 30)), int(rng.integers(0, 40))))
+
+    def test_blocked_sweep(self):
+        rng = np.random.default_rng(11)
+        with mock.patch.object(loss, "DENSE_MAX_CELLS", 50):
+            for _ in range(50):
+                self.assertSameLoss(self.random_case(rng, int(rng.integers(10, 80)), int(rng.integers(5, 60))))
+
+    def test_degenerate_inputs(self):
+        self.assertSameLoss((640, 480, [], [], 5, 5))
+        self.assertSameLoss((640, 480, [("Dusty", 0.9, [10, 10, 10, 50])], [[0, 0, 0, 0]], 5, 5))
+        self.assertSameLoss((640, 480, [("Snow-Covered", 0.5, [0, 0, 640, 480])], [], 5, 5))
+
+
+class RescoreTests(MediaTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        img = GrayscaleImage.objects.create(image="uploaded_images/x.jpg", location="Roof", capacity=5, sunlight_hours=4)
+        detections = [("Dusty", 0.9, [0, 0, 50, 100]), ("Snow-Covered", 0.7, [100, 0, 200, 50])]
+        panels = [[0, 0, 100, 100], [100, 0, 200, 100]]
+        payload = finish_analysis(img, 200, 100, detections, panels)
+        self.output = YOLOOutput.objects.get(download_token=payload["download_token"])
+        self.url = reverse("rescore", args=[self.output.download_token])
+
+    def rescore(self, body, **kwargs):
+        return self.client.post(self.url, json.dumps(body), content_type="application/json", **kwargs)
+
+    def test_original_inputs_reproduce_the_stored_totals(self):
+        data = self.rescore({}).json()
+        self.assertEqual(data["summary"]["total_daily_loss_kwh"], self.output.total_daily_loss_kwh)
+        self.assertEqual(data["summary"]["overall_loss_percentage"], self.output.loss_percentage)
+        self.assertEqual(data["summary"]["total_panels"], self.output.total_panels)
+
+    def test_json_and_form_bodies(self):
+        doubled = self.rescore({"capacity": 10, "loss_table": {"Dusty": 0.24, "Snow-Covered": 0.56}}).json()
+        self.assertAlmostEqual(doubled["summary"]["total_daily_loss_kwh"], 4 * self.output.total_daily_loss_kwh, 2)
+
+        form = self.client.post(self.url, {"sunHours": "8", "loss_table": json.dumps({"Dusty": 0})}).json()
+        self.assertEqual(form["summary"]["sunlight_hours"], 8)
+        self.assertEqual(form["loss_table"]["Dusty"], 0)
+        self.assertEqual(form["panel_analysis"][0]["panel_loss_kwh"], 0)
+
+    def test_invalid_requests(self):
+        for body in ({"capacity": "lots"}, {"loss_table": {"Dusty": 2}}, {"loss_table": [1]}, [], "text"):
+            self.assertEqual(self.rescore(body).status_code, 400, body)
+        response = self.client.post(self.url, b"{", content_type="application/json")
+        self.assertEqual(response.status_code, 400)
+
+    def test_missing_non_finite_and_non_positive_inputs(self):
+        for value in (None, "nan", "inf", "-inf", 0, -2):
+            for field in ("capacity", "sunHours"):
+                response = self.rescore({field: value})
+                self.assertEqual(response.status_code, 400, (field, value))
+                self.assertIn(field, response.json()["error"])
+        self.assertEqual(self.client.post(self.url, {"capacity": "NaN"}).status_code, 400)
+
+    def test_outputs_without_stored_detections(self):
+        YOLOOutput.objects.filter(pk=self.output.pk).update(detections=None)
+        self.assertEqual(self.rescore({}).status_code, 409)
+
+
+@override_settings(ENERGY_RESULT_CACHE_MAX_ENTRIES=2)
+class ResultCacheTests(MediaTestMixin, TestCase):
+
+    model_version = "v1"
+
+    def setUp(self):
+        super().setUp()
+        self.cache = ResultCache()
+
+    def put(self, content_hash):
+        img = GrayscaleImage(capacity=5, sunlight_hours=5)
+        img.image.save(f"{content_hash}.jpg", ContentFile(content_hash.encode()))
+        self.cache.put(content_hash, img, 640, 480, [("Dusty", 0.9, [1, 2, 3, 4])], [[0, 0, 640, 480]])
+
+    def test_hit(self):
+        self.put("a")
+        entry = self.cache.get("a")
+        self.assertEqual(entry.as_analysis(), (640, 480, [("Dusty", 0.9, [1, 2, 3, 4])], [[0, 0, 640, 480]]))
+        self.assertEqual(DetectionCache.objects.get().hits, 1)
+        self.assertIsNone(self.cache.get("a", mode="tiled"))
+
+    def test_miss_after_model_or_threshold_change(self):
+        self.put("a")
+        with mock.patch.object(engine, "_model_version", "v2"):
+            self.assertIsNone(self.cache.get("a"))
+        with mock.patch("Energyapp.pipeline.BEST_CONF", 0.5):
+            self.assertIsNone(self.cache.get("a"))
+        with override_settings(ENERGY_CASCADE_ORDER=["snow", "best"]):
+            self.assertIsNone(self.cache.get("a"))
+        self.assertIsNotNone(self.cache.get("a"))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.put("a")
+        self.put("b")
+        DetectionCache.objects.filter(content_hash="a").update(last_used_at=datetime(2030, 1, 1, tzinfo=timezone.utc))
+        self.put("c")
+        self.assertEqual(sorted(DetectionCache.objects.values_list("content_hash", flat=True)), ["a", "c"])
+
+    def test_entries_of_replaced_models_are_purged(self):
+        self.put("a")
+        self.version.stop()
+        with mock.patch.object(engine, "_model_version", "v2"):
+            self.put("b")
+        self.assertEqual(list(DetectionCache.objects.values_list("model_version", flat=True)), ["v2"])
+
+    def test_entry_of_a_deleted_upload_is_dropped(self):
+        self.put("a")
+        blob_storage.delete(DetectionCache.objects.get().image)
+        self.assertIsNone(self.cache.get("a"))
+        self.assertFalse(DetectionCache.objects.exists())
+
+
+class StreamingUploadTests(MediaTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.upload_dir = self.temp_dir()
+        self.override(
+            FILE_UPLOAD_TEMP_DIR=self.upload_dir, ENERGY_MAX_UPLOAD_BYTES=300_000,
+            ENERGY_ADMISSION_SLOTS=1, ENERGY_ADMISSION_QUEUE=0,
+        )
+
+    def upload(self, data, name="panel.jpg"):
+        return self.client.post(reverse("index"), {"greyImage": SimpleUploadedFile(name, data)})
+
+    def assertRejected(self, response, status):
+        self.assertEqual(response.status_code, status)
+        self.assertEqual(os.listdir(self.upload_dir), [])  # the partial upload was removed
+
+    def test_too_large(self):
+        # by Content-Length, before the body is read
+        self.assertRejected(self.upload(b"\xff\xd8\xff" + b"\0" * 1_400_000), 413)
+        # while streaming: the body fits the form overhead, the image does not
+        self.assertRejected(self.upload(b"\xff\xd8\xff" + b"\0" * 600_000), 413)
+
+    def test_not_an_image(self):
+        self.assertRejected(self.upload(b"%PDF-1.7 not an image at all"), 415)
+        # image magic, but no header PIL can parse within HEADER_LIMIT
+        jpeg_without_frame = b"\xff\xd8" + (b"\xff\xe1\xff\xff" + b"\0" * 65533) * 4
+        with mock.patch("Energyapp.uploads.HEADER_LIMIT", 100_000):
+            self.assertRejected(self.upload(jpeg_without_frame), 415)
+
+    def test_repeat_upload_needs_no_admission_slot(self):
+        data = jpeg_bytes()
+        first = GrayscaleImage(capacity=5, sunlight_hours=5)
+        first.image.save("panel.jpg", ContentFile(data))
+        result_cache.put(hashlib.sha256(data).hexdigest(), first, 64, 48, [], [[0, 0, 64, 48]])
+
+        ticket = admission.acquire()  # the host is busy
+        try:
+            response = self.upload(data)
+        finally:
+            ticket.release()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["summary"]["total_panels"], 1)
+
+
+class AdmissionTests(MediaTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.override(ENERGY_ADMISSION_SLOTS=2, ENERGY_ADMISSION_MEMORY_MB=64, ENERGY_BATCH_SIZE=1)
+
+    def analyse_while_busy(self, **limits):
+        held = admission.acquire(weight=2)
+        try:
+            with override_settings(**limits):
+                return self.client.post(reverse("batch_analysis"), {"images": SimpleUploadedFile("a.jpg", jpeg_bytes())})
+        finally:
+            held.release()
+
+    def test_full_queue_is_turned_away_at_once(self):
+        response = self.analyse_while_busy(ENERGY_ADMISSION_QUEUE=0)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreaterEqual(int(response["Retry-After"]), 1)
+
+    def test_queued_request_gives_up_after_max_wait(self):
+        response = self.analyse_while_busy(ENERGY_ADMISSION_QUEUE=4, ENERGY_ADMISSION_MAX_WAIT_S=0.05)
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response["Retry-After"]), 1)
+
+    def test_weight_above_the_slots_is_capped(self):
+        self.assertEqual(admission.weight((100, 100)), 1)
+        self.assertEqual(admission.weight((20_000, 20_000)), 2)
+        ticket = admission.acquire(admission.weight((20_000, 20_000)), max_wait=0.1)
+        self.assertEqual(ticket.weight, 2)
+        ticket.release()
+        admission.acquire(admission.weight((20_000, 20_000)), max_wait=0.1).release()  # slots were freed
+
+
+class PreparedImageTests(TestCase):
+
+    def test_results_placeholder_holds_no_pixels(self):
+        prepared = PreparedImage(np.zeros((480, 1000, 3), dtype=np.uint8))
+        self.assertEqual(prepared.placeholder.shape, (480, 1000, 3))
+        self.assertEqual(prepared.placeholder.strides[:2], (0, 0))  # one pixel, broadcast
+        self.assertEqual(prepared.boxed.shape, (640, 640, 3))
+
+
+class TilingTests(TestCase):
+
+    def test_windows_cover_the_image_with_overlap(self):
+        for width, height in ((3000, 2000), (1280, 1280), (1300, 900), (500, 400)):
+            windows = tile_windows(width, height, size=1280, overlap=160)
+            covered = np.zeros((height, width), dtype=bool)
+            for x0, y0, x1, y1 in windows:
+                self.assertTrue(0 <= x0 < x1 <= width and 0 <= y0 < y1 <= height)
+                self.assertEqual((x1 - x0, y1 - y0), (min(1280, width), min(1280, height)))
+                covered[y0:y1, x0:x1] = True
+            self.assertTrue(covered.all(), (width, height))
+
+            # neighbours share at least the overlap, also the tile shifted in at the edge
+            xs = sorted({x0 for x0, _, _, _ in windows})
+            for left, right in zip(xs, xs[1:]):
+                self.assertGreaterEqual(left + 1280 - right, 160)
+
+    def test_box_cut_by_a_tile_border_is_merged(self):
+        boxes = [
+            [1150, 100, 1280, 200],  # left tile: object cut at x=1280
+            [1150, 100, 1350, 200],  # right tile (starts at 1120): the whole object
+            [1160, 110, 1340, 190],  # same place, other fault type
+            [2000, 100, 2100, 200],  # elsewhere
+        ]
+        keep = merge_boxes(boxes, [0.6, 0.9, 0.5, 0.7], ["Dusty", "Dusty", "Snow-Covered", "Dusty"])
+        self.assertEqual(keep, [1, 3, 2])
+
+
+class PanelLayoutRegistrationTests(TestCase):
+
+    def scene(self, seed):
+        """A smooth random 'site' larger than a fingerprint, so shifted crops share content."""
+        rng = np.random.default_rng(seed)
+        noise = Image.fromarray(rng.integers(0, 256, (40, 40), dtype=np.uint8))
+        return np.asarray(noise.resize((160, 160), Image.BICUBIC), dtype=np.float32)
+
+    def crop(self, scene, x, y):
+        fp = scene[y:y + FINGERPRINT_SIZE, x:x + FINGERPRINT_SIZE].copy()
+        fp -= fp.mean()
+        return fp / (fp.std() + 1e-6)
+
+    def test_shifted_frame_registers(self):
+        scene = self.scene(1)
+        reference = self.crop(scene, 10, 10)
+        # the site appears 3 px further right and 5 px further down in the new frame
+        dx, dy, score = register(reference, self.crop(scene, 7, 5))
+        self.assertAlmostEqual(dx, 3, delta=1)
+        self.assertAlmostEqual(dy, 5, delta=1)
+        self.assertGreaterEqual(score, settings.ENERGY_LAYOUT_MIN_CORRELATION)
+
+    def test_unrelated_frame_scores_low(self):
+        reference = self.crop(self.scene(1), 10, 10)
+        _, _, score = register(reference, self.crop(self.scene(2), 10, 10))
+        self.assertLess(score, settings.ENERGY_LAYOUT_MIN_CORRELATION)
+
+    def test_shift_boxes_clips_and_drops(self):
+        panels = [[10, 10, 50, 50], [90, 20, 120, 60], [5, 5, 15, 15]]
+        self.assertEqual(
+            shift_boxes(panels, -20.4, 10, width=100, height=100),
+            [[0, 20, 29, 60], [69, 30, 99, 70]],
+        )
+
+
+class AnalysisPersistenceTests(MediaTestMixin, TestCase):
+
+    def analysis(self, location):
+        img = GrayscaleImage.objects.create(
+            image="uploaded_images/x.jpg", location=location, capacity=5, sunlight_hours=4,
+            status=GrayscaleImage.STATUS_RUNNING,
+        )
+        detections = [("Dusty", 0.9, [0, 0, 50, 100]), ("Snow-Covered", 0.7, [100, 0, 200, 50])]
+        return img, 200, 100, detections, [[0, 0, 100, 100], [100, 0, 200, 100]]
+
+    def test_persistence_counts_match_the_rows(self):
+        analyses = [self.analysis("Roof"), self.analysis("Barn")]
+        payloads = finish_analyses(analyses)
+
+        for (img, *_), payload in zip(analyses, payloads):
+            output = YOLOOutput.objects.get(download_token=payload["download_token"])
+            panels = PanelAnalysis.objects.filter(yolo_output=output).count()
+            faults = FaultDetail.objects.filter(panel__yolo_output=output).count()
+            counts = payload["persistence"]
+            self.assertEqual((counts["panels_inserted"], counts["faults_inserted"]), (panels, faults))
+            self.assertEqual(counts["rows_inserted"], 1 + panels + faults)
+            self.assertGreater(faults, 0)
+            self.assertGreaterEqual(counts["db_ms"], 0)
+
+            img.refresh_from_db()
+            self.assertEqual(img.status, GrayscaleImage.STATUS_DONE)
+            self.assertEqual(img.result["download_token"], payload["download_token"])
+
+    def test_failed_bulk_write_rolls_back_everything(self):
+        analyses = [self.analysis("Roof"), self.analysis("Barn")]
+        with mock.patch.object(FaultDetail.objects, "bulk_create", side_effect=DatabaseError("disk full")):
+            with self.assertRaises(DatabaseError):
+                finish_analyses(analyses)
+
+        self.assertFalse(YOLOOutput.objects.exists())
+        self.assertFalse(PanelAnalysis.objects.exists())
+        self.assertFalse(DailyLossRollup.objects.exists())
+        self.assertEqual(
+            set(GrayscaleImage.objects.values_list("status", flat=True)), {GrayscaleImage.STATUS_RUNNING}
+        )
+
+    def test_failed_upload_analysis_marks_the_row_failed(self):
+        upload = SimpleUploadedFile("panel.jpg", jpeg_bytes())
+
+        with mock.patch("Energyapp.views.analyze_image", side_effect=RuntimeError("model crashed")):
+            with self.assertRaises(RuntimeError):
+                self.client.post(reverse("index"), {"greyImage": upload})
+
+        img = GrayscaleImage.objects.get()
+        self.assertEqual(img.status, GrayscaleImage.STATUS_FAILED)
+        self.assertIn("model crashed", img.error)
+        self.assertIsNotNone(img.started_at)
+        self.assertIsNotNone(img.finished_at)
+
+
+class MetricsTests(MediaTestMixin, TestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = jpeg_bytes()
+        # a repeat upload: answered from the result cache, no models needed
+        first = GrayscaleImage(capacity=5, sunlight_hours=5)
+        first.image.save("panel.jpg", ContentFile(self.data))
+        detections = [("Dusty", 0.9, [0, 0, 32, 48])]
+        result_cache.put(hashlib.sha256(self.data).hexdigest(), first, 64, 48, detections, [[0, 0, 64, 48]])
+
+    def upload(self):
+        response = self.client.post(reverse("index"), {"greyImage": SimpleUploadedFile("panel.jpg", self.data)})
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_exposition_format(self):
+        analyses = metrics.analyses.value()
+        dusty = metrics.faults.value(fault="Dusty")
+        self.upload()
+
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+        lines = response.content.decode().splitlines()
+
+        self.assertIn("# HELP energy_analyses_total Analyses finished (loss computed and saved).", lines)
+        self.assertIn("# TYPE energy_analyses_total counter", lines)
+        self.assertIn(f"energy_analyses_total {analyses + 1}", lines)
+        self.assertIn(f'energy_faults_total{{fault="Dusty"}} {dusty + 1}', lines)
+        self.assertIn("# TYPE energy_request_duration_seconds histogram", lines)
+        self.assertTrue(any(
+            line.startswith('energy_request_duration_seconds_bucket{view="index",method="POST",status="200",le="+Inf"} ')
+            for line in lines
+        ))
+        sample = re.compile(r'^[a-z_]+(\{([a-z_]+="[^"]*",?)+\})? -?[0-9.e+-]+$')
+        for line in lines:
+            if not line.startswith("#"):
+                self.assertRegex(line, sample)
+
+    def test_server_timing_on_analysis_responses(self):
+        self.assertNotIn("Server-Timing", self.upload())
+
+        with override_settings(ENERGY_SERVER_TIMING=True):
+            header = self.upload()["Server-Timing"]
+        entries = [entry.split(";dur=") for entry in header.split(", ")]
+        names = [name for name, _ in entries]
+        self.assertIn("loss", names)
+        self.assertIn("db_writes", names)
+        self.assertEqual(names[-1], "total")
+        for _, duration in entries:
+            self.assertGreaterEqual(float(duration), 0)
+
+    def test_processes_are_added_up(self):
+        with override_settings(ENERGY_METRICS_DIR=self.temp_dir()):
+            metrics.analyses.inc(3)
+            metrics.stage_seconds.observe(0.2, stage="loss")
+
+            pid = os.fork()
+            if pid == 0:  # a worker: counts from zero and writes its own file
+                try:
+                    metrics.analyses.inc(2)
+                    metrics.stage_seconds.observe(0.2, stage="loss")
+                    metrics.store.flush()
+                finally:
+                    os._exit(0)
+            os.waitpid(pid, 0)
+
+            merged = {metric.name: metric for metric in metrics.store.collect()}
+            lines = metrics.render().splitlines()
+        self.assertIn(f"energy_analyses_total {metrics.analyses.value() + 2}", lines)
+        self.assertEqual(merged["energy_analyses_total"].value(), metrics.analyses.value() + 2)
+        self.assertEqual(
+            merged["energy_stage_duration_seconds"].count(stage="loss"),
+            metrics.stage_seconds.count(stage="loss") + 1,
+        )
+
+    def test_server_timing_names_are_tokens(self):
+        self.assertEqual(server_timing({"model:best": 1.234}, 5), "model.best;dur=1.2, total;dur=5.0")
+
+
+class MicroBatcherTests(TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def run_batch(self, items):
+        self.calls.append(list(items))
+        return [item * 10 for item in items]
+
+    def test_concurrent_submits_share_one_call_up_to_max_batch(self):
+        batcher = MicroBatcher("test", self.run_batch, window_ms=5000, max_batch=4)
+        start = threading.Barrier(4)
+
+        def submit(item):
+            start.wait()
+            return batcher.submit(item).result(timeout=2)
+
+        with ThreadPoolExecutor(4) as pool:
+            results = list(pool.map(submit, range(4)))
+
+        # the window is 5 s: a prompt answer means the full batch closed it
+        self.assertEqual(results, [0, 10, 20, 30])
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(sorted(self.calls[0]), [0, 1, 2, 3])
+
+        futures = [batcher.submit(item) for item in range(4, 12)]
+        self.assertEqual([f.result(timeout=2) for f in futures], list(range(40, 120, 10)))
+        self.assertEqual(self.calls[1:], [[4, 5, 6, 7], [8, 9, 10, 11]])
+
+    def test_window_flushes_a_partial_batch(self):
+        batcher = MicroBatcher("test", self.run_batch, window_ms=50, max_batch=8)
+        started = time.perf_counter()
+        futures = [batcher.submit(1), batcher.submit(2)]
+        self.assertEqual([f.result(timeout=2) for f in futures], [10, 20])
+        self.assertGreaterEqual(time.perf_counter() - started, 0.05)
+        self.assertEqual(self.calls, [[1, 2]])
+        self.assertEqual(batcher.stats()["batch_size_histogram"], {"2": 1})
+
+    def test_failure_reaches_every_waiter(self):
+        def run_batch(items):
+            raise RuntimeError("CUDA out of memory")
+
+        batcher = MicroBatcher("test", run_batch, window_ms=5000, max_batch=3)
+        futures = [batcher.submit(item) for item in range(3)]
+        for future in futures:
+            with self.assertRaisesRegex(RuntimeError, "CUDA out of memory"):
+                future.result(timeout=2)
+
+    @override_settings(ENERGY_MICROBATCH_WINDOW_MS=100, ENERGY_MICROBATCH_MAX_SIZE=8)
+    def test_one_queue_per_model_and_confidence(self):
+        def predict_batch(key, items, conf):
+            self.calls.append((key, conf, sorted(items)))
+            return [f"{key}@{conf}:{item}" for item in items]
+
+        with mock.patch.object(engine, "_batchers", {}), mock.patch.object(engine, "predict_batch", predict_batch):
+            requests = [("best", 1, 0.25), ("snow", 2, 0.2), ("best", 3, 0.25), ("best", 4, 0.5)]
+            with ThreadPoolExecutor(len(requests)) as pool:
+                results = list(pool.map(lambda r: engine.predict(r[0], r[1], r[2]), requests))
+
+        self.assertEqual(results, ["best@0.25:1", "snow@0.2:2", "best@0.25:3", "best@0.5:4"])
+        self.assertEqual(
+            sorted(self.calls), [("best", 0.25, [1, 3]), ("best", 0.5, [4]), ("snow", 0.2, [2])]
+        )
+
+
+class FaultCascadeTests(TestCase):
+    """run_fault_cascade_batch with stub models: which detector sees which image, in which order."""
+
+    # what each detector finds on each test image
+    FINDINGS = {
+        ("best", "dusty"): ["dusty"],
+        ("best", "clean"): ["clean"],
+        ("snow", "clean"): ["snow"],
+        ("snow", "snowy"): ["snow"],
+    }
+    NAMES = {0: "clean", 1: "dusty", 2: "snow"}
+
+    def setUp(self):
+        self.calls = []
+        for name, fake in (("predict_batch", self.predict_batch), ("classify", self.classify)):
+            patcher = mock.patch.object(engine, name, fake)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def predict_batch(self, key, images, conf):
+        self.calls.append((key, list(images)))
+        ids = {label: i for i, label in self.NAMES.items()}
+        return [
+            SimpleNamespace(names=self.NAMES, boxes=[
+                SimpleNamespace(cls=[ids[label]], conf=[0.9], xyxy=[np.array([0, 0, 10, 10])])
+                for label in self.FINDINGS.get((key, image), [])
+            ])
+            for image in images
+        ]
+
+    def classify(self, key, images):
+        self.calls.append((key, list(images)))
+        verdicts = {"snowy": ("snow", 0.95), "clean": ("clean", 0.9), "dusty": ("snow", 0.5)}
+        names = ["clean", "snow"]
+        return [
+            SimpleNamespace(names=names, probs=SimpleNamespace(
+                top1=names.index(verdicts[image][0]), top1conf=verdicts[image][1],
+            ))
+            for image in images
+        ]
+
+    def labels(self, outcomes):
+        return [[lbl for lbl, _, _ in detections] for detections, _ in outcomes]
+
+    def test_later_detector_only_sees_images_without_a_meaningful_fault(self):
+        fallbacks = metrics.cascade_fallbacks.value(detector="snow")
+        outcomes = run_fault_cascade_batch(["dusty", "clean", "snowy"])
+
+        self.assertEqual(self.calls, [("best", ["dusty", "clean", "snowy"]), ("snow", ["clean", "snowy"])])
+        self.assertEqual(self.labels(outcomes), [["Dusty"], ["Snow-Covered"], ["Snow-Covered"]])
+        self.assertEqual(metrics.cascade_fallbacks.value(detector="snow"), fallbacks + 2)
+
+    @override_settings(
+        ENERGY_CASCADE_ORDER=["snow", "best"], ENERGY_CASCADE_IGNORE_LABELS=["Non-Defective", "Snow-Covered"],
+    )
+    def test_configured_order_and_ignore_labels(self):
+        outcomes = run_fault_cascade_batch(["dusty", "snowy"])
+
+        # snow cover is not a fault here, so "snowy" goes on to best (which finds nothing)
+        self.assertEqual(self.calls, [("snow", ["dusty", "snowy"]), ("best", ["dusty", "snowy"])])
+        self.assertEqual(self.labels(outcomes), [["Dusty"], []])
+
+    @override_settings(
+        ENERGY_CASCADE_GATE_MODEL="gate.pt", ENERGY_CASCADE_GATE_ROUTES={"snow": "snow", "clean": "none"},
+        ENERGY_CASCADE_GATE_MIN_CONF=0.8,
+    )
+    def test_gate_routes_skips_and_falls_back(self):
+        outcomes = run_fault_cascade_batch(["snowy", "clean", "dusty"])
+
+        self.assertEqual(self.calls, [
+            ("gate", ["snowy", "clean", "dusty"]),
+            ("snow", ["snowy"]),  # sure it is snow: the snow model first, and it finds it
+            ("best", ["dusty"]),  # the gate is unsure: the configured order
+        ])
+        self.assertEqual(self.labels(outcomes), [["Snow-Covered"], [], ["Dusty"]])
+        self.assertIsNone(outcomes[1][1])  # confidently clean: no detector ran
+
+    def test_plan(self):
+        rules = CascadeRules(order=["best", "snow"], gate=True, routes={"snow": "snow", "clean": "none"})
+        self.assertEqual(rules.plan("snow", 0.9), ["snow", "best"])
+        self.assertEqual(rules.plan("clean", 0.9), [])
+        self.assertEqual(rules.plan("snow", 0.5), ["best", "snow"])
+        self.assertEqual(rules.plan("bird", 0.99), ["best", "snow"])
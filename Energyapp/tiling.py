@@ -0,0 +1,221 @@
+import logging
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from . import metrics
+from .inference import engine
+from .preprocess import MODEL_INPUT_SIZE, PreparedImage
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 1280
+TILE_OVERLAP = 160
+# boxes of the same class covering this much of the smaller one are merged
+MERGE_THRESHOLD = 0.6
+
+
+# =====================================================
+# Windowed raster readers
+# =====================================================
+class MemmapRaster:
+    """
+    Uncompressed RGB rasters (plain TIFF, PPM, ...) are memory-mapped, so a
+    window read only touches the pages of that window and peak memory is
+    bounded by the tile size, not the image size.
+    """
+
+    def __init__(self, path, size, offset):
+        self.width, self.height = size
+        self._data = np.memmap(path, dtype=np.uint8, mode="r", offset=offset,
+                               shape=(self.height, self.width, 3))
+
+    def read(self, x0, y0, x1, y1):
+        return np.array(self._data[y0:y1, x0:x1])
+
+    def overview(self, max_side=MODEL_INPUT_SIZE):
+        return _overview(self._data, max_side)
+
+    def close(self):
+        del self._data
+
+
+class DecodedRaster:
+    """
+    Compressed formats (JPEG, PNG, compressed TIFF) cannot be decoded
+    window by window with PIL, so they are decoded once; tiles are then
+    views into that single array and never copied as a whole.
+    """
+
+    def __init__(self, file_obj):
+        with Image.open(file_obj) as im:
+            im = ImageOps.exif_transpose(im)
+            self._data = np.asarray(im.convert("RGB"))
+        self.height, self.width = self._data.shape[:2]
+
+    def read(self, x0, y0, x1, y1):
+        return self._data[y0:y1, x0:x1]
+
+    def overview(self, max_side=MODEL_INPUT_SIZE):
+        return _overview(self._data, max_side)
+
+    def close(self):
+        del self._data
+
+
+def _overview(data, max_side):
+    """Whole image, subsampled to about `max_side` (what the gate classifier sees)."""
+    step = max(1, max(data.shape[:2]) // max_side)
+    return np.ascontiguousarray(data[::step, ::step])
+
+
+def _raw_rgb_offset(im):
+    """File offset of the pixel data if it is packed, top-down RGB rows, else None."""
+    if im.mode != "RGB" or len(im.tile) != 1:
+        return None
+
+    tile = im.tile[0]
+    args = tile.args if isinstance(tile.args, tuple) else (tile.args,)
+    if (
+        tile.codec_name != "raw"
+        or tile.extents != (0, 0) + im.size
+        or args[:3] not in (("RGB", 0, 1), ("RGB", 0), ("RGB",))
+    ):
+        return None
+
+    # checked last: for some formats getexif() has to load the whole image
+    if im.getexif().get(0x0112, 1) != 1:
+        return None
+    return tile.offset
+
+
+def is_windowed(file_obj):
+    """True when open_raster() memory-maps this file instead of decoding it whole."""
+    try:
+        with Image.open(file_obj) as im:
+            return _raw_rgb_offset(im) is not None
+    finally:
+        file_obj.seek(0)
+
+
+def open_raster(path=None, file_obj=None):
+    """Picks the cheapest reader for the stored upload."""
+    if path is not None:
+        with Image.open(path) as im:
+            offset, size = _raw_rgb_offset(im), im.size
+        if offset is not None:
+            return MemmapRaster(path, size, offset)
+        return DecodedRaster(path)
+    return DecodedRaster(file_obj)
+
+
+def tile_windows(width, height, size=TILE_SIZE, overlap=TILE_OVERLAP):
+    """Overlapping (x0, y0, x1, y1) windows covering the image; edge tiles are shifted inwards."""
+    step = max(1, size - overlap)
+
+    def starts(length):
+        if length <= size:
+            return [0]
+        points = list(range(0, length - size, step))
+        points.append(length - size)
+        return points
+
+    return [
+        (x0, y0, min(x0 + size, width), min(y0 + size, height))
+        for y0 in starts(height)
+        for x0 in starts(width)
+    ]
+
+
+# =====================================================
+# Merging boxes across tile borders
+# =====================================================
+def merge_boxes(boxes, scores, labels, threshold=MERGE_THRESHOLD):
+    """
+    Greedy NMS per label using intersection over the *smaller* box, so both
+    the duplicates from overlapping tiles and the fragments of an object cut
+    by a tile border are dropped in favour of the most confident box.
+    Returns the indices to keep, highest confidence first.
+    """
+    if not len(boxes):
+        return []
+
+    boxes = np.asarray(boxes, dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64)
+    labels = np.asarray(labels)
+    areas = np.maximum(0, boxes[:, 2] - boxes[:, 0]) * np.maximum(0, boxes[:, 3] - boxes[:, 1])
+
+    keep = []
+    for label in np.unique(labels):
+        idx = np.nonzero(labels == label)[0]
+        idx = idx[np.argsort(-scores[idx], kind="stable")]
+
+        while len(idx):
+            best, rest = idx[0], idx[1:]
+            keep.append(int(best))
+
+            iw = np.minimum(boxes[best, 2], boxes[rest, 2]) - np.maximum(boxes[best, 0], boxes[rest, 0])
+            ih = np.minimum(boxes[best, 3], boxes[rest, 3]) - np.maximum(boxes[best, 1], boxes[rest, 1])
+            inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+            smaller = np.maximum(np.minimum(areas[best], areas[rest]), 1)
+            idx = rest[inter / smaller < threshold]
+
+    return sorted(keep, key=lambda i: -scores[i])
+
+
+# =====================================================
+# Tiled detection for large orthomosaics
+# =====================================================
+def _detect_over_tiles(raster, windows, key, conf, batch_size, normalize):
+    """Runs one model over all windows; returns [(label, conf, [x1, y1, x2, y2]), ...] in image coordinates."""
+    found = []
+    for start in range(0, len(windows), batch_size):
+        batch = windows[start:start + batch_size]
+        prepared = [PreparedImage(raster.read(*window)) for window in batch]
+
+        for (x0, y0, _, _), res in zip(batch, engine.predict_batch(key, prepared, conf)):
+            for b in res.boxes:
+                x1, y1, x2, y2 = b.xyxy[0].tolist()
+                found.append((
+                    normalize(res.names[int(b.cls[0])]),
+                    float(b.conf[0]),
+                    [int(x1) + x0, int(y1) + y0, int(x2) + x0, int(y2) + y0],
+                ))
+        del prepared
+    return found
+
+
+def _merged(found):
+    keep = merge_boxes([box for _, _, box in found], [c for _, c, _ in found], [lbl for lbl, _, _ in found])
+    return [found[i] for i in keep]
+
+
+def run_tiled_detection(raster, confs, normalize, rules, tile_size=TILE_SIZE,
+                        overlap=TILE_OVERLAP, batch_size=8):
+    """
+    Same cascade as the full-image pipeline (cascade.CascadeRules), applied
+    tile by tile: the gate classifier, when configured, looks at a
+    downscaled overview of the whole image; each detector of the plan then
+    runs on every tile until one finds a meaningful fault anywhere. Panel
+    detection runs on every tile. Returns (width, height, detections, panel boxes).
+    """
+    windows = tile_windows(raster.width, raster.height, tile_size, overlap)
+    logger.info("Tiled detection: %dx%d image, %d tiles", raster.width, raster.height, len(windows))
+
+    with engine.analysis_slot():
+        plan = rules.plan()
+        if rules.gate:
+            res = engine.classify("gate", [PreparedImage(raster.overview())])[0]
+            plan = rules.plan(res.names[res.probs.top1], float(res.probs.top1conf))
+
+        detections = []
+        for step, key in enumerate(plan):
+            if step:
+                metrics.cascade_fallbacks.inc(detector=key)
+            detections = _merged(_detect_over_tiles(raster, windows, key, confs[key], batch_size, normalize))
+            if rules.is_meaningful(detections):
+                break
+
+        panels = _merged(_detect_over_tiles(raster, windows, "panel", confs["panel"], batch_size, normalize))
+
+    return raster.width, raster.height, detections, [box for _, _, box in panels]
@@ -0,0 +1,154 @@
+import hashlib
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile
+from django.core.files.uploadhandler import FileUploadHandler, StopFutureHandlers, StopUpload
+from PIL import Image, ImageFile
+
+# leading bytes of the image formats the pipeline accepts
+MAGIC_BYTES = (
+    b"\xff\xd8\xff",          # JPEG
+    b"\x89PNG\r\n\x1a\n",     # PNG
+    b"BM",                    # BMP
+    b"II*\x00", b"MM\x00*",   # TIFF
+    b"GIF87a", b"GIF89a",
+)
+MAGIC_LENGTH = 12
+
+# give up on an upload whose image header is not parsed after this many bytes
+HEADER_LIMIT = 4 << 20
+
+# multipart boundaries and the other form fields on top of the image itself
+FORM_OVERHEAD = 1 << 20
+
+
+def looks_like_image(head):
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return True
+    return head.startswith(MAGIC_BYTES)
+
+
+class StreamedImageUpload(TemporaryUploadedFile):
+    """
+    An image upload that was written to disk and hashed while it arrived.
+    The temporary file lives under FILE_UPLOAD_TEMP_DIR, inside MEDIA_ROOT,
+    so saving it is a rename.
+    """
+    sha256 = None
+    image_size = None  # (width, height) from the header
+
+
+# =====================================================
+# Upload handler for the analysis endpoints
+# =====================================================
+class StreamingImageUploadHandler(FileUploadHandler):
+    """
+    Streams one image field chunk by chunk into a temporary file, a sha256
+    and PIL's incremental header parser. Oversized or non-image payloads stop
+    the upload at the first chunk that gives them away; the reason is left on
+    `request.upload_rejection` as (status, message).
+    Only a chunk (plus at most HEADER_LIMIT bytes until the header is parsed)
+    is held in memory. Nothing is decoded here: the view looks up the result
+    cache by the sha256 first, and only a miss is admitted and decoded.
+    """
+    chunk_size = 256 * 1024
+
+    def __init__(self, request, field_name="greyImage"):
+        super().__init__(request)
+        self.target_field = field_name
+        self.max_bytes = settings.ENERGY_MAX_UPLOAD_BYTES
+        self.active = False
+
+    def new_file(self, field_name, *args, **kwargs):
+        super().new_file(field_name, *args, **kwargs)
+        self.active = field_name == self.target_field
+        if not self.active:
+            return  # other fields go to Django's default handlers
+
+        if self.content_length and self.content_length > self.max_bytes:
+            self.reject(413, "Uploaded image is too large")
+
+        self.file = StreamedImageUpload(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
+        self.digest = hashlib.sha256()
+        self.parser = ImageFile.Parser()
+        self.head = b""
+        raise StopFutureHandlers()
+
+    def receive_data_chunk(self, raw_data, start):
+        if not self.active:
+            return raw_data
+
+        if start + len(raw_data) > self.max_bytes:
+            self.reject(413, "Uploaded image is too large")
+
+        if len(self.head) < MAGIC_LENGTH:
+            self.head += raw_data[:MAGIC_LENGTH]
+            if len(self.head) >= MAGIC_LENGTH and not looks_like_image(self.head):
+                self.reject(415, "Uploaded file is not a supported image")
+
+        self.file.write(raw_data)
+        self.digest.update(raw_data)
+        if self.parser is not None:
+            self.feed(raw_data)
+        return None
+
+    def feed(self, data):
+        try:
+            self.parser.feed(data)
+        except Image.DecompressionBombError:
+            self.reject(413, "Uploaded image has too many pixels")
+        except Exception:
+            # broken data: left for the normal decode path to report
+            self.parser = None
+            return
+
+        im = self.parser.image
+        if im is None:
+            if len(self.parser.data or b"") > HEADER_LIMIT:
+                self.reject(415, "Uploaded file is not a supported image")
+            return
+
+        if Image.MAX_IMAGE_PIXELS and im.size[0] * im.size[1] > Image.MAX_IMAGE_PIXELS:
+            self.reject(413, "Uploaded image has too many pixels")
+        self.file.image_size = im.size
+        # header parsed: stop feeding, the parser would buffer the rest of the
+        # payload (JPEG cannot be decoded incrementally by PIL)
+        self.parser = None
+
+    def file_complete(self, file_size):
+        if not self.active:
+            return None
+
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.sha256 = self.digest.hexdigest()
+        self.active = False
+        return self.file
+
+    def upload_interrupted(self):
+        if self.active:
+            self.file.close()
+
+    def reject(self, status, message):
+        self.parser = None
+        self.request.upload_rejection = (status, message)
+        raise StopUpload(connection_reset=False)
+
+
+def receive_image_upload(request, field_name="greyImage", max_request_bytes=None):
+    """
+    Parses a multipart analysis request with the streaming handler (every
+    file of `field_name` goes through it). Must run before anything touches
+    request.POST / request.FILES. The whole body may be `max_request_bytes`
+    (default: one image). Returns (status, message) when the upload was
+    rejected, else None.
+    """
+    if max_request_bytes is None:
+        max_request_bytes = settings.ENERGY_MAX_UPLOAD_BYTES + FORM_OVERHEAD
+    length = int(request.META.get("CONTENT_LENGTH") or 0)
+    if length > max_request_bytes:
+        return 413, "Uploaded image is too large"
+
+    request.upload_handlers.insert(0, StreamingImageUploadHandler(request, field_name))
+    request.FILES  # parses the body
+    return getattr(request, "upload_rejection", None)
@@ -1,6 +1,21 @@
 from django.urls import path
-from .views import Index
+from .views import (
+    Index, JobList, JobDetail, BatchAnalysis, Rescore, AnnotatedImage,
+    FleetSummary, SiteSummary, DailyLoss, WorstPanels, Metrics, Healthz, Readyz,
+)
 
 urlpatterns = [
     path("", Index.as_view(), name="index"),
+    path("batch/", BatchAnalysis.as_view(), name="batch_analysis"),
+    path("jobs/", JobList.as_view(), name="job_list"),
+    path("jobs/<uuid:signature>/", JobDetail.as_view(), name="job_detail"),
+    path("outputs/<uuid:download_token>/annotated/", AnnotatedImage.as_view(), name="annotated_image"),
+    path("outputs/<uuid:download_token>/rescore/", Rescore.as_view(), name="rescore"),
+    path("analytics/fleet/", FleetSummary.as_view(), name="fleet_summary"),
+    path("analytics/sites/<str:location>/", SiteSummary.as_view(), name="site_summary"),
+    path("analytics/daily-loss/", DailyLoss.as_view(), name="daily_loss"),
+    path("analytics/worst-panels/", WorstPanels.as_view(), name="worst_panels"),
+    path("metrics", Metrics.as_view(), name="metrics"),
+    path("healthz", Healthz.as_view(), name="healthz"),
+    path("readyz", Readyz.as_view(), name="readyz"),
 ]
@@ -1,11 +1,8 @@
-from ultralytics import YOLO
 import numpy as np
 from PIL import Image
 
-# Load YOLO models once
-primary_model = YOLO("best.pt")
-snow_model = YOLO("snow.pt")
-panel_model = YOLO("panel_detect.pt")
+from .inference import engine
+from .preprocess import PreparedImage
 
 FAULT_LOSS = {
     "Non-Defective": (0.00, 0.00),
@@ -33,7 +30,9 @@ def normalize_label(raw_label):
 
 def detect_faults(pil_img, conf_thresh=0.4):
     """Runs YOLO fault detection"""
-    res1 = primary_model.predict(pil_img, conf=conf_thresh, verbose=False)[0]
+    prepared = PreparedImage(np.asarray(pil_img.convert("RGB")))
+
+    res1 = engine.predict("best", prepared, conf=conf_thresh)
     dets1 = [(normalize_label(res1.names[int(b.cls[0])]),
               float(b.conf[0]),
               tuple(map(int, b.xyxy[0]))) for b in res1.boxes]
@@ -43,7 +42,7 @@ def detect_faults(pil_img, conf_thresh=0.4):
     if meaningful:
         return dets1, np.asarray(res1.plot()).astype(np.uint8)
 
-    res2 = snow_model.predict(pil_img, conf=conf_thresh, verbose=False)[0]
+    res2 = engine.predict("snow", prepared, conf=conf_thresh)
     dets2 = [(normalize_label(res2.names[int(b.cls[0])]),
               float(b.conf[0]),
               tuple(map(int, b.xyxy[0]))) for b in res2.boxes]
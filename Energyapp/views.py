@@ -1,243 +1,408 @@
-from django.http import JsonResponse
+import json
+import os
+import zipfile
+from datetime import date
+
+from django.conf import settings
+from django.http import HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.views import View
-from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
 from django.views.decorators.csrf import csrf_exempt
+from django.utils import timezone
 from django.utils.decorators import method_decorator
 
-from PIL import Image
-import uuid
-import io
-import os
+from PIL import Image, UnidentifiedImageError
 
-from .models import (
-    GrayscaleImage,
-    YOLOOutput,
-    PanelAnalysis,
-    FaultDetail
-)
-
-# ---------------- ENERGY LOSS CONSTANTS ----------------
-FAULT_LOSS = {
-    "Non-Defective": 0.00,
-    "Dusty": 0.12,
-    "Bird-drop": 0.18,
-    "Snow-Covered": 0.28,
-    "Physical Damage": 0.40,
-    "Electrical-Damage": 0.55,
-}
-
-# ---------------- LABEL NORMALIZATION ----------------
-def normalize(lbl):
-    lbl = lbl.strip().lower()
-    mapping = {
-        "clean": "Non-Defective",
-        "non-defective": "Non-Defective",
-        "dusty": "Dusty",
-        "bird": "Bird-drop",
-        "bird-drop": "Bird-drop",
-        "snow": "Snow-Covered",
-        "physical damage": "Physical Damage",
-        "faulty_solar_panel": "Physical Damage",
-        "electrical-damage": "Electrical-Damage",
-    }
-    return mapping.get(lbl, lbl.title())
-
-
-# ---------------- YOLO LAZY LOADING ----------------
-from ultralytics import YOLO
-
-BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-MODEL_DIR = os.path.join(BASE_DIR, "models")
-
-best_model = None
-snow_model = None
-panel_model = None
+from . import analytics, boot, media, metrics
+from .admission import admission
+from .batch import analyze_site, iter_batch_uploads
+from .cache import hash_upload, result_cache
+from .loss import FAULT_LOSS, compute_energy_loss, parse_loss_table, summarize
+from .models import GrayscaleImage, YOLOOutput
+from .inference import engine
+from .jobs import job_payload
+from .pipeline import analyze_image, finish_analysis, mark_failed, parse_energy_inputs, wants_tiled
+from .preprocess import PreparedImage
+from .render import FORMATS, VARIANTS, get_annotated, variant_name
+from .storage import blob_storage
+from .tiling import is_windowed
+from .uploads import receive_image_upload
 
 
 @method_decorator(csrf_exempt, name='dispatch')
 class Index(View):
 
     def get(self, request):
-        return JsonResponse({"status": "Backend is live"}, status=200)
+        return JsonResponse({"status": "Backend is live", "models": engine.stats()}, status=200)
 
     def post(self, request):
-        global best_model, snow_model, panel_model
-
-        # Load models once
-        if best_model is None:
-            best_model = YOLO(os.path.join(MODEL_DIR, "best.pt"))
-        if snow_model is None:
-            snow_model = YOLO(os.path.join(MODEL_DIR, "snow.pt"))
-        if panel_model is None:
-            panel_model = YOLO(os.path.join(MODEL_DIR, "panel_detect.pt"))
+        # Stream the upload to disk, hash and header parser in one pass
+        rejection = receive_image_upload(request)
+        if rejection is not None:
+            return JsonResponse({"error": rejection[1]}, status=rejection[0])
 
         # User Inputs
-        location = request.POST.get("location", "Home")
-        capacity = float(request.POST.get("capacity", 5))
-        sun_hours = float(request.POST.get("sunHours", 5))
-
-        SYSTEM_CAPACITY = max(capacity, 0.1)
-        SUNLIGHT = max(sun_hours, 0.1)
-        max_energy = SYSTEM_CAPACITY * SUNLIGHT
+        try:
+            location, SYSTEM_CAPACITY, SUNLIGHT = parse_energy_inputs(request.POST)
+        except ValueError as exc:
+            return JsonResponse({"error": str(exc)}, status=400)
 
         # Check image
         if "greyImage" not in request.FILES:
             return JsonResponse({"error": "No image uploaded"}, status=400)
 
         img_file = request.FILES["greyImage"]
+        content_hash = getattr(img_file, "sha256", None) or hash_upload(img_file)
+
+        try:
+            tiled = wants_tiled(img_file, request.POST.get("tiled"))
+        except (UnidentifiedImageError, OSError):
+            return JsonResponse({"error": "Uploaded file is not a valid image"}, status=400)
+        mode = "tiled" if tiled else "full"
+        # calibration uploads refresh the panel layout of the site
+        calibrate = request.POST.get("calibrate", "").lower() in ("1", "true", "yes")
+
+        # ---------- REPEAT UPLOAD: reuse stored file and detections ----------
+        cached = None if calibrate else result_cache.get(content_hash, mode)
+        if cached is not None:
+            blob_storage.retain(cached.image)
+            img_obj = GrayscaleImage.objects.create(
+                image=cached.image,
+                content_hash=content_hash,
+                location=location,
+                capacity=SYSTEM_CAPACITY,
+                sunlight_hours=SUNLIGHT,
+                status=GrayscaleImage.STATUS_RUNNING,
+                started_at=timezone.now(),
+            )
+            return JsonResponse(_run_analysis(img_obj, finish_analysis, *cached.as_analysis()))
+
+        # ---------- ADMISSION (only cache misses need memory and CPU) ----------
+        # tiled mode only holds a batch of tiles when the raster is memory-mapped;
+        # compressed formats are decoded whole first (tiling.DecodedRaster)
+        if tiled and is_windowed(img_file):
+            size = (settings.ENERGY_TILE_SIZE, settings.ENERGY_TILE_SIZE)
+        else:
+            size = getattr(img_file, "image_size", None)
+        admission.admit(request, admission.weight(size))
+
+        # ---------- DECODE ONCE (from the temporary file, still in the page cache) ----------
+        # tiled mode reads windows from the stored file instead
+        prepared = None
+        if not tiled:
+            try:
+                prepared = PreparedImage.from_upload(img_file)
+            except (UnidentifiedImageError, OSError):
+                return JsonResponse({"error": "Uploaded file is not a valid image"}, status=400)
 
         img_obj = GrayscaleImage.objects.create(
             image=img_file,
+            content_hash=content_hash,
             location=location,
             capacity=SYSTEM_CAPACITY,
-            sunlight_hours=SUNLIGHT
+            sunlight_hours=SUNLIGHT,
+            status=GrayscaleImage.STATUS_RUNNING,
+            started_at=timezone.now(),
         )
 
-        img_path = img_obj.image.path
-        pil = Image.open(img_path).convert("RGB")
-        w, h = pil.size
-
-        # ---------- YOLO MAIN DETECTION ----------
-        best_res = best_model.predict(img_path, conf=0.25, verbose=False)[0]
-
-        detections = []
-        for b in best_res.boxes:
-            lbl = normalize(best_res.names[int(b.cls[0])])
-            conf = float(b.conf[0])
-            box = list(map(int, b.xyxy[0].tolist()))
-            detections.append((lbl, conf, box))
-
-        meaningful_fault = any(lbl != "Non-Defective" for lbl, _, _ in detections)
-
-        if not meaningful_fault:
-            snow_res = snow_model.predict(img_path, conf=0.2, verbose=False)[0]
-            detections = []
-            for b in snow_res.boxes:
-                lbl = normalize(snow_res.names[int(b.cls[0])])
-                conf = float(b.conf[0])
-                box = list(map(int, b.xyxy[0].tolist()))
-                detections.append((lbl, conf, box))
-            final_res = snow_res
-        else:
-            final_res = best_res
+        return JsonResponse(_run_analysis(
+            img_obj, analyze_image, prepared,
+            content_hash=content_hash, tiled=tiled, calibrate=calibrate, check_cache=False,
+        ))
+
+
+def _run_analysis(img_obj, analyze, *args, **kwargs):
+    """
+    Runs `analyze(img_obj, ...)` for a row created as running. On failure the
+    row is marked failed before the error propagates (500), so it never stays
+    "running" for the stale-job sweeper to pick up.
+    """
+    try:
+        return analyze(img_obj, *args, **kwargs)
+    except Exception:
+        mark_failed(img_obj)
+        raise
+
+
+# =====================================================
+# Async analyses: POST returns a job id, a worker pool
+# (manage.py run_analysis_workers) runs the pipeline
+# =====================================================
+@method_decorator(csrf_exempt, name='dispatch')
+class JobList(View):
 
-        # ---------- PANEL DETECTION ----------
-        panel_res = panel_model.predict(img_path, conf=0.2, verbose=False)[0]
-        panels = [list(map(int, b.xyxy[0].tolist())) for b in panel_res.boxes]
+    def post(self, request):
+        # the worker does the full decode, only the header is parsed while streaming
+        rejection = receive_image_upload(request)
+        if rejection is not None:
+            return JsonResponse({"error": rejection[1]}, status=rejection[0])
 
-        if not panels:
-            panels = [(0, 0, w, h)]
+        try:
+            location, SYSTEM_CAPACITY, SUNLIGHT = parse_energy_inputs(request.POST)
+        except ValueError as exc:
+            return JsonResponse({"error": str(exc)}, status=400)
 
-        total_daily_loss = 0
-        panel_data = []  # store before saving to DB
+        if "greyImage" not in request.FILES:
+            return JsonResponse({"error": "No image uploaded"}, status=400)
 
-        # ---------- PANEL LOOP ----------
-        for idx, (px1, py1, px2, py2) in enumerate(panels, start=1):
-            pw, ph = px2 - px1, py2 - py1
-            area = max(1, pw * ph)
+        img_file = request.FILES["greyImage"]
 
-            panel_loss = 0
-            fault_records = []
+        if getattr(img_file, "image_size", None) is None:
+            try:
+                with Image.open(img_file) as im:
+                    im.verify()
+            except (UnidentifiedImageError, OSError, SyntaxError):
+                return JsonResponse({"error": "Uploaded file is not a valid image"}, status=400)
+            img_file.seek(0)
 
-            for lbl, conf, (fx1, fy1, fx2, fy2) in detections:
+        job = GrayscaleImage.objects.create(
+            image=img_file,
+            content_hash=getattr(img_file, "sha256", None) or hash_upload(img_file),
+            location=location,
+            capacity=SYSTEM_CAPACITY,
+            sunlight_hours=SUNLIGHT,
+            status=GrayscaleImage.STATUS_QUEUED,
+            tiled=wants_tiled(img_file, request.POST.get("tiled")),
+        )
 
-                ix1 = max(px1, fx1)
-                iy1 = max(py1, fy1)
-                ix2 = min(px2, fx2)
-                iy2 = min(py2, fy2)
+        data = job_payload(job)
+        data["status_url"] = reverse("job_detail", args=[job.signature])
+        return JsonResponse(data, status=202)
 
-                if ix2 > ix1 and iy2 > iy1:
-                    fault_area = (ix2 - ix1) * (iy2 - iy1)
-                    fraction = fault_area / area
-                    loss_fraction = FAULT_LOSS.get(lbl, 0) * fraction
-                    daily_loss = loss_fraction * SYSTEM_CAPACITY * SUNLIGHT
 
-                    fault_records.append({
-                        "fault": lbl,
-                        "confidence": conf,
-                        "affected_area": round(fraction * 100, 2),
-                        "loss_percentage": round(loss_fraction * 100, 2),
-                        "daily_loss": round(daily_loss, 3),
-                    })
+class JobDetail(View):
 
-                    panel_loss += daily_loss
+    def get(self, request, signature):
+        job = get_object_or_404(GrayscaleImage, signature=signature)
+        return JsonResponse(job_payload(job))
 
-            total_daily_loss += panel_loss
 
-            half = len(fault_records) // 2
+# =====================================================
+# Whole-site inspections: many images in one request
+# =====================================================
+@method_decorator(csrf_exempt, name='dispatch')
+class BatchAnalysis(View):
 
-            panel_data.append({
-                "panel_number": idx,
-                "panel_loss": round(panel_loss, 3),
-                "left": fault_records[:half],
-                "right": fault_records[half:]
-            })
+    def post(self, request):
+        # every "images" file is size- and type-checked while it streams in
+        rejection = receive_image_upload(request, "images", settings.ENERGY_BATCH_MAX_UPLOAD_BYTES)
+        if rejection is not None:
+            return JsonResponse({"error": rejection[1]}, status=rejection[0])
+
+        try:
+            location, SYSTEM_CAPACITY, SUNLIGHT = parse_energy_inputs(request.POST)
+        except ValueError as exc:
+            return JsonResponse({"error": str(exc)}, status=400)
+
+        if "images" not in request.FILES and "archive" not in request.FILES:
+            return JsonResponse({"error": "Upload images (multipart 'images') or a ZIP 'archive'"}, status=400)
+
+        # one slot per image of a forward batch
+        admission.admit(request, admission.weight(images=settings.ENERGY_BATCH_SIZE))
+        try:
+            results, site = analyze_site(
+                iter_batch_uploads(request.FILES),
+                location,
+                SYSTEM_CAPACITY,
+                SUNLIGHT,
+                batch_size=settings.ENERGY_BATCH_SIZE,
+                max_images=settings.ENERGY_BATCH_MAX_IMAGES,
+            )
+        except zipfile.BadZipFile:
+            return JsonResponse({"error": "Archive is not a valid ZIP file"}, status=400)
+
+        return JsonResponse({
+            "message": "Site Analysis Completed",
+            "site": site,
+            "results": results,
+        })
+
+
+# =====================================================
+# What-if: re-run only the loss math on stored boxes
+# =====================================================
+@method_decorator(csrf_exempt, name='dispatch')
+class Rescore(View):
+
+    def post(self, request, download_token):
+        output = get_object_or_404(
+            YOLOOutput.objects.select_related("input_image"), download_token=download_token
+        )
+        if output.detections is None or output.panel_boxes is None:
+            return JsonResponse({"error": "This analysis has no stored detections, re-upload the image"}, status=409)
+
+        if request.content_type == "application/json":
+            try:
+                data = json.loads(request.body or b"{}")
+            except ValueError:
+                return JsonResponse({"error": "Invalid JSON body"}, status=400)
+            if not isinstance(data, dict):
+                return JsonResponse({"error": "JSON body must be an object"}, status=400)
+        else:
+            data = request.POST
+
+        img = output.input_image
+        try:
+            _, capacity, sun_hours = parse_energy_inputs(data, img.location, img.capacity, img.sunlight_hours)
+
+            loss_table = data.get("loss_table")
+            if isinstance(loss_table, str):
+                loss_table = json.loads(loss_table)
+            loss_table = parse_loss_table(loss_table) if loss_table is not None else FAULT_LOSS
+        except ValueError as exc:
+            return JsonResponse({"error": str(exc)}, status=400)
+
+        loss = compute_energy_loss(
+            output.image_width,
+            output.image_height,
+            [(lbl, conf, box) for lbl, conf, box in output.detections],
+            output.panel_boxes,
+            capacity,
+            sun_hours,
+            loss_table,
+        )
+        summary, response_panels = summarize(img.location, capacity, sun_hours, loss)
+
+        return JsonResponse({
+            "message": "Energy Loss Re-scored",
+            "download_token": str(output.download_token),
+            "summary": summary,
+            "panel_analysis": response_panels,
+            "loss_table": loss_table,
+        })
 
-        final_energy = max(max_energy - total_daily_loss, 0)
 
-        # ---------- SAVE ANNOTATED IMAGE ----------
-        annotated = final_res.plot()
-        pil_ann = Image.fromarray(annotated)
+# =====================================================
+# Annotated image, rendered on first request
+# =====================================================
+class AnnotatedImage(View):
 
-        buffer = io.BytesIO()
-        pil_ann.save(buffer, format="JPEG")
-        buffer.seek(0)
+    def get(self, request, download_token):
+        variant = request.GET.get("size", "full")
+        if variant not in VARIANTS:
+            return JsonResponse({"error": f"size must be one of {', '.join(VARIANTS)}"}, status=400)
+        fmt, negotiated = media.negotiate(request)
+        if fmt not in FORMATS:
+            return JsonResponse({"error": f"format must be one of {', '.join(FORMATS)}"}, status=400)
 
-        file_name = f"yolo_output_{uuid.uuid4()}.jpg"
-        saved_path = default_storage.save("yolo_outputs/" + file_name, ContentFile(buffer.getvalue()))
+        # browsers and CDNs revalidate with the ETag: no query, no file access
+        tag = media.etag(download_token, variant, fmt)
+        response = media.not_modified(request, tag, negotiated)
+        if response is not None:
+            return response
 
-        # ---------- SAVE YOLO OUTPUT ----------
-        yolo_obj = YOLOOutput.objects.create(
-            input_image=img_obj,
-            image=saved_path,
-            total_panels=len(panels),
-            total_daily_loss_kwh=round(total_daily_loss, 3),
-            loss_percentage=round((total_daily_loss / max_energy) * 100, 2)
+        output = get_object_or_404(
+            YOLOOutput.objects.select_related("input_image"), download_token=download_token
+        )
+        storage, name = get_annotated(output, variant, fmt)
+        return media.serve(
+            request, storage, name, fmt, tag,
+            # the full render is stored under its content hash
+            filename=os.path.basename(variant_name(download_token, variant, fmt)),
+            vary=negotiated,
         )
 
-        # ---------- SAVE PANEL + FAULTS ----------
-        for p in panel_data:
-            panel_rec = PanelAnalysis.objects.create(
-                yolo_output=yolo_obj,
-                panel_number=p["panel_number"],
-                panel_loss_kwh=p["panel_loss"]
-            )
 
-            for f in p["left"] + p["right"]:
-                FaultDetail.objects.create(
-                    panel=panel_rec,
-                    fault_name=f["fault"],
-                    confidence=f["confidence"],
-                    affected_area=f["affected_area"],
-                    loss_percentage=f["loss_percentage"],
-                    daily_loss=f["daily_loss"]
-                )
-
-        # ---------- RESPONSE ----------
-        response_panels = []
-        for p in panel_data:
-            response_panels.append({
-                "panel_number": p["panel_number"],
-                "panel_loss_kwh": p["panel_loss"],
-                "faults_left": p["left"],
-                "faults_right": p["right"],
-            })
+# =====================================================
+# Read API: site and fleet analytics
+# (aggregated in the database, keyset paginated)
+# =====================================================
+def _parse_date(raw, name):
+    if not raw:
+        return None
+    try:
+        return date.fromisoformat(raw)
+    except ValueError:
+        raise ValueError(f"{name} must be a date (YYYY-MM-DD)")
+
+
+class FleetSummary(View):
+
+    def get(self, request):
+        try:
+            limit = analytics.page_size(request.GET.get("limit"))
+            sites, next_cursor = analytics.sites_page(limit, request.GET.get("cursor"))
+        except ValueError as exc:
+            return JsonResponse({"error": str(exc)}, status=400)
 
         return JsonResponse({
-            "message": "Energy Loss Analysis Completed",
-            "summary": {
-                "location": location,
-                "total_panels": len(panels),
-                "system_capacity_kw": SYSTEM_CAPACITY,
-                "sunlight_hours": SUNLIGHT,
-                "max_possible_energy": round(max_energy, 3),
-                "final_energy": round(final_energy, 3),
-                "total_daily_loss_kwh": round(total_daily_loss, 3),
-                "overall_loss_percentage":
-                    round((total_daily_loss / max_energy) * 100, 2),
-            },
-            "panel_analysis": response_panels,
-            "download_url": yolo_obj.image.url,
-            "file_name": file_name
+            "totals": analytics.totals(),
+            "loss_by_fault": analytics.loss_by_fault(),
+            "sites": sites,
+            "next_cursor": next_cursor,
+        })
+
+
+class SiteSummary(View):
+
+    def get(self, request, location):
+        data = analytics.totals(location)
+        if not data["images"]:
+            return JsonResponse({"error": "No analyses for this location"}, status=404)
+
+        return JsonResponse({
+            "location": location,
+            "totals": data,
+            "loss_by_fault": analytics.loss_by_fault(location),
         })
+
+
+class DailyLoss(View):
+
+    def get(self, request):
+        try:
+            limit = analytics.page_size(request.GET.get("limit"))
+            days, next_cursor = analytics.daily_loss_page(
+                limit,
+                request.GET.get("cursor"),
+                location=request.GET.get("location") or None,
+                start=_parse_date(request.GET.get("from"), "from"),
+                end=_parse_date(request.GET.get("to"), "to"),
+            )
+        except ValueError as exc:
+            return JsonResponse({"error": str(exc)}, status=400)
+
+        return JsonResponse({"days": days, "next_cursor": next_cursor})
+
+
+class WorstPanels(View):
+
+    def get(self, request):
+        try:
+            limit = analytics.page_size(request.GET.get("limit"))
+            panels, next_cursor = analytics.worst_panels_page(
+                limit, request.GET.get("cursor"), location=request.GET.get("location") or None
+            )
+        except ValueError as exc:
+            return JsonResponse({"error": str(exc)}, status=400)
+
+        return JsonResponse({"panels": panels, "next_cursor": next_cursor})
+
+
+# =====================================================
+# Prometheus metrics of this worker process
+# =====================================================
+class Metrics(View):
+
+    def get(self, request):
+        return HttpResponse(metrics.render(engine), content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+# =====================================================
+# Liveness / readiness probes (cheap: no models, no torch)
+# =====================================================
+class Healthz(View):
+
+    def get(self, request):
+        return JsonResponse({"status": "alive", "pid": os.getpid()})
+
+
+class Readyz(View):
+
+    def get(self, request):
+        ready, checks = boot.readiness()
+        return JsonResponse(
+            {"status": "ready" if ready else "not ready", "checks": checks, "boot": boot.timings},
+            status=200 if ready else 503,
+        )
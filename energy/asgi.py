@@ -8,9 +8,17 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
 
 import os
+import time
 
-from django.core.asgi import get_asgi_application
+_started = time.perf_counter()
+
+from django.core.asgi import get_asgi_application  # noqa: E402
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'energy.settings')
 
 application = get_asgi_application()
+
+# Only serving processes load the models (not manage.py commands)
+from Energyapp import boot  # noqa: E402
+
+boot.serve(_started)
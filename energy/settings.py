@@ -1,5 +1,6 @@
 from pathlib import Path
 import os
+import tempfile
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -48,6 +49,9 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+
+    "Energyapp.middleware.RequestMetricsMiddleware",
+    "Energyapp.middleware.AdmissionMiddleware",
 ]
 
 ROOT_URLCONF = "energy.urls"
@@ -80,6 +84,15 @@ DATABASES = {
     "default": {
         "ENGINE": "django.db.backends.sqlite3",
         "NAME": BASE_DIR / "db.sqlite3",
+        "OPTIONS": {
+            # several gunicorn/analysis workers write at once: WAL lets readers
+            # run during a write, IMMEDIATE takes the write lock up front
+            # (no deadlocked lock upgrades) and timeout waits for it instead
+            # of failing with "database is locked"
+            "init_command": "PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;",
+            "transaction_mode": "IMMEDIATE",
+            "timeout": 20,
+        },
     }
 }
 
@@ -94,6 +107,9 @@ STATICFILES_STORAGE = "whitenoise.storage.CompressedStaticFilesStorage"
 MEDIA_URL = "/media/"
 MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
+# Uploads are spooled next to MEDIA_ROOT so storing them is a rename, not a copy
+FILE_UPLOAD_TEMP_DIR = os.path.join(MEDIA_ROOT, "tmp")
+
 # =====================================================
 # ✔ CORS + CSRF FOR LOCAL DEVELOPMENT
 # =====================================================
@@ -120,3 +136,110 @@ CORS_ALLOW_ORIGINS_ALL =["*"]
 CORS_ALLOW_METHODS = ["DELETE", "GET", "OPTIONS", "PATCH", "POST", "PUT"]
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
+
+# =====================================================
+# ✔ INFERENCE ENGINE
+# =====================================================
+
+# Load (and fuse) the YOLO models when a serving process starts (wsgi.py / asgi.py)
+# instead of on the first POST; management commands never load them
+ENERGY_PRELOAD_MODELS = os.environ.get("ENERGY_PRELOAD_MODELS", "1") == "1"
+
+# Which model runtime to load: "pt" (PyTorch), "onnx" (ONNX Runtime) or "openvino".
+# Exported files are built with `manage.py export_models`; INT8 picks the quantized ones
+ENERGY_MODEL_FORMAT = os.environ.get("ENERGY_MODEL_FORMAT", "pt")
+ENERGY_MODEL_INT8 = os.environ.get("ENERGY_MODEL_INT8", "0") == "1"
+
+# Skip the dummy warm-up inference at startup (gunicorn.conf.py runs it per worker)
+ENERGY_DEFER_WARMUP = os.environ.get("ENERGY_DEFER_WARMUP", "0") == "1"
+
+# How many analyses one worker process may run inference for at the same time
+ENERGY_MAX_CONCURRENT_ANALYSES = int(os.environ.get("ENERGY_MAX_CONCURRENT_ANALYSES", "1"))
+
+# torch intra-op threads per process (0 = split the cores between concurrent branches)
+ENERGY_TORCH_THREADS = int(os.environ.get("ENERGY_TORCH_THREADS", "0"))
+
+# Fault cascade: detectors tried in order until one finds a fault that is not an
+# ignored label. An optional image classifier (weights in models/, e.g. gate.pt)
+# can route an image straight to one detector ("label:detector", "none" = skip)
+ENERGY_CASCADE_ORDER = [k for k in os.environ.get("ENERGY_CASCADE_ORDER", "best,snow").split(",") if k]
+ENERGY_CASCADE_IGNORE_LABELS = [l for l in os.environ.get("ENERGY_CASCADE_IGNORE_LABELS", "Non-Defective").split(",") if l]
+ENERGY_CASCADE_GATE_MODEL = os.environ.get("ENERGY_CASCADE_GATE_MODEL", "")
+ENERGY_CASCADE_GATE_ROUTES = dict(
+    route.split(":", 1) for route in os.environ.get("ENERGY_CASCADE_GATE_ROUTES", "").split(",") if ":" in route
+)
+ENERGY_CASCADE_GATE_MIN_CONF = float(os.environ.get("ENERGY_CASCADE_GATE_MIN_CONF", "0.8"))
+
+# Micro-batching across concurrent requests (0 = off). Only useful when a worker
+# serves several requests at once (gunicorn --threads / ENERGY_MAX_CONCURRENT_ANALYSES > 1)
+ENERGY_MICROBATCH_WINDOW_MS = float(os.environ.get("ENERGY_MICROBATCH_WINDOW_MS", "0"))
+ENERGY_MICROBATCH_MAX_SIZE = int(os.environ.get("ENERGY_MICROBATCH_MAX_SIZE", "8"))
+
+# Batch endpoint: images per forward pass and images per request
+ENERGY_BATCH_SIZE = int(os.environ.get("ENERGY_BATCH_SIZE", "8"))
+ENERGY_BATCH_MAX_IMAGES = int(os.environ.get("ENERGY_BATCH_MAX_IMAGES", "2000"))
+
+# Result cache for repeat uploads (max rows, LRU evicted; 0 = off)
+ENERGY_RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("ENERGY_RESULT_CACHE_MAX_ENTRIES", "5000"))
+
+# Annotated images are rendered on first download; variants listed here are
+# rendered in the background right after an analysis (thumbnail, preview, full)
+ENERGY_PRERENDER_VARIANTS = [v for v in os.environ.get("ENERGY_PRERENDER_VARIANTS", "").split(",") if v]
+
+# Tiled inference for large orthomosaics ("tiled" POST field, or automatic above this size)
+ENERGY_TILED_AUTO_SIDE = int(os.environ.get("ENERGY_TILED_AUTO_SIDE", "6000"))
+ENERGY_TILE_SIZE = int(os.environ.get("ENERGY_TILE_SIZE", "1280"))
+ENERGY_TILE_OVERLAP = int(os.environ.get("ENERGY_TILE_OVERLAP", "160"))
+
+# Per-site panel layouts (opt-in, for fixed cameras): repeat inspections of a
+# location skip the panel model when the frame registers against the stored one
+# (shift as a fraction of the frame, minimum normalised correlation after alignment).
+# Uploads without an explicit location never use or store a layout.
+ENERGY_PANEL_LAYOUTS = os.environ.get("ENERGY_PANEL_LAYOUTS", "0") == "1"
+ENERGY_LAYOUT_MAX_SHIFT = float(os.environ.get("ENERGY_LAYOUT_MAX_SHIFT", "0.05"))
+ENERGY_LAYOUT_MIN_CORRELATION = float(os.environ.get("ENERGY_LAYOUT_MIN_CORRELATION", "0.8"))
+
+# PIL refuses larger images as decompression bombs; orthomosaics go up to ~20k x 20k
+ENERGY_MAX_IMAGE_PIXELS = int(os.environ.get("ENERGY_MAX_IMAGE_PIXELS", str(20000 * 20000)))
+
+# Largest single image accepted by the analysis endpoints (bytes)
+ENERGY_MAX_UPLOAD_BYTES = int(os.environ.get("ENERGY_MAX_UPLOAD_BYTES", str(50 * 1024 * 1024)))
+
+# Async jobs (POST /jobs/): a job whose worker died this many times is marked failed
+ENERGY_JOB_MAX_ATTEMPTS = int(os.environ.get("ENERGY_JOB_MAX_ATTEMPTS", "3"))
+
+# Largest batch request and largest total uncompressed size of a batch ZIP (bytes)
+ENERGY_BATCH_MAX_UPLOAD_BYTES = int(os.environ.get("ENERGY_BATCH_MAX_UPLOAD_BYTES", str(1024 * 1024 * 1024)))
+
+# Admission control, host-wide (all workers): analyses running at once, requests
+# allowed to wait for a slot and for how long; beyond that 429/503 + Retry-After.
+# Images whose decoded size exceeds MEMORY_MB / SLOTS take several slots (0 slots = off)
+ENERGY_ADMISSION_SLOTS = int(os.environ.get("ENERGY_ADMISSION_SLOTS", str(max(1, (os.cpu_count() or 1) // 2))))
+ENERGY_ADMISSION_QUEUE = int(os.environ.get("ENERGY_ADMISSION_QUEUE", "8"))
+ENERGY_ADMISSION_MAX_WAIT_S = float(os.environ.get("ENERGY_ADMISSION_MAX_WAIT_S", "5"))
+ENERGY_ADMISSION_MEMORY_MB = int(os.environ.get("ENERGY_ADMISSION_MEMORY_MB", "2048"))
+ENERGY_ADMISSION_DIR = os.environ.get(
+    "ENERGY_ADMISSION_DIR", os.path.join(tempfile.gettempdir(), "energyapp-admission")
+)
+
+# Annotated image downloads. ENERGY_MEDIA_ACCEL hands the file to the front-end
+# server so workers never stream bytes: "nginx" (X-Accel-Redirect to
+# ENERGY_MEDIA_ACCEL_PREFIX, an `internal` location aliased to MEDIA_ROOT) or
+# "sendfile" (X-Sendfile, Apache mod_xsendfile). Empty: streamed by Django with
+# Range support. Renders never change for a download token, hence the long max-age.
+ENERGY_MEDIA_ACCEL = os.environ.get("ENERGY_MEDIA_ACCEL", "")
+ENERGY_MEDIA_ACCEL_PREFIX = os.environ.get("ENERGY_MEDIA_ACCEL_PREFIX", "/protected-media/")
+ENERGY_MEDIA_CACHE_CONTROL = os.environ.get("ENERGY_MEDIA_CACHE_CONTROL", "public, max-age=31536000, immutable")
+ENERGY_MEDIA_WEBP = os.environ.get("ENERGY_MEDIA_WEBP", "1") == "1"
+
+# Stage timings are always collected for /metrics; this also sends them to the
+# client as a Server-Timing header (visible in the browser's network panel)
+ENERGY_SERVER_TIMING = os.environ.get("ENERGY_SERVER_TIMING", "0") == "1"
+
+# /metrics covers only the process that answers the scrape unless this points at
+# a directory shared by every gunicorn and analysis worker process: each writes
+# its samples there and the scrape adds them up (cleared when a service starts)
+ENERGY_METRICS_DIR = os.environ.get("ENERGY_METRICS_DIR", "")
+
+# multipart batches carry one file per image
+DATA_UPLOAD_MAX_NUMBER_FILES = ENERGY_BATCH_MAX_IMAGES
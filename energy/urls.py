@@ -8,7 +8,7 @@ urlpatterns = [
     path("", include("Energyapp.urls")),
 ]
 
+# development only; in production annotated images go out through
+# outputs/<token>/annotated/ (see ENERGY_MEDIA_ACCEL)
 if settings.DEBUG:
     urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-else:
-    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
@@ -8,9 +8,17 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 """
 
 import os
+import time
 
-from django.core.wsgi import get_wsgi_application
+_started = time.perf_counter()
+
+from django.core.wsgi import get_wsgi_application  # noqa: E402
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'energy.settings')
 
 application = get_wsgi_application()
+
+# Only serving processes load the models (not manage.py commands)
+from Energyapp import boot  # noqa: E402
+
+boot.serve(_started)
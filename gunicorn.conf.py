@@ -0,0 +1,37 @@
+import gc
+import os
+import time
+
+# Load the Django app (and with it the YOLO models) in the master process so
+# that forked workers share the model weights copy-on-write.
+preload_app = True
+
+# Warm-up inference runs in each worker after fork, never in the master.
+os.environ.setdefault("ENERGY_DEFER_WARMUP", "1")
+
+
+def on_starting(server):
+    # samples of the previous run's workers would be added to the new ones
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "energy.settings")
+    from Energyapp import metrics
+
+    metrics.store.clear()
+
+
+def pre_fork(server, worker):
+    # Keep the preloaded objects out of the collector so that gc passes in
+    # the workers do not touch (and un-share) their pages.
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.perf_counter()
+
+
+def post_worker_init(worker):
+    from Energyapp import boot
+    from Energyapp.inference import engine
+
+    if engine.ready:
+        engine.warmup()
+    boot.worker_started(worker.forked_at)